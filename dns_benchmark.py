@@ -0,0 +1,211 @@
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from dns_latency_stats import format_table
+from dns_standin_server import STANDIN_PORT, ZoneSigner, serve
+
+BENCHMARK_HISTORY = 'benchmark_results.jsonl'  # one JSON record per suite run
+STANDIN_NETWORK = '127.0.1.'  # stand-in servers listen on 127.0.1.1, 127.0.1.2, ... at STANDIN_PORT
+STANDIN_SIGNING_SEED = b'dns-benchmark'  # the stand-ins sign answers, so the DNSSEC sweep validates a real chain
+DOMAIN_COUNTS = [1000, 10000]
+SERVER_COUNTS = [1, 4, 16]
+SERIAL_MAX_QUERIES = 5000  # the serial scan is skipped for bigger grids, it would only measure patience
+MEASUREMENT_SECONDS = 3  # how long run_measurements runs back-to-back rounds
+BLOCKED_EVERY = 5  # every n-th generated domain is on the stand-in block list
+BLOCK_ACTIONS = [None, 'zero', 'nxdomain', 'refused']  # what the stand-in servers do with blocked names, in turn
+REGRESSION_TOLERANCE = 0.15  # relative drop in queries per second (or rise in CPU per query) that fails the run
+
+
+def standin_entries(server_count, latency=0.0, jitter=0.0, loss=0.0):
+    entries = []
+    for index in range(server_count):
+        action = BLOCK_ACTIONS[index % len(BLOCK_ACTIONS)]
+        entries.append({'address': f'{STANDIN_NETWORK}{index + 1}', 'port': STANDIN_PORT, 'latency': latency,
+                        'jitter': jitter, 'loss': loss, 'signing_seed': STANDIN_SIGNING_SEED,
+                        'rules': [({'blocked.bench.example'}, action)] if action else []})
+    return entries
+
+
+# Server entries the benchmarked code is given for the stand-ins
+def standin_servers(server_count):
+    return [f"udp://{entry['address']}:{entry['port']}" for entry in standin_entries(server_count)]
+
+
+def write_domains(workdir, count):
+    domains_file = os.path.join(workdir, f'domains-{count}.txt')
+    with open(domains_file, 'w') as file:
+        for index in range(count):
+            label = 'blocked' if index % BLOCKED_EVERY == 0 else 'site'
+            file.write(f'd{index}.{label}.bench.example\n')
+    return domains_file
+
+
+def write_servers(workdir, servers):
+    servers_file = os.path.join(workdir, f'servers-{len(servers)}.txt')
+    with open(servers_file, 'w') as file:
+        file.write('\n'.join(servers) + '\n')
+    return servers_file
+
+
+# Benchmark cases: each runs one code path against the stand-in servers and returns how many queries it sent
+def bench_scan_serial(servers, domains_file, domain_count, workdir):
+    from dns_domain_list_check import evaluate_dns_servers
+    evaluate_dns_servers(domains_file, write_servers(workdir, servers), os.path.join(workdir, 'serial.db'),
+                         os.path.join(workdir, 'serial.csv'), 0, domain_count, resume=False)
+    return domain_count * len(servers)
+
+
+def bench_scan_concurrent(servers, domains_file, domain_count, workdir):
+    from dns_domain_list_check import evaluate_dns_servers_concurrent
+    evaluate_dns_servers_concurrent(domains_file, write_servers(workdir, servers),
+                                    os.path.join(workdir, 'concurrent.db'), os.path.join(workdir, 'concurrent.csv'),
+                                    domain_count, resume=False)
+    return domain_count * len(servers)
+
+
+def bench_measurement(servers, domains_file, domain_count, workdir):
+    import dns_latency_measurement
+    dns_latency_measurement.PING_LATENCY = False  # ICMP needs privileges and doesn't reach the stand-in
+    output_file = os.path.join(workdir, 'latency.csv')
+    domains = dns_latency_measurement.load_domains(domains_file, domain_count)
+    dns_latency_measurement.run_measurements(servers, domains, 0.001, MEASUREMENT_SECONDS, output_file,
+                                             analysis_interval=3600)
+    with open(output_file, 'r') as file:
+        rows = sum(1 for _ in file) - 1
+    return rows * 2  # google.com and the random domain
+
+
+def bench_dnssec_sweep(servers, domains_file, domain_count, workdir):
+    from dns_check_dnssec import sweep
+    with open(domains_file, 'r') as file:
+        domains = [line.strip() for line in file]
+    verdicts, rows = sweep(servers, domains, [], trust_anchors=ZoneSigner(STANDIN_SIGNING_SEED).trust_anchors())
+    # Answers that didn't validate mean the figures measure something other than validation
+    outcomes = {row['outcome'] for row in rows}
+    if 'secure' not in outcomes or outcomes & {'unsigned', 'bogus', 'unverified'}:
+        raise RuntimeError(f"DNSSEC sweep against the stand-ins did not validate: {sorted(outcomes)}")
+    return domain_count * len(servers)
+
+
+CASES = {
+    'scan_serial': bench_scan_serial,
+    'scan_concurrent': bench_scan_concurrent,
+    'measurement': bench_measurement,
+    'dnssec_sweep': bench_dnssec_sweep,
+}
+
+
+# Run one case in this (fresh) process and report throughput, CPU time per query and peak memory
+def run_case(case, servers, domains_file, domain_count, workdir):
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started, started_cpu = time.perf_counter(), time.process_time()
+        queries = CASES[case](servers, domains_file, domain_count, workdir)
+        seconds, cpu_seconds = time.perf_counter() - started, time.process_time() - started_cpu
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux
+    return {'case': case, 'domains': domain_count, 'servers': len(servers), 'queries': queries,
+            'seconds': round(seconds, 3), 'qps': round(queries / seconds, 1),
+            'cpu_us_per_query': round(cpu_seconds / queries * 1e6, 1),
+            'peak_rss_mb': round(peak_rss / 1024, 1), 'rss_growth_mb': round((peak_rss - baseline_rss) / 1024, 1)}
+
+
+# (case, domain count, server count) combinations to run
+def benchmark_grid(cases, domain_counts, server_counts):
+    for case in cases:
+        for server_count in server_counts:
+            # The measurement loop picks one domain per round, so the list size barely matters to it
+            for domain_count in (domain_counts if case != 'measurement' else domain_counts[:1]):
+                if case == 'scan_serial' and domain_count * server_count > SERIAL_MAX_QUERIES:
+                    continue
+                yield case, domain_count, server_count
+
+
+# Run the grid against stand-in servers, each case in its own process so memory figures don't mix.
+def run_benchmarks(cases=tuple(CASES), domain_counts=DOMAIN_COUNTS, server_counts=SERVER_COUNTS, latency=0.0,
+                   jitter=0.0, loss=0.0):
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    standin = context.Process(target=serve, args=(standin_entries(max(server_counts), latency, jitter, loss), ready),
+                              daemon=True)
+    standin.start()
+    if not ready.wait(30):
+        standin.terminate()
+        raise RuntimeError(f"Stand-in DNS servers did not start (is port {STANDIN_PORT} in use?)")
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            domain_files = {count: write_domains(workdir, count) for count in domain_counts}
+            for case, domain_count, server_count in benchmark_grid(cases, domain_counts, server_counts):
+                servers = standin_servers(server_count)
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    result = pool.submit(run_case, case, servers, domain_files[domain_count], domain_count,
+                                         workdir).result()
+                print(f"{case} with {domain_count} domains x {server_count} servers: {result['qps']} queries/s")
+                results.append(result)
+    finally:
+        standin.terminate()
+        standin.join()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(history_file=BENCHMARK_HISTORY):
+    try:
+        with open(history_file, 'r') as file:
+            return [json.loads(line) for line in file if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+# Append a suite run to the history file
+def record_results(results, history_file=BENCHMARK_HISTORY, settings=None):
+    record = {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': git_commit(),
+              'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+              'settings': settings or {}, 'results': results}
+    with open(history_file, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+    return record
+
+
+# Cases that got slower than in the previous recorded run on the same machine and settings
+def find_regressions(record, history, tolerance=REGRESSION_TOLERANCE):
+    previous = next((old for old in reversed(history)
+                     if old['platform'] == record['platform'] and old['settings'] == record['settings']), None)
+    if previous is None:
+        return []
+    before = {(result['case'], result['domains'], result['servers']): result for result in previous['results']}
+    regressions = []
+    for result in record['results']:
+        old = before.get((result['case'], result['domains'], result['servers']))
+        if old is None:
+            continue
+        if result['qps'] < old['qps'] * (1 - tolerance) or \
+                result['cpu_us_per_query'] > old['cpu_us_per_query'] * (1 + tolerance):
+            regressions.append((result, old))
+    return regressions
+
+
+def print_results(results):
+    columns = ['case', 'domains', 'servers', 'queries', 'seconds', 'qps', 'cpu_us_per_query', 'peak_rss_mb']
+    print()
+    print(format_table("Benchmark results:", columns, [[result[column] for column in columns] for result in results]))
+
+
+if __name__ == "__main__":
+    from dnstk import script_main
+    script_main('benchmark')
@@ -0,0 +1,224 @@
+import array
+import hashlib
+import io
+import itertools
+import math
+import mmap
+import os
+import random
+import re
+import struct
+
+DOMAIN_SET_MAGIC = b'DSET'
+DOMAIN_SET_VERSION = 1
+# magic, version, domain count, bloom filter size in bits, bloom hash count
+DOMAIN_SET_HEADER = struct.Struct('<4sIQQI')
+FALSE_POSITIVE_RATE = 0.001  # bloom filter false positive rate
+
+# Addresses hosts-file blocklists point blocked names at, and names that are never worth querying
+HOSTS_ADDRESSES = {'0.0.0.0', '127.0.0.1', '::', '::1', '0', '255.255.255.255', 'fe80::1%lo0', 'ff00::0',
+                   'ff02::1', 'ff02::2', 'ff02::3'}
+IGNORED_NAMES = {'localhost', 'localhost.localdomain', 'local', 'broadcasthost', 'ip6-localhost',
+                 'ip6-loopback', 'ip6-localnet', 'ip6-mcastprefix', 'ip6-allnodes', 'ip6-allrouters',
+                 'ip6-allhosts', '0.0.0.0'}
+
+ADBLOCK_RULE = re.compile(r'^\|\|([^\^/$|*]+)\^?(?:\$.*)?$')
+DNSMASQ_RULE = re.compile(r'^(?:address|server|local)=/([^/]+)/')
+LABEL = re.compile(r'^[a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9_])?$')
+IPV4 = re.compile(r'^\d{1,3}(?:\.\d{1,3}){3}$')
+
+
+# Domain names found on one blocklist line, in hosts, adblock, dnsmasq or plain format
+def parse_blocklist_line(line):
+    line = line.strip()
+    if not line or line[0] in '#!':
+        return []
+    if line.startswith('||'):
+        match = ADBLOCK_RULE.match(line)
+        return [match.group(1)] if match else []
+    if line.startswith(('address=/', 'server=/', 'local=/')):
+        match = DNSMASQ_RULE.match(line)
+        return match.group(1).split('/') if match else []
+    # Adblock exceptions, cosmetic filters and other rules we can't map to a domain
+    if line.startswith(('@@', '[', '/')) or '##' in line or '#@#' in line:
+        return []
+
+    fields = line.split('#', 1)[0].split()
+    if len(fields) > 1 and (fields[0] in HOSTS_ADDRESSES or IPV4.match(fields[0]) or ':' in fields[0]):
+        return fields[1:]
+    return fields[:1]
+
+
+# Lowercase, IDNA-encode and validate a domain name; returns None for anything that isn't a queryable name
+def normalize_domain(domain):
+    domain = domain.strip().rstrip('.').lower()
+    if domain.startswith('*.'):
+        domain = domain[2:]
+    if not domain or domain in IGNORED_NAMES or IPV4.match(domain):
+        return None
+    if not domain.isascii():
+        try:
+            domain = domain.encode('idna').decode('ascii')
+        except UnicodeError:
+            return None
+    labels = domain.split('.')
+    if len(domain) > 253 or len(labels) < 2 or not all(LABEL.match(label) for label in labels):
+        return None
+    return domain
+
+
+# Lines of a blocklist file or URL; urllib.request (and the HTTP stack behind it) is only loaded for URLs
+def read_source_lines(source):
+    if source.startswith(('http://', 'https://')):
+        import urllib.request
+        with urllib.request.urlopen(source) as response:
+            yield from io.TextIOWrapper(response, encoding='utf-8', errors='replace')
+    else:
+        with open(source, 'r', encoding='utf-8', errors='replace') as file:
+            yield from file
+
+
+# Parse and normalize blocklists into one set of unique domains, with counts of what was dropped
+def collect_domains(sources):
+    domains = set()
+    stats = {'lines': 0, 'invalid': 0, 'duplicates': 0}
+    for source in sources:
+        for line in read_source_lines(source):
+            stats['lines'] += 1
+            for name in parse_blocklist_line(line):
+                domain = normalize_domain(name)
+                if domain is None:
+                    stats['invalid'] += 1
+                    continue
+                domain = domain.encode('ascii')
+                if domain in domains:
+                    stats['duplicates'] += 1
+                else:
+                    domains.add(domain)
+    return domains, stats
+
+
+# Bit positions of a domain in a bloom filter, by double hashing one 128-bit digest
+def bloom_positions(domain, bits, hashes):
+    digest = hashlib.blake2b(domain, digest_size=16).digest()
+    first, second = struct.unpack('<QQ', digest)
+    return [(first + i * second) % bits for i in range(hashes)]
+
+
+# Bloom filter size in bits and number of hashes for n entries at the given false positive rate
+def bloom_parameters(count, false_positive_rate=FALSE_POSITIVE_RATE):
+    bits = max(64, int(math.ceil(-count * math.log(false_positive_rate) / math.log(2) ** 2)))
+    bits = (bits + 7) // 8 * 8
+    hashes = max(1, int(round(bits / max(count, 1) * math.log(2))))
+    return bits, hashes
+
+
+# Write a sorted, deduplicated domain set file:
+# header | line offsets (count + 1 little-endian u64) | domains, one per line, sorted | bloom filter bits
+def write_domain_set(domains, output_path, false_positive_rate=FALSE_POSITIVE_RATE):
+    domains = sorted(domains)
+    bits, hashes = bloom_parameters(len(domains), false_positive_rate)
+    bloom = bytearray(bits // 8)
+    for domain in domains:
+        for position in bloom_positions(domain, bits, hashes):
+            bloom[position >> 3] |= 1 << (position & 7)
+
+    offsets = array.array('Q', itertools.accumulate(map((1).__add__, map(len, domains)), initial=0))
+    temporary_path = output_path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(DOMAIN_SET_HEADER.pack(DOMAIN_SET_MAGIC, DOMAIN_SET_VERSION, len(domains), bits, hashes))
+        offsets.tofile(file)
+        for domain in domains:
+            file.write(domain + b'\n')
+        file.write(bloom)
+    os.replace(temporary_path, output_path)
+    return len(domains)
+
+
+# Whether a file is a domain set written by write_domain_set
+def is_domain_set(path):
+    try:
+        with open(path, 'rb') as file:
+            return file.read(len(DOMAIN_SET_MAGIC)) == DOMAIN_SET_MAGIC
+    except OSError:
+        return False
+
+
+# Read-only, memory-mapped view of a domain set: indexing and sampling in O(1) per domain,
+# membership through the bloom filter and then a binary search
+class DomainSet:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.bloom_bits, self.bloom_hashes = DOMAIN_SET_HEADER.unpack_from(self.mapped)
+        if magic != DOMAIN_SET_MAGIC or version != DOMAIN_SET_VERSION:
+            raise ValueError(f"{path} is not a domain set")
+        self.offsets_start = DOMAIN_SET_HEADER.size
+        self.blob_start = self.offsets_start + 8 * (self.count + 1)
+        self.bloom_start = self.blob_start + self.offset(self.count)
+
+    def close(self):
+        self.mapped.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def offset(self, index):
+        return struct.unpack_from('<Q', self.mapped, self.offsets_start + 8 * index)[0]
+
+    def entry(self, index):
+        start = self.blob_start + self.offset(index)
+        return self.mapped[start:self.blob_start + self.offset(index + 1) - 1]
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self.entry(index).decode('ascii')
+
+    def __iter__(self):
+        return (self[index] for index in range(self.count))
+
+    def __contains__(self, domain):
+        domain = normalize_domain(domain)
+        if domain is None:
+            return False
+        domain = domain.encode('ascii')
+        for position in bloom_positions(domain, self.bloom_bits, self.bloom_hashes):
+            if not self.mapped[self.bloom_start + (position >> 3)] & (1 << (position & 7)):
+                return False
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle) < domain:
+                low = middle + 1
+            else:
+                high = middle
+        return low < self.count and self.entry(low) == domain
+
+    # Random sample of up to k domains, without reading the rest of the set; all of them for k=None
+    def sample(self, k, rng=random):
+        if k is None:
+            return list(self)
+        return [self[index] for index in rng.sample(range(self.count), min(k, self.count))]
+
+
+# Build a domain set from blocklist files or URLs and report what was kept
+def ingest_blocklists(sources, output_path, false_positive_rate=FALSE_POSITIVE_RATE):
+    domains, stats = collect_domains(sources)
+    count = write_domain_set(domains, output_path, false_positive_rate)
+    print(f"Read {stats['lines']} lines from {len(sources)} blocklists.")
+    print(f"Dropped {stats['invalid']} invalid entries and {stats['duplicates']} duplicates.")
+    print(f"Wrote {count} unique domains to {output_path}.")
+    return count
+
+
+if __name__ == "__main__":
+    from dnstk import script_main
+    script_main('ingest')
@@ -1,7 +1,34 @@
-import dns.resolver
-import dns.query
+import asyncio
+import collections
+import csv
+import time
 import dns.dnssec
+import dns.exception
+import dns.flags
 import dns.message
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdataclass
+import dns.rdataset
+import dns.rdatatype
+import dns.rrset
+from dns_query_engine import QueryEngine
+
+# Root zone trust anchors (KSK-2017 and KSK-2024) as DS records
+ROOT_TRUST_ANCHORS = dns.rrset.from_text(
+    '.', 172800, 'IN', 'DS',
+    '20326 8 2 E06D44B80B8F1D39A95C0B0D7C65D08458E880409BBF683457104237C7F8EC8D',
+    '38696 8 2 683D2D0ACB8C9B712A1948B27F741219298D0A450D612C483AF444A4C0FB2B16')
+NEGATIVE_TTL = 30  # seconds a zone whose keys could not be fetched or validated is not retried
+# Signed domains a validating server must answer with valid signatures
+SIGNED_DOMAINS = ['iana.org', 'isc.org', 'ietf.org', 'internetsociety.org', 'nic.cz', 'cloudflare.com',
+                  'dnssec-tools.org', 'ripe.net', 'verisign.com', 'nlnetlabs.nl']
+# Deliberately broken domains a validating server must refuse with SERVFAIL
+BOGUS_DOMAINS = ['dnssec-failed.org', 'www.dnssec-failed.org', 'sigfail.ippacket.stream',
+                 'brokendnssec.net']
+# Outcomes of a signed domain that mean the server gave an answer
+ANSWERED_SIGNED = ('secure', 'unsigned', 'bogus', 'unverified')
 
 
 def check_dnssec(server, domain="iana.org"):
@@ -23,17 +50,234 @@ def check_dnssec(server, domain="iana.org"):
         return False
 
 
-def main():
-    # Read the list of DNS servers from the file
-    with open("dns_servers.txt", "r") as file:
-        dns_servers = [line.strip() for line in file.readlines()]
+# No server returned the RRset with its signatures, e.g. because the path to them strips DNSSEC records.
+# That leaves the answer unverified; only signatures that are there and don't verify make it bogus.
+class MissingSignatures(dns.exception.DNSException):
+    pass
+
+
+# RRSIG RRset covering the given name and type in a message section, or None
+def find_signatures(section, name, rdtype):
+    for rrset in section:
+        if rrset.rdtype == dns.rdatatype.RRSIG and rrset.covers == rdtype and rrset.name == name:
+            return rrset
+    return None
+
+
+# Whether a DNSKEY matches one of the DS records of its zone; DS digest types we can't compute don't match
+def matches_delegation(zone, key, delegation):
+    for ds in delegation:
+        try:
+            if dns.dnssec.make_ds(zone, key, ds.digest_type) == ds:
+                return True
+        except dns.dnssec.UnsupportedAlgorithm:
+            continue
+    return False
+
+
+# Checks answers against the DNSSEC chain of trust down from the root. Validated DNSKEY RRsets are cached
+# per zone until their (or their DS RRset's) TTL runs out, so parent zones shared by many domains
+# (root, TLDs) are fetched and validated once per sweep no matter how many servers ask for them.
+class ChainValidator:
+    def __init__(self, engine, servers, trust_anchors=ROOT_TRUST_ANCHORS):
+        self.engine = engine
+        self.servers = list(servers)  # asked in order for DNSKEY/DS RRsets until one has a valid answer
+        self.trust_anchors = trust_anchors
+        self.keys = {}  # zone name -> future of (DNSKEY RRset or None, expiry, error)
+        self.fetches = 0
 
-    for server in dns_servers:
-        if check_dnssec(server):
-            print(f"DNS server {server} supports DNSSEC.")
+    # Validated DNSKEY RRset of a zone; raises ValidationFailure or the network error that stopped it
+    async def trusted_keys(self, zone):
+        entry = self.keys.get(zone)
+        if entry is None or (entry.done() and entry.result()[1] <= time.monotonic()):
+            # Store the future right away so concurrent lookups of a zone share one fetch
+            entry = self.keys[zone] = asyncio.ensure_future(self.fetch_keys(zone))
+        keys, _, error = await asyncio.shield(entry)
+        if error is not None:
+            raise error
+        return keys
+
+    async def fetch_keys(self, zone):
+        self.fetches += 1
+        try:
+            keys, ttl = await self.validated_keys(zone)
+            return keys, time.monotonic() + ttl, None
+        except (dns.exception.DNSException, OSError) as e:
+            return None, time.monotonic() + NEGATIVE_TTL, e
+
+    # Signed RRset of the given type from the first server that has one, with its RRSIGs
+    async def signed_rrset(self, name, rdtype):
+        error = MissingSignatures(f"no signed {dns.rdatatype.to_text(rdtype)} RRset for {name}")
+        for server in self.servers:
+            try:
+                response = (await self.engine.query(server, name.to_text(), rdtype, want_dnssec=True)).response
+            except (dns.exception.DNSException, OSError) as e:
+                error = e
+                continue
+            try:
+                rrset = response.find_rrset(response.answer, name, dns.rdataclass.IN, rdtype)
+            except KeyError:
+                continue
+            rrsigs = find_signatures(response.answer, name, rdtype)
+            if rrsigs is not None:
+                return rrset, rrsigs
+        raise error
+
+    # DNSKEY RRset of a zone, signed by a key its parent vouches for with a DS record (RFC 4035 section 5.2).
+    # Only the keys matching a DS may sign the set: a set signed by any of its own keys would let a forged set
+    # that carries the real KSK next to the forger's key through.
+    async def validated_keys(self, zone):
+        keys, key_signatures = await self.signed_rrset(zone, dns.rdatatype.DNSKEY)
+
+        if zone == dns.name.root:
+            delegation = self.trust_anchors
         else:
-            print(f"DNS server {server} does not support DNSSEC.")
+            delegation, delegation_signatures = await self.signed_rrset(zone, dns.rdatatype.DS)
+            parent = delegation_signatures[0].signer
+            # The DS RRset belongs to the parent zone; any other signer could point the chain at itself
+            if parent == zone or not zone.is_subdomain(parent):
+                raise dns.dnssec.ValidationFailure(f"DS RRset of {zone} signed by {parent}, not a parent zone")
+            dns.dnssec.validate(delegation, delegation_signatures, {parent: await self.trusted_keys(parent)})
+
+        entry_keys = [key for key in keys if matches_delegation(zone, key, delegation)]
+        if not entry_keys:
+            raise dns.dnssec.ValidationFailure(f"no DNSKEY of {zone} matches its DS records")
+        dns.dnssec.validate(keys, key_signatures, {zone: dns.rdataset.from_rdata_list(keys.ttl, entry_keys)})
+        return keys, min(keys.ttl, delegation.ttl)
+
+    # 'secure' if every RRset in the answer validates up to the trust anchors, 'unsigned' if signatures
+    # are missing, 'bogus' if they don't validate and 'unverified' if the chain couldn't be fetched
+    async def check_answer(self, response):
+        for rrset in response.answer:
+            if rrset.rdtype == dns.rdatatype.RRSIG:
+                continue
+            rrsigs = find_signatures(response.answer, rrset.name, rrset.rdtype)
+            if rrsigs is None:
+                return 'unsigned'
+            signer = rrsigs[0].signer
+            # A zone's keys only vouch for names in that zone; validate() doesn't check this
+            if not rrset.name.is_subdomain(signer):
+                return 'bogus'
+            try:
+                dns.dnssec.validate(rrset, rrsigs, {signer: await self.trusted_keys(signer)})
+            except dns.dnssec.ValidationFailure:
+                return 'bogus'
+            except (dns.exception.DNSException, OSError):
+                return 'unverified'
+        return 'secure'
+
+
+# Query one domain with the DO bit set and describe what the server did with it
+async def check_domain(engine, validator, server, domain, expect):
+    row = {'server': server, 'domain': domain, 'expect': expect, 'outcome': 'timeout', 'ad': False,
+           'latency': None}
+    try:
+        result = await engine.query(server, domain, 'A', want_dnssec=True)
+    except (dns.exception.DNSException, OSError):
+        return row
+    response = result.response
+    row['ad'] = bool(response.flags & dns.flags.AD)
+    row['latency'] = result.latency
+    rcode = response.rcode()
+
+    if rcode == dns.rcode.SERVFAIL:
+        row['outcome'] = 'rejected' if expect == 'bogus' else 'servfail'
+    elif rcode != dns.rcode.NOERROR or not response.answer:
+        row['outcome'] = dns.rcode.to_text(rcode).lower() if rcode != dns.rcode.NOERROR else 'nodata'
+    elif expect == 'bogus':
+        row['outcome'] = 'answered'
+    else:
+        row['outcome'] = await validator.check_answer(response)
+    return row
+
+
+# Overall verdict for a server from its rows: 'validates', 'strips', 'passes bogus', 'unreachable'
+# or 'inconclusive'
+def classify_server(rows):
+    signed = collections.Counter(row['outcome'] for row in rows if row['expect'] == 'secure')
+    bogus = collections.Counter(row['outcome'] for row in rows if row['expect'] == 'bogus')
+    authenticated = sum(1 for row in rows if row['expect'] == 'secure' and row['outcome'] == 'secure' and row['ad'])
+    answered = sum(signed[outcome] for outcome in ANSWERED_SIGNED)
+
+    if not answered and not bogus['answered'] and not bogus['rejected']:
+        return 'unreachable'
+    if signed['unsigned'] * 2 > answered:
+        return 'strips'
+    if bogus['answered']:
+        return 'passes bogus'
+    if bogus['rejected'] and authenticated * 2 > answered and not signed['bogus']:
+        return 'validates'
+    return 'inconclusive'
+
+
+# Check every server against every signed and bogus domain concurrently
+async def sweep_async(servers, signed_domains, bogus_domains, max_in_flight=512, per_server_in_flight=32,
+                      timeout=2.0, chain_servers=None, trust_anchors=ROOT_TRUST_ANCHORS):
+    engine = QueryEngine(timeout=timeout)
+    validator = ChainValidator(engine, chain_servers or servers, trust_anchors)
+    global_limit = asyncio.Semaphore(max_in_flight)
+    # Bursts beyond what one server's socket buffer holds are dropped and only come back as retries
+    server_limits = {server: asyncio.Semaphore(per_server_in_flight) for server in servers}
+
+    async def limited(server, domain, expect):
+        async with server_limits[server], global_limit:
+            return await check_domain(engine, validator, server, domain, expect)
+
+    try:
+        rows = await asyncio.gather(*[limited(server, domain, 'secure')
+                                      for server in servers for domain in signed_domains],
+                                    *[limited(server, domain, 'bogus')
+                                      for server in servers for domain in bogus_domains])
+    finally:
+        await engine.close()
+    return rows, validator.fetches
+
+
+# Sweep all servers and classify each one; local validation needs dnspython's DNSSEC extra (cryptography)
+def sweep(servers, signed_domains=SIGNED_DOMAINS, bogus_domains=BOGUS_DOMAINS, max_in_flight=512,
+          per_server_in_flight=32, timeout=2.0, chain_servers=None, trust_anchors=ROOT_TRUST_ANCHORS):
+    started = time.monotonic()
+    rows, fetches = asyncio.run(sweep_async(servers, signed_domains, bogus_domains, max_in_flight,
+                                            per_server_in_flight, timeout, chain_servers, trust_anchors))
+    by_server = collections.defaultdict(list)
+    for row in rows:
+        by_server[row['server']].append(row)
+    verdicts = {server: classify_server(by_server[server]) for server in servers}
+    print(f"Checked {len(servers)} servers against {len(signed_domains)} signed and {len(bogus_domains)} bogus "
+          f"domains in {time.monotonic() - started:.1f} s ({fetches} DNSKEY fetches).")
+    return verdicts, rows
+
+
+# One line per server with its verdict and the outcome counts behind it
+def print_verdicts(verdicts, rows):
+    counts = collections.defaultdict(collections.Counter)
+    for row in rows:
+        counts[row['server']][row['expect'], row['outcome']] += 1
+    for server, verdict in verdicts.items():
+        count = counts[server]
+        print(f"DNS server {server}: {verdict} (signed: {count['secure', 'secure']} secure, "
+              f"{count['secure', 'unsigned']} unsigned, {count['secure', 'bogus']} bogus, "
+              f"{count['secure', 'servfail']} servfail, {count['secure', 'timeout']} timeouts; "
+              f"bogus: {count['bogus', 'rejected']} rejected, {count['bogus', 'answered']} answered)")
+
+
+# Raw sweep results, one row per server and domain
+def write_sweep_csv(rows, csv_output_file):
+    with open(csv_output_file, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['server', 'domain', 'expect', 'outcome', 'ad', 'latency'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+# Domains from a file, one per line, or the given defaults if there is no such file
+def load_domain_list(file_path, default):
+    try:
+        with open(file_path, "r") as file:
+            return [line.strip() for line in file if line.strip() and not line.startswith('#')]
+    except FileNotFoundError:
+        return list(default)
 
 
 if __name__ == "__main__":
-    main()
+    from dnstk import script_main
+    script_main('dnssec')
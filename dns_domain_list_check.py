@@ -1,137 +1,381 @@
-import dns.resolver
+import asyncio
+import collections
+import contextlib
+import math
+import multiprocessing
+import os
 import time
-import csv
 import datetime
-import random
+from dns_domain_sampling import sample_domains, parse_shard, shard_share, worker_shards
+from dns_results_store import ResultsStore, export_csv
+from dns_query_engine import QueryEngine, shared_blocking_engine, has_answer, first_address
+from dns_metrics import QueryMetrics, MetricsExporter, profiled
 
 
-# Function to resolve a domain using a specific DNS server
+# Whether a response resolves the domain, i.e. it has an A record that isn't the 0.0.0.0 block answer
+def is_resolved(response):
+    return has_answer(response, 'A') and first_address(response, 'A') != '0.0.0.0'
+
+
+# Function to resolve a domain using a specific DNS server. Only an answer can mean the domain is blocked:
+# without one (a timeout, a retry budget running out, a broken connection or a server out of use after
+# failing repeatedly) the result is None, stored as unavailable and retried on resume.
 def resolve_domain(domain, dns_server, sleep_time):
     try:
-        resolver = dns.resolver.Resolver()
-        resolver.nameservers = [dns_server]
-        answer = resolver.resolve(domain, 'A')
-        ip_address = answer[0].to_text()
-        time.sleep(sleep_time)
-        return ip_address != '0.0.0.0'
+        result = shared_blocking_engine().query(dns_server, domain, 'A')
     except Exception:
-        return False
+        return None
+    time.sleep(sleep_time)
+    return is_resolved(result.response)
 
 
-# Function to load already processed domains from working_domains.txt
-def load_processed_domains(working_domains_file):
-    try:
-        with open(working_domains_file, 'r') as wdf:
-            return set(wdf.read().splitlines())
-    except FileNotFoundError:
-        return set()
+# Token bucket limiting the rate of queries sent to a single DNS server
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate  # tokens (queries) per second
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
 
+    async def acquire(self):
+        # The lock keeps waiters in FIFO order so no query starves
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-# Main function to evaluate DNS servers
-def evaluate_dns_servers(domains_file, dns_servers_file, working_domains_file, csv_output_file, sleep_time,
-                         num_domains):
-    # Load already processed domains
-    processed_domains = load_processed_domains(working_domains_file)
 
-    # Read domains and DNS servers from files
-    with open(domains_file, 'r') as df:
-        all_domains = df.read().splitlines()
+# Function to resolve a domain asynchronously, honouring the concurrency and rate limits
+async def resolve_domain_async(domain, engine, dns_server, server_limit, global_limit, bucket=None):
+    # Per-server slot and token first, so a throttled server doesn't hold global slots while waiting
+    async with server_limit:
+        if bucket is not None:
+            await bucket.acquire()
+        async with global_limit:
+            try:
+                result = await engine.query(dns_server, domain, 'A')
+            except Exception:
+                return None  # no answer, see resolve_domain
+            return is_resolved(result.response)
 
+
+# Function to read the DNS servers: plain addresses for UDP, or tcp://, tls:// and https:// URLs
+def load_dns_servers(dns_servers_file):
     with open(dns_servers_file, 'r') as dsf:
-        dns_servers = dsf.read().splitlines()
+        return [line.strip() for line in dsf if line.strip()]
+
+
+# Print resolved/blocked totals for every DNS server
+def print_dns_stats(dns_stats, total_resolvable_domains):
+    for dns_server, stats in dns_stats.items():
+        blocked_due_to_resolving_issues = total_resolvable_domains - stats['resolved'] - stats['unavailable']
+        unavailable = f", {stats['unavailable']} domains UNAVAILABLE (no answer)" \
+            if stats['unavailable'] else ''
+        print(
+            f"{dns_server}: {stats['resolved']} domains RESOLVED, {blocked_due_to_resolving_issues} domains BLOCKED"
+            f"{unavailable}")
+
+
+# Record the results of one domain: update stats and the results store, then report progress. retried are
+# the servers whose earlier UNAVAILABLE result these replace.
+def record_domain_result(scan, domain, index, results, resolved_before=False, retried=()):
+    domain_resolved = resolved_before
+    if resolved_before:
+        # run_stats counted those as unavailable, the results below count them anew
+        for dns_server in retried:
+            scan['dns_stats'][dns_server]['unavailable'] -= 1
+    for dns_server, resolved in results.items():
+        if resolved:
+            scan['dns_stats'][dns_server]['resolved'] += 1
+            domain_resolved = True
+        elif resolved is not None:
+            scan['dns_stats'][dns_server]['blocked'] += 1
+
+    if domain_resolved and not resolved_before:
+        scan['total_resolvable_domains'] += 1
+    if domain_resolved:
+        for dns_server, resolved in results.items():
+            if resolved is None:
+                scan['dns_stats'][dns_server]['unavailable'] += 1
+
+    scan['store'].record(scan['run_id'], domain, results)
+
+    # Progress and time estimation, over the domains tested by this invocation
+    total_domains = scan['total_domains']
+    completed = index
+    remaining = total_domains - completed
+    scan['tested'] += 1
+    elapsed_time = (datetime.datetime.now() - scan['start_time']).total_seconds()
+    estimated_time = (elapsed_time / scan['tested']) * remaining
+    print(
+        f"Tested {completed}/{total_domains} domains. Remaining: {remaining} domains. "
+        f"Estimated time left: {datetime.timedelta(seconds=estimated_time)} "
+        f"Domain: '{domain}' was {'RESOLVED' if domain_resolved else 'not resolved'}."
+    )
+
+    # Print intermediate stats after every 10 domains
+    if completed % 10 == 0:
+        print("\n" + "=" * 50)
+        print("Intermediate DNS Servers Stats:")
+        print_dns_stats(scan['dns_stats'], scan['total_resolvable_domains'])
+        print("=" * 50 + "\n")
+
 
-    # Select X random domains
-    domains = random.sample(all_domains, num_domains)
+# Print the final statistics of a scan
+def print_final_stats(scan):
+    end_time = datetime.datetime.now()
+    duration = end_time - scan['start_time']
 
-    total_domains = len(domains)
-    total_resolvable_domains = 0
-    dns_stats = {dns: {'resolved': 0, 'blocked': 0} for dns in dns_servers}
+    print("\nFinal Statistics:")
+    print(f"Run: {scan['run_id']} (started {scan['run_started']})")
+    print(f"Start of the test: {scan['start_time'].strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"End of the test: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"Duration of the test: {str(duration)}")
+    print(
+        f"Domains tested: {scan['total_domains']} (randomly picked domains from total of {scan['all_domains_count']} domains)")
+    print(f"Active domains: {scan['total_resolvable_domains']} (resolved by at least one of the DNS servers)")
 
-    start_time = datetime.datetime.now()
+    print("\nDNS Servers Stats:")
+    print_dns_stats(scan['dns_stats'], scan['total_resolvable_domains'])
+
+
+# Set up the shared state of a scan: resume the last unfinished run over domains_file, or start a new one.
+# A sharded scan (shard = (i, N)) only takes the domains of its shard, and its share of num_domains.
+def start_scan(domains_file, dns_servers_file, store_file, num_domains, use_domain_index=False, resume=True,
+               shard=None):
+    store = ResultsStore(store_file)
+    dns_servers = load_dns_servers(dns_servers_file)
+    shard_spec = format_shard(shard)
+
+    run_id = store.latest_unfinished_run(domains_file, shard_spec) if resume else None
+    if run_id is None:
+        # Select X random domains, streaming the list so memory grows with X and not with the list
+        if shard is not None and num_domains is not None:
+            num_domains = shard_share(num_domains, shard)
+        domains, all_domains_count = sample_domains(domains_file, num_domains, use_index=use_domain_index,
+                                                    shard=shard)
+        run_id = store.create_run(domains_file, all_domains_count, domains, shard_spec)
+    else:
+        print(f"Resuming run {run_id}.")
+
+    # Servers added since the run started are tested on all of its domains, the others only where missing
+    store.add_run_servers(run_id, dns_servers)
+    _, all_domains_count, run_started, _ = store.run_info(run_id)
+    dns_stats, total_resolvable_domains = store.run_stats(run_id, dns_servers)
+
+    return {
+        'store': store,
+        'run_id': run_id,
+        'run_started': run_started,
+        'remaining': store.remaining(run_id, dns_servers),
+        'dns_servers': dns_servers,
+        'all_domains_count': all_domains_count,
+        'total_domains': store.run_domain_count(run_id),
+        'total_resolvable_domains': total_resolvable_domains,
+        'dns_stats': dns_stats,
+        'start_time': datetime.datetime.now(),
+        'tested': 0,
+    }
+
+
+# Commit what is left, mark the run finished if nothing remains, and export it as CSV. The final stats are
+# taken from the store, since results retried on resume were counted before.
+def finish_scan(scan, csv_output_file):
+    store = scan['store']
+    if not store.remaining(scan['run_id'], scan['dns_servers']):
+        store.finish_run(scan['run_id'])
+    scan['dns_stats'], scan['total_resolvable_domains'] = store.run_stats(scan['run_id'], scan['dns_servers'])
+    export_csv(store, scan['run_id'], csv_output_file)
+    store.close()
+
+
+def format_shard(shard):
+    return f'{shard[0]}/{shard[1]}' if shard is not None else None
+
+
+# Output file of one shard of a scan, e.g. dns_results.shard-2-of-8.db
+def shard_path(path, shard):
+    if shard is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}.shard-{shard[0]}-of-{shard[1]}{extension}'
+
+
+# Main function to evaluate DNS servers
+def evaluate_dns_servers(domains_file, dns_servers_file, store_file, csv_output_file, sleep_time,
+                         num_domains, use_domain_index=False, resume=True, shard=None, metrics=None):
+    store_file, csv_output_file = shard_path(store_file, shard), shard_path(csv_output_file, shard)
+    scan = start_scan(domains_file, dns_servers_file, store_file, num_domains, use_domain_index, resume, shard)
+    if metrics is not None:
+        shared_blocking_engine().engine.metrics = metrics
 
     try:
-        # Open CSV file for appending
-        with open(csv_output_file, 'a', newline='') as csvfile:
-            csvwriter = csv.writer(csvfile)
-            # Write header only if the file is new
-            if csvfile.tell() == 0:
-                header = ['Domain'] + dns_servers
-                csvwriter.writerow(header)
-
-            for index, domain in enumerate(domains, start=1):
-                if domain in processed_domains:
-                    print(f"Domain '{domain}' already processed. Skipping...")
-                    continue
-
-                row = [domain]
-                domain_resolved = False
-                for dns_server in dns_servers:
-                    resolved = resolve_domain(domain, dns_server, sleep_time)
-                    row.append(resolved)
-                    if resolved:
-                        dns_stats[dns_server]['resolved'] += 1
-                        domain_resolved = True
-                    else:
-                        dns_stats[dns_server]['blocked'] += 1
-
-                if domain_resolved:
-                    total_resolvable_domains += 1
-                    # Append domain to working_domains_file
-                    with open(working_domains_file, 'a') as wdf:
-                        wdf.write(f"{domain}\n")
-                    processed_domains.add(domain)
-
-                csvwriter.writerow(row)
-
-                # Progress and time estimation
-                completed = index
-                remaining = total_domains - completed
-                elapsed_time = (datetime.datetime.now() - start_time).total_seconds()
-                estimated_time = (elapsed_time / completed) * remaining
-                print(
-                    f"Tested {completed}/{total_domains} domains. Remaining: {remaining} domains. "
-                    f"Estimated time left: {datetime.timedelta(seconds=estimated_time)} "
-                    f"Domain: '{domain}' was {'RESOLVED' if domain_resolved else 'not resolved'}."
-                )
-
-                # Print intermediate stats after every 10 domains
-                if completed % 10 == 0:
-                    print("\n" + "=" * 50)
-                    print("Intermediate DNS Servers Stats:")
-                    for dns_server, stats in dns_stats.items():
-                        blocked_due_to_resolving_issues = total_resolvable_domains - stats['resolved']
-                        print(
-                            f"{dns_server}: {stats['resolved']} domains RESOLVED, {blocked_due_to_resolving_issues} domains BLOCKED")
-                    print("=" * 50 + "\n")
+        for index, domain, servers, resolved_before, retried in scan['remaining']:
+            results = {dns_server: resolve_domain(domain, dns_server, sleep_time) for dns_server in servers}
+            record_domain_result(scan, domain, index, results, resolved_before, retried)
     except KeyboardInterrupt:
         print("\nProcess interrupted by user.")
     finally:
-        end_time = datetime.datetime.now()
-        duration = end_time - start_time
-
-        # Print final statistics
-        print("\nFinal Statistics:")
-        print(f"Start of the test: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"End of the test: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"Duration of the test: {str(duration)}")
-        print(
-            f"Domains tested: {total_domains} (randomly picked domains from total of {len(all_domains)} domains)")
-        print(f"Active domains: {total_resolvable_domains} (resolved by at least one of the DNS servers)")
+        finish_scan(scan, csv_output_file)
+        print_final_stats(scan)
+
+
+# Resolve the domains of a scan concurrently, recording them in the original order
+async def scan_domains_async(scan, max_in_flight, per_server_in_flight, rate_limit, timeout, metrics=None):
+    engine = QueryEngine(lifetime=timeout, metrics=metrics)
+    global_limit = asyncio.Semaphore(max_in_flight)
+    servers = {}
+    for dns_server in scan['dns_servers']:
+        bucket = TokenBucket(rate_limit) if rate_limit else None
+        servers[dns_server] = (asyncio.Semaphore(per_server_in_flight), bucket)
+
+    async def resolve_on_servers(domain, dns_servers):
+        results = await asyncio.gather(*(
+            resolve_domain_async(domain, engine, dns_server, servers[dns_server][0], global_limit, servers[dns_server][1])
+            for dns_server in dns_servers))
+        return dict(zip(dns_servers, results))
+
+    # Keep enough domains pending to fill every query slot, but no more, so memory stays bounded
+    window = 2 * max(1, max_in_flight // max(1, len(servers)))
+    pending = collections.deque()
+    try:
+        for index, domain, dns_servers, resolved_before, retried in scan['remaining']:
+            task = asyncio.ensure_future(resolve_on_servers(domain, dns_servers))
+            pending.append((index, domain, resolved_before, retried, task))
+            if len(pending) >= window:
+                await record_next_pending(scan, pending)
+
+        while pending:
+            await record_next_pending(scan, pending)
+    finally:
+        for *_, task in pending:
+            task.cancel()
+        await engine.close()
+
+
+# Wait for the oldest pending domain and record its result
+async def record_next_pending(scan, pending):
+    index, domain, resolved_before, retried, task = pending[0]
+    results = await task
+    record_domain_result(scan, domain, index, results, resolved_before, retried)
+    pending.popleft()
+
+
+# Concurrent variant of evaluate_dns_servers, producing the same results and statistics.
+# profile_file, if given, receives stack samples of the scan loop (see dns_metrics.profiled).
+def evaluate_dns_servers_concurrent(domains_file, dns_servers_file, store_file, csv_output_file,
+                                    num_domains, max_in_flight=256, per_server_in_flight=32, rate_limit=None,
+                                    timeout=5.0, use_domain_index=False, resume=True, shard=None, metrics=None,
+                                    profile_file=None):
+    store_file, csv_output_file = shard_path(store_file, shard), shard_path(csv_output_file, shard)
+    scan = start_scan(domains_file, dns_servers_file, store_file, num_domains, use_domain_index, resume, shard)
+
+    try:
+        with profiled(profile_file):
+            asyncio.run(scan_domains_async(scan, max_in_flight, per_server_in_flight, rate_limit, timeout,
+                                           metrics))
+    except KeyboardInterrupt:
+        print("\nProcess interrupted by user.")
+    finally:
+        finish_scan(scan, csv_output_file)
+        print_final_stats(scan)
+
+
+# Whether the shards hold every domain of the target shard exactly once
+def shards_cover(shards, target=(0, 1)):
+    period = math.lcm(target[1], *(count for _, count in shards))
+    if period > 1_000_000:
+        return True  # too many residues to check; trust the specs
+    for residue in range(target[0], period, target[1]):
+        if sum(1 for index, count in shards if residue % count == index) != 1:
+            return False
+    return True
+
+
+# Combine the latest runs of shard stores into one run of store_file (labelled as shard, if the result is
+# itself one shard of a bigger scan), export it as CSV and print the final stats of the whole scan
+def merge_shards(shard_store_files, store_file, csv_output_file, shard=None):
+    runs = []
+    for shard_store_file in shard_store_files:
+        shard_store = ResultsStore(shard_store_file)
+        run_id = shard_store.latest_run()
+        if run_id is None:
+            shard_store.close()
+            raise ValueError(f"No runs in {shard_store_file}")
+        runs.append((shard_store_file, run_id, shard_store.run_info(run_id), shard_store.run_shard(run_id)))
+        shard_store.close()
+
+    domains_files = {info[0] for _, _, info, _ in runs}
+    if len(domains_files) > 1:
+        raise ValueError(f"Shards scanned different domain lists: {', '.join(sorted(domains_files))}")
+    shards = [parse_shard(spec) for _, _, _, spec in runs if spec is not None]
+    if len(shards) != len(runs) or not shards_cover(shards, shard or (0, 1)):
+        print("Warning: the shards are missing or overlapping parts of the domain list.")
+
+    store = ResultsStore(store_file)
+    domains_file, all_domains_count = runs[0][2][0], runs[0][2][1]
+    run_id = store.create_run(domains_file, all_domains_count, [], format_shard(shard))
+    for shard_store_file, shard_run_id, _, _ in runs:
+        store.import_run(shard_store_file, shard_run_id, run_id)
+    if all(info[3] is not None for _, _, info, _ in runs):
+        store.finish_run(run_id)
+
+    dns_servers = store.run_servers(run_id)
+    dns_stats, total_resolvable_domains = store.run_stats(run_id, dns_servers)
+    print(f"\nMerged {len(runs)} shards into run {run_id} of {store_file}.")
+    print(f"Domains tested: {store.run_domain_count(run_id)} (from total of {all_domains_count} domains)")
+    print(f"Active domains: {total_resolvable_domains} (resolved by at least one of the DNS servers)")
+    print("\nDNS Servers Stats:")
+    print_dns_stats(dns_stats, total_resolvable_domains)
+    export_csv(store, run_id, csv_output_file)
+    store.close()
+
+
+# One worker of a local sharded scan; its progress goes to a log file next to its store, and its metrics
+# (if metrics_file is given) to a JSON dump per shard
+def scan_shard_worker(domains_file, dns_servers_file, store_file, csv_output_file, num_domains, shard, options,
+                      metrics_file=None):
+    metrics = QueryMetrics() if metrics_file is not None else None
+    with open(shard_path(store_file, shard) + '.log', 'a') as log, contextlib.redirect_stdout(log), \
+            MetricsExporter(metrics, None, shard_path(metrics_file, shard)) if metrics else contextlib.nullcontext():
+        evaluate_dns_servers_concurrent(domains_file, dns_servers_file, store_file, csv_output_file, num_domains,
+                                        shard=shard, metrics=metrics, **options)
+
+
+# Scan one shard of the domain list (all of it by default) with a process per worker, each with its own event
+# loop and store, and merge their stores. Run the same command with --shard i/N on N hosts, then merge their
+# stores with --merge, to spread a scan over machines.
+def evaluate_dns_servers_sharded(domains_file, dns_servers_file, store_file, csv_output_file, num_domains,
+                                 workers, shard=None, metrics_file=None, **options):
+    shards = worker_shards(shard or (0, 1), workers)
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=scan_shard_worker,
+                                 args=(domains_file, dns_servers_file, store_file, csv_output_file, num_domains,
+                                       worker_shard, options, metrics_file))
+                 for worker_shard in shards]
+    for process in processes:
+        process.start()
+    print(f"Started {workers} shard workers, logging to {shard_path(store_file, shards[0])}.log and the like.")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # The workers got the interrupt too; they save their progress, so the scan can be resumed
+        for process in processes:
+            process.join()
+        print("\nProcess interrupted by user.")
+        return
 
-        print("\nDNS Servers Stats:")
-        for dns_server, stats in dns_stats.items():
-            blocked_due_to_resolving_issues = total_resolvable_domains - stats['resolved']
-            print(
-                f"{dns_server}: {stats['resolved']} domains RESOLVED, {blocked_due_to_resolving_issues} domains BLOCKED")
+    merge_shards([shard_path(store_file, worker_shard) for worker_shard in shards], shard_path(store_file, shard),
+                 shard_path(csv_output_file, shard), shard)
 
 
 if __name__ == "__main__":
-    # Input/Output files
-    domains_file = "domains.txt"  # list of domains to check for
-    dns_servers_file = "dns_servers.txt"  # list of DNS servers
-    working_domains_file = "working_domains.txt"  # already processed active domains (have A record)
-    csv_output_file = "dns_results.csv"  # detailed output
-    sleep_time = 0  # seconds between checking if needed
-    num_domains = 1904  # Number of random domains to pick from the domain_file
-
-    evaluate_dns_servers(domains_file, dns_servers_file, working_domains_file, csv_output_file, sleep_time, num_domains)
+    from dnstk import script_main
+    script_main('scan')
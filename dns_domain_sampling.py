@@ -0,0 +1,238 @@
+import array
+import hashlib
+import itertools
+import math
+import mmap
+import os
+import random
+import struct
+from dns_blocklist_ingest import DomainSet, is_domain_set
+
+CHUNK_SIZE = 16 * 1024 * 1024  # bytes of the domain list handled at once
+INDEX_MAGIC = b'DLIX'
+INDEX_VERSION = 1
+# magic, version, size and mtime of the indexed list, number of lines
+INDEX_HEADER = struct.Struct('<4sIQQQ')
+SET_BATCH = 100000  # domains of a domain set hashed at once when picking a shard
+
+
+# Map a file read-only; empty files can't be mapped, so they yield None
+def map_file(file):
+    if os.fstat(file.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# Split a memory-mapped file into chunks that end on a line boundary, as (offset, bytes) pairs
+def iter_chunks(mapped, chunk_size=CHUNK_SIZE):
+    start = 0
+    size = len(mapped)
+    while start < size:
+        end = min(start + chunk_size, size)
+        if end < size:
+            newline = mapped.rfind(b'\n', start, end)
+            # A single line longer than the chunk: extend to its end
+            end = newline + 1 if newline != -1 else (mapped.find(b'\n', end) + 1 or size)
+        yield start, mapped[start:end]
+        start = end
+
+
+# Non-empty, stripped lines of a chunk; the iteration runs in C, without a Python-level loop per line
+def chunk_lines(chunk):
+    return filter(None, map(bytes.strip, chunk.split(b'\n')))
+
+
+def decode_domain(line):
+    return line.decode('utf-8', errors='replace')
+
+
+# Reservoir sampling with geometric skips (Li's Algorithm L) over lists of lines, so only O(k log(n/k))
+# lines are touched. Returns up to k lines in random order and the number of lines seen.
+def reservoir_from_batches(batches, k, rng=random):
+    reservoir = []
+    count = 0
+    if k <= 0:
+        return reservoir, count
+
+    weight = math.exp(math.log(rng.random()) / k)
+    next_pick = None  # index of the next line that replaces a reservoir entry
+    for lines in batches:
+        position = 0
+        if len(reservoir) < k:
+            position = min(k - len(reservoir), len(lines))
+            reservoir.extend(lines[:position])
+            if len(reservoir) == k:
+                next_pick = k + int(math.log(rng.random()) / math.log(1 - weight))
+        while next_pick is not None and next_pick < count + len(lines):
+            reservoir[rng.randrange(k)] = lines[next_pick - count]
+            weight *= math.exp(math.log(rng.random()) / k)
+            next_pick += int(math.log(rng.random()) / math.log(1 - weight)) + 1
+        count += len(lines)
+
+    rng.shuffle(reservoir)
+    return reservoir, count
+
+
+# Non-empty lines of a domain list, a list per chunk
+def iter_line_batches(file_path):
+    with open(file_path, 'rb') as file:
+        mapped = map_file(file)
+        if mapped is None:
+            return
+        with mapped:
+            for _, chunk in iter_chunks(mapped):
+                yield list(chunk_lines(chunk))
+
+
+# Uniform random sample of up to k non-empty lines, memory grows with k and not with the file.
+# Returns the sample in random order (all lines in file order for k=None) and the number of non-empty lines.
+def reservoir_sample(file_path, k, rng=random):
+    if k is None:
+        lines = list(itertools.chain.from_iterable(iter_line_batches(file_path)))
+        return [decode_domain(line) for line in lines], len(lines)
+    if k <= 0:
+        return [], 0
+    reservoir, count = reservoir_from_batches(iter_line_batches(file_path), k, rng)
+    return [decode_domain(line) for line in reservoir], count
+
+
+# Default location of the line-offset index for a domain list
+def index_path_for(file_path):
+    return file_path + '.idx'
+
+
+# Write an index holding the byte offset of every non-empty line, so samples can be drawn without a rescan
+def build_line_index(file_path, index_path=None):
+    index_path = index_path or index_path_for(file_path)
+    stat = os.stat(file_path)
+    count = 0
+    temporary_path = index_path + '.tmp'
+    with open(file_path, 'rb') as file, open(temporary_path, 'wb') as index:
+        index.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, 0, 0))
+        mapped = map_file(file)
+        if mapped is not None:
+            with mapped:
+                for offset, chunk in iter_chunks(mapped):
+                    lines = chunk.split(b'\n')
+                    # Start offset of every line, then keep those of the non-empty ones
+                    starts = itertools.accumulate(map((1).__add__, map(len, lines)), initial=offset)
+                    offsets = array.array('Q', itertools.compress(starts, map(bytes.strip, lines)))
+                    offsets.tofile(index)
+                    count += len(offsets)
+        index.seek(0)
+        index.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, stat.st_size, stat.st_mtime_ns, count))
+    os.replace(temporary_path, index_path)
+    return count
+
+
+# Whether an index exists and still matches the size and modification time of its domain list
+def index_is_current(file_path, index_path=None):
+    index_path = index_path or index_path_for(file_path)
+    try:
+        with open(index_path, 'rb') as index:
+            magic, version, size, mtime_ns, _ = INDEX_HEADER.unpack(index.read(INDEX_HEADER.size))
+    except (FileNotFoundError, struct.error):
+        return False
+    stat = os.stat(file_path)
+    return magic == INDEX_MAGIC and version == INDEX_VERSION and (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+
+
+# Random sample of up to k lines drawn through the index, in O(k) time regardless of the list size;
+# all lines in file order for k=None
+def sample_from_index(file_path, k, index_path=None, rng=random):
+    index_path = index_path or index_path_for(file_path)
+    with open(index_path, 'rb') as index, open(file_path, 'rb') as file:
+        _, _, _, _, count = INDEX_HEADER.unpack(index.read(INDEX_HEADER.size))
+        if count == 0:
+            return [], count
+        with mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ) as offsets, map_file(file) as mapped:
+            domains = []
+            line_numbers = range(count) if k is None else rng.sample(range(count), min(k, count))
+            for line_number in line_numbers:
+                position = INDEX_HEADER.size + 8 * line_number
+                offset = struct.unpack_from('<Q', offsets, position)[0]
+                end = mapped.find(b'\n', offset)
+                domains.append(decode_domain(mapped[offset:end if end != -1 else len(mapped)].strip()))
+    return domains, count
+
+
+# Random sample of up to k domains from a list (all of them for k=None), plus the number of domains in it.
+# Domain sets from dns_blocklist_ingest are sampled directly; for text lists with use_index,
+# an up-to-date line index is used (and built first if missing or stale).
+def sample_domains(file_path, k, use_index=False, index_path=None, rng=random, shard=None):
+    if shard is not None:
+        return sample_shard(file_path, k, shard, rng)
+    if is_domain_set(file_path):
+        with DomainSet(file_path) as domain_set:
+            return domain_set.sample(k, rng), len(domain_set)
+    if use_index:
+        if not index_is_current(file_path, index_path):
+            build_line_index(file_path, index_path)
+        return sample_from_index(file_path, k, index_path, rng)
+    return reservoir_sample(file_path, k, rng)
+
+
+# Unique random name under a domain; no resolver has it cached, so looking it up takes a trip to the
+# domain's authoritative servers
+def random_subdomain(domain, rng=random):
+    return f'{rng.getrandbits(48):012x}.{domain}'
+
+
+# Parse a shard spec 'i/N' (i counted from 0) into (i, N)
+def parse_shard(spec):
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"Shard must look like i/N, got {spec!r}")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index must be between 0 and {count - 1}, got {spec!r}")
+    return index, count
+
+
+# Shard a domain belongs to, out of count. The hash only depends on the name, so every process and host
+# running the same shard spec agrees on the partition.
+def shard_of(domain, count):
+    digest = hashlib.blake2b(domain.strip().lower(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % count
+
+
+# Split a shard into the sub-shards of its local workers: worker w of shard i/N takes (i + N*w)/(N*W).
+# Since N divides N*W, the workers' shards together hold exactly the domains of i/N.
+def worker_shards(shard, workers):
+    index, count = shard
+    return [(index + count * worker, count * workers) for worker in range(workers)]
+
+
+# How many of k sampled domains a shard takes, so the shares of all shards add up to k
+def shard_share(k, shard):
+    index, count = shard
+    return k // count + (1 if index < k % count else 0)
+
+
+# Random sample of up to k domains of one shard (all of them for k=None) and the size of the whole list
+def sample_shard(file_path, k, shard, rng=random):
+    index, count = shard
+    if is_domain_set(file_path):
+        with DomainSet(file_path) as domain_set:
+            size = len(domain_set)
+            batches = ([domain_set.entry(position) for position in range(start, min(start + SET_BATCH, size))]
+                       for start in range(0, size, SET_BATCH))
+            sample, total = shard_sample_batches(batches, k, index, count, rng)
+    else:
+        sample, total = shard_sample_batches(iter_line_batches(file_path), k, index, count, rng)
+    return [decode_domain(line) for line in sample], total
+
+
+def shard_sample_batches(batches, k, index, count, rng):
+    total = 0
+
+    def in_shard():
+        nonlocal total
+        for lines in batches:
+            total += len(lines)
+            yield [line for line in lines if shard_of(line, count) == index]
+
+    if k is None:
+        return list(itertools.chain.from_iterable(in_shard())), total
+    sample, _ = reservoir_from_batches(in_shard(), k, rng)
+    return sample, total
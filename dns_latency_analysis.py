@@ -1,28 +1,207 @@
+import concurrent.futures
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import os
+import re
+from dns_latency_writer import COLUMNS, local_timezone, to_timestamp_ns, segments_in_range, load_pyarrow, \
+    segment_columns, timestamp_filters
+
+FIGSIZE = (19.2, 10.8)  # Full HD at 100 DPI
+DPI = 100
+MAX_PLOT_POINTS = int(FIGSIZE[0] * DPI)  # one point per horizontal pixel, a min and a max per two pixels
+PLOT_WORKERS = None  # processes rendering plots, None for one per CPU
+CHUNK_ROWS = 1_000_000  # rows per chunk when results are streamed instead of loaded at once
+LATENCY_COLUMNS = ['ping_latency', 'google_query_latency', 'domain_query_latency']
+PLOT_COLUMNS = ['server'] + LATENCY_COLUMNS + ['domain']  # what detailed_analysis reads, besides the timestamp
+
+
+def with_timestamp_columns(columns):
+    columns = list(columns) if columns is not None else COLUMNS
+    return columns if 'timestamp' in columns else ['timestamp'] + columns
+
+
+def parse_csv_timestamps(df, start=None, end=None):
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format='%Y-%m-%d %H:%M:%S')
+    if start is not None:
+        df = df[df['timestamp'] >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df['timestamp'] < pd.Timestamp(end)]
+    return df
+
+
+# DataFrame from a table of the columnar backend, with plain string servers/domains and local-time timestamps
+def table_to_frame(table):
+    df = table.to_pandas()
+    for column in ('server', 'domain'):
+        if column in df:
+            df[column] = df[column].astype(str)
+    df['timestamp'] = (pd.to_datetime(df['timestamp'], unit='ns', utc=True)
+                       .dt.tz_convert(local_timezone()).dt.tz_localize(None))
+    return df
+
+
+# Requested columns a results file or segment has; older ones lack the setup time columns
+def available_columns(columns):
+    return lambda column: column in columns
+
+
+# Load latency results with a local-time 'timestamp' column, from a CSV file or a columnar results directory.
+# Only the requested columns are read, and from a results directory only the segments in the time window.
+def load_results(file_path, columns=None, start=None, end=None):
+    columns = with_timestamp_columns(columns)
+
+    if not os.path.isdir(file_path):
+        return parse_csv_timestamps(pd.read_csv(file_path, usecols=available_columns(columns)), start, end)
+
+    pa, _, pq = load_pyarrow()
+    start_ns, end_ns = to_timestamp_ns(start), to_timestamp_ns(end)
+    tables = [pq.read_table(segment, columns=segment_columns(segment, columns),
+                            filters=timestamp_filters(start_ns, end_ns))
+              for segment in segments_in_range(file_path, start_ns, end_ns)]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    return table_to_frame(pa.concat_tables(tables, promote_options='permissive'))
+
+
+# Latencies of a CSV chunk read with only disabled probes ('None', or empty in load test rows) as missing:
+# columns without failures parse as numbers right away, and in the others failed measurements ('nan')
+# become inf, so the two can be told apart
+def mark_failed_csv(df):
+    for column in LATENCY_COLUMNS:
+        if column in df and not pd.api.types.is_float_dtype(df[column]):
+            text = df[column]
+            try:
+                values = text.astype(float)
+            except (TypeError, ValueError):  # anything else unreadable counts as failed too
+                values = pd.to_numeric(text, errors='coerce').fillna(np.inf).mask(text.isna())
+            df[column] = values.mask(text.eq('nan'), np.inf)
+    return df
+
+
+# The same for a table of the columnar backend, where disabled probes are null and failures NaN
+def mark_failed_table(table):
+    _, pc, _ = load_pyarrow()
+    for column in LATENCY_COLUMNS:
+        if column in table.column_names:
+            values = table[column]
+            table = table.set_column(table.column_names.index(column), column,
+                                     pc.if_else(pc.is_nan(values), np.inf, values))
+    return table
+
+
+# Same as load_results, but yielding DataFrames of at most chunk_rows rows so memory stays bounded.
+# With mark_failed, failed measurements come back as inf and only disabled probes as NaN.
+def iter_results(file_path, columns=None, start=None, end=None, chunk_rows=CHUNK_ROWS, mark_failed=False):
+    columns = with_timestamp_columns(columns)
+
+    if not os.path.isdir(file_path):
+        disabled = {column: ['None', ''] for column in LATENCY_COLUMNS} if mark_failed else None
+        for chunk in pd.read_csv(file_path, usecols=available_columns(columns), chunksize=chunk_rows,
+                                 na_values=disabled, keep_default_na=not mark_failed):
+            chunk = parse_csv_timestamps(chunk, start, end)
+            yield mark_failed_csv(chunk) if mark_failed else chunk
+        return
+
+    pa, pc, pq = load_pyarrow()
+    start_ns, end_ns = to_timestamp_ns(start), to_timestamp_ns(end)
+    for segment in segments_in_range(file_path, start_ns, end_ns):
+        for batch in pq.ParquetFile(segment).iter_batches(batch_size=chunk_rows,
+                                                          columns=segment_columns(segment, columns)):
+            table = pa.Table.from_batches([batch])
+            if start_ns is not None:
+                table = table.filter(pc.greater_equal(table['timestamp'], start_ns))
+            if end_ns is not None:
+                table = table.filter(pc.less(table['timestamp'], end_ns))
+            yield table_to_frame(mark_failed_table(table) if mark_failed else table)
+
+
+# Position of the smallest value in each bucket of consecutive points (the first one on ties)
+def bucket_minimum_positions(values, bucket, edges):
+    minimums = np.minimum.reduceat(values, edges[:-1])
+    candidates = np.flatnonzero(values == minimums[bucket])
+    _, first = np.unique(bucket[candidates], return_index=True)
+    return candidates[first]
+
+
+# Shrink a time series to at most max_points, keeping the minimum and maximum of each bucket of
+# consecutive points so spikes and dips survive. Buckets with only failures keep a NaN, so gaps stay visible.
+def downsample_minmax(timestamps, values, max_points=MAX_PLOT_POINTS):
+    values = np.asarray(values, dtype=float)
+    if len(values) <= max_points:
+        return np.asarray(timestamps), values
+    buckets = max(1, max_points // 2)
+    edges = np.linspace(0, len(values), buckets + 1).astype(int)
+    bucket = np.repeat(np.arange(buckets), np.diff(edges))
+    missing = np.isnan(values)
+    lowest = bucket_minimum_positions(np.where(missing, np.inf, values), bucket, edges)
+    highest = bucket_minimum_positions(np.where(missing, np.inf, -values), bucket, edges)
+    keep = np.union1d(lowest, highest)
+    return np.asarray(timestamps)[keep], values[keep]
+
+
+# A server entry as part of a file name; URLs such as udp://host:port or https://host/dns-query hold slashes
+def file_name_part(server):
+    return re.sub(r'[^A-Za-z0-9.-]+', '_', server)
+
+
+# Description of one line chart, small enough to hand to another process: (label, timestamps, values) lines
+def line_plot(title, lines, ylim, filename, message, legend_loc=None):
+    return {'kind': 'line', 'title': title, 'lines': lines, 'ylim': ylim, 'filename': filename,
+            'message': message, 'legend_loc': legend_loc}
+
+
+# Description of one bar chart comparing servers
+def bar_plot(title, frame, filename, message):
+    return {'kind': 'bar', 'title': title, 'frame': frame, 'filename': filename, 'message': message}
+
+
+# Draw one plot; saved plots are rendered off-screen, so this also runs in worker processes.
+# matplotlib is only imported here, so loading results (or finding there are none) doesn't wait for it.
+def render_plot(plot, save_plots=True):
+    import matplotlib.pyplot as plt
+    if save_plots:
+        plt.switch_backend('Agg')
+
+    if plot['kind'] == 'line':
+        plt.figure(figsize=FIGSIZE)
+        for label, timestamps, values in plot['lines']:
+            plt.plot(timestamps, values, label=label)
+        plt.xlabel('Timestamp')
+        if plot['ylim'] > 0:  # NaN when the metric wasn't measured at all, e.g. with pings disabled
+            plt.ylim(0, plot['ylim'])
+        plt.legend(loc=plot['legend_loc']) if plot['legend_loc'] else plt.legend()
+    else:
+        plot['frame'].plot(kind='bar', figsize=FIGSIZE)
+
+    plt.title(plot['title'])
+    plt.ylabel('Latency (s)')
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+
+    if save_plots:
+        plt.savefig(plot['filename'], dpi=DPI)
+        plt.close()  # Close the figure after saving to free memory
+        return plot['message']
+    plt.show()
+    return None
+
 
 # Detailed analysis function with plots and detailed statistics
-def detailed_analysis(file_path='dns_latency_results.csv', save_plots=True, output_dir='plots'):
+def detailed_analysis(file_path='dns_latency_results.csv', save_plots=True, output_dir='plots', start=None, end=None,
+                      workers=PLOT_WORKERS):
     if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
         print("No data available for analysis.")
         return
 
-    df = pd.read_csv(file_path)
+    df = load_results(file_path, PLOT_COLUMNS, start, end)
 
     if df.empty:
         print("No data available for analysis.")
         return
 
-    # Convert timestamp to datetime and sort by it
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    # Sort by timestamp
     df = df.sort_values(by='timestamp')
 
-    # Ensure that 'ping_latency_nan_count', 'google_query_latency_nan_count', 'domain_query_latency_nan_count' are correctly created
-    df['ping_latency_nan_count'] = df['ping_latency'].isna().astype(int)
-    df['google_query_latency_nan_count'] = df['google_query_latency'].isna().astype(int)
-    df['domain_query_latency_nan_count'] = df['domain_query_latency'].isna().astype(int)
-
     # Calculate the global maximum latency across all servers and latency types
     global_max_latency = df[['ping_latency', 'google_query_latency', 'domain_query_latency']].max().max()
 
@@ -30,92 +209,44 @@ def detailed_analysis(file_path='dns_latency_results.csv', save_plots=True, outp
     if save_plots and not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    # Split by server once, and downsample every series to what the plot can show
+    server_frames = dict(tuple(df.groupby('server', sort=False)))
+    series = {
+        (server, metric): downsample_minmax(server_df['timestamp'].to_numpy(), server_df[metric].to_numpy())
+        for server, server_df in server_frames.items()
+        for metric in ('ping_latency', 'google_query_latency', 'domain_query_latency')
+    }
+    plots = []
+
     ### Individual Server Plots
     # Plot latency over time for each server (ping, google.com, and random domain)
-    for server in df['server'].unique():
-        server_df = df[df['server'] == server]
-
-        plt.figure(figsize=(19.2, 10.8))  # Set figsize for Full HD resolution
-        plt.plot(server_df['timestamp'], server_df['ping_latency'], label='Ping Latency')
-        plt.plot(server_df['timestamp'], server_df['google_query_latency'], label='Google.com Latency')
-        plt.plot(server_df['timestamp'], server_df['domain_query_latency'], label=f'Random Domain Latency ({server_df["domain"].iloc[0]})')
-
-        plt.title(f'Latency over time for {server}')
-        plt.xlabel('Timestamp')
-        plt.ylabel('Latency (s)')
-        plt.ylim(0, global_max_latency)  # Set consistent y-axis limits for all plots
-        plt.xticks(rotation=45)
-        plt.legend()
-        plt.tight_layout()
-
-        if save_plots:
-            plot_filename = f"{output_dir}/latency_{server.replace(':', '_')}.png"
-            plt.savefig(plot_filename, dpi=100)  # Save with DPI set to 100 for Full HD resolution
-            print(f"Saved plot for {server} as {plot_filename}")
-            plt.close()  # Close the figure after saving to free memory
-        else:
-            plt.show()
+    for server, server_df in server_frames.items():
+        plots.append(line_plot(
+            f'Latency over time for {server}',
+            [('Ping Latency', *series[server, 'ping_latency']),
+             ('Google.com Latency', *series[server, 'google_query_latency']),
+             (f'Random Domain Latency ({server_df["domain"].iloc[0]})', *series[server, 'domain_query_latency'])],
+            global_max_latency,  # Set consistent y-axis limits for all plots
+            f"{output_dir}/latency_{file_name_part(server)}.png",
+            f"Saved plot for {server} as {output_dir}/latency_{file_name_part(server)}.png"))
 
     ### Grouped Line Graphs by Latency Type
-    # Ping Latency - Grouped by servers
-    plt.figure(figsize=(19.2, 10.8))
-    for server in df['server'].unique():
-        server_df = df[df['server'] == server]
-        plt.plot(server_df['timestamp'], server_df['ping_latency'], label=server)
-    plt.title('Ping Latency over Time (Grouped by Servers)')
-    plt.xlabel('Timestamp')
-    plt.ylabel('Latency (s)')
-    plt.ylim(0, df['ping_latency'].max())  # Dynamic y-axis limit based on actual data
-    plt.xticks(rotation=45)
-    plt.legend(loc='upper right')
-    plt.tight_layout()
-    if save_plots:
-        plot_filename = f"{output_dir}/ping_latency_grouped.png"
-        plt.savefig(plot_filename, dpi=100)
-        print(f"Saved grouped ping latency plot as {plot_filename}")
-        plt.close()
-    else:
-        plt.show()
-
-    # Google Query Latency - Grouped by servers
-    plt.figure(figsize=(19.2, 10.8))
-    for server in df['server'].unique():
-        server_df = df[df['server'] == server]
-        plt.plot(server_df['timestamp'], server_df['google_query_latency'], label=server)
-    plt.title('Google Query Latency over Time (Grouped by Servers)')
-    plt.xlabel('Timestamp')
-    plt.ylabel('Latency (s)')
-    plt.ylim(0, df['google_query_latency'].max())  # Dynamic y-axis limit based on actual data
-    plt.xticks(rotation=45)
-    plt.legend(loc='upper right')
-    plt.tight_layout()
-    if save_plots:
-        plot_filename = f"{output_dir}/google_latency_grouped.png"
-        plt.savefig(plot_filename, dpi=100)
-        print(f"Saved grouped Google query latency plot as {plot_filename}")
-        plt.close()
-    else:
-        plt.show()
-
-    # New Domain Query Latency - Grouped by servers
-    plt.figure(figsize=(19.2, 10.8))
-    for server in df['server'].unique():
-        server_df = df[df['server'] == server]
-        plt.plot(server_df['timestamp'], server_df['domain_query_latency'], label=server)
-    plt.title('New Domain Query Latency over Time (Grouped by Servers)')
-    plt.xlabel('Timestamp')
-    plt.ylabel('Latency (s)')
-    plt.ylim(0, df['domain_query_latency'].max())  # Dynamic y-axis limit based on actual data
-    plt.xticks(rotation=45)
-    plt.legend(loc='upper right')
-    plt.tight_layout()
-    if save_plots:
-        plot_filename = f"{output_dir}/domain_latency_grouped.png"
-        plt.savefig(plot_filename, dpi=100)
-        print(f"Saved grouped new domain query latency plot as {plot_filename}")
-        plt.close()
-    else:
-        plt.show()
+    grouped = [
+        ('ping_latency', 'Ping Latency over Time (Grouped by Servers)', 'ping_latency_grouped.png',
+         'grouped ping latency plot'),
+        ('google_query_latency', 'Google Query Latency over Time (Grouped by Servers)', 'google_latency_grouped.png',
+         'grouped Google query latency plot'),
+        ('domain_query_latency', 'New Domain Query Latency over Time (Grouped by Servers)',
+         'domain_latency_grouped.png', 'grouped new domain query latency plot'),
+    ]
+    for metric, title, filename, description in grouped:
+        plots.append(line_plot(
+            title,
+            [(server, *series[server, metric]) for server in server_frames],
+            df[metric].max(),  # Dynamic y-axis limit based on actual data
+            f"{output_dir}/{filename}",
+            f"Saved {description} as {output_dir}/{filename}",
+            legend_loc='upper right'))
 
     ### Summary Bar Graphs for Comparison
     # Compute summary statistics for each server
@@ -136,61 +267,35 @@ def detailed_analysis(file_path='dns_latency_results.csv', save_plots=True, outp
     summary['aggregate_median'] = summary[['ping_latency_median', 'google_query_latency_median', 'domain_query_latency_median']].mean(axis=1)
     summary['aggregate_std'] = summary[['ping_latency_std', 'google_query_latency_std', 'domain_query_latency_std']].mean(axis=1)
 
-    # Ping Latency Comparison
-    summary[['ping_latency_mean', 'ping_latency_median', 'ping_latency_std']].plot(kind='bar', figsize=(19.2, 10.8))
-    plt.title('Ping Latency Comparison by Server (Mean, Median, Std)')
-    plt.ylabel('Latency (s)')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    if save_plots:
-        plot_filename = f"{output_dir}/ping_latency_comparison.png"
-        plt.savefig(plot_filename, dpi=100)
-        print(f"Saved ping latency comparison plot as {plot_filename}")
-        plt.close()
-    else:
-        plt.show()
+    comparisons = [
+        ('ping_latency', 'Ping Latency Comparison by Server (Mean, Median, Std)', 'ping_latency_comparison.png',
+         'ping latency comparison plot'),
+        ('google_query_latency', 'Google Query Latency Comparison by Server (Mean, Median, Std)',
+         'google_query_latency_comparison.png', 'Google query latency comparison plot'),
+        ('domain_query_latency', 'New Domain Query Latency Comparison by Server (Mean, Median, Std)',
+         'domain_query_latency_comparison.png', 'new domain query latency comparison plot'),
+        ('aggregate', 'Aggregate Latency Comparison by Server (Mean, Median, Std)',
+         'aggregate_latency_comparison.png', 'aggregate latency comparison plot'),
+    ]
+    for prefix, title, filename, description in comparisons:
+        plots.append(bar_plot(
+            title,
+            summary[[f'{prefix}_mean', f'{prefix}_median', f'{prefix}_std']],
+            f"{output_dir}/{filename}",
+            f"Saved {description} as {output_dir}/{filename}"))
 
-    # Google Query Latency Comparison
-    summary[['google_query_latency_mean', 'google_query_latency_median', 'google_query_latency_std']].plot(kind='bar', figsize=(19.2, 10.8))
-    plt.title('Google Query Latency Comparison by Server (Mean, Median, Std)')
-    plt.ylabel('Latency (s)')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    if save_plots:
-        plot_filename = f"{output_dir}/google_query_latency_comparison.png"
-        plt.savefig(plot_filename, dpi=100)
-        print(f"Saved Google query latency comparison plot as {plot_filename}")
-        plt.close()
-    else:
-        plt.show()
+    if not save_plots:
+        # Interactive windows have to be shown from this process, one after another
+        for plot in plots:
+            render_plot(plot, save_plots=False)
+        return
 
-    # New Domain Query Latency Comparison
-    summary[['domain_query_latency_mean', 'domain_query_latency_median', 'domain_query_latency_std']].plot(kind='bar', figsize=(19.2, 10.8))
-    plt.title('New Domain Query Latency Comparison by Server (Mean, Median, Std)')
-    plt.ylabel('Latency (s)')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    if save_plots:
-        plot_filename = f"{output_dir}/domain_query_latency_comparison.png"
-        plt.savefig(plot_filename, dpi=100)
-        print(f"Saved new domain query latency comparison plot as {plot_filename}")
-        plt.close()
-    else:
-        plt.show()
+    # The plots are independent, so render them in parallel
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for message in pool.map(render_plot, plots):
+            print(message)
 
-    # Aggregate Latency Comparison
-    summary[['aggregate_mean', 'aggregate_median', 'aggregate_std']].plot(kind='bar', figsize=(19.2, 10.8))
-    plt.title('Aggregate Latency Comparison by Server (Mean, Median, Std)')
-    plt.ylabel('Latency (s)')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    if save_plots:
-        plot_filename = f"{output_dir}/aggregate_latency_comparison.png"
-        plt.savefig(plot_filename, dpi=100)
-        print(f"Saved aggregate latency comparison plot as {plot_filename}")
-        plt.close()
-    else:
-        plt.show()
 
 if __name__ == "__main__":
-    detailed_analysis()
+    from dnstk import script_main
+    script_main('analyze')
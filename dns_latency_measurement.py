@@ -1,129 +1,252 @@
+import asyncio
+import concurrent.futures
+import math
 import time
 import random
-from ping3 import ping
-import dns.resolver
-import pandas as pd
-import numpy as np
-import os
-
-# Configuration variables
-INTERVAL = 60  # in seconds
-DURATION = None  # None for continuous measurement
-OUTPUT_FILE = 'dns_latency_results.csv'
+import dns.rcode
+from dns_domain_sampling import sample_domains, random_subdomain
+from dns_query_engine import QueryEngine, shared_blocking_engine, has_answer, server_host
+from dns_latency_stats import load_aggregates, print_summary, snapshot_path_for, load_cache_probe_stats, \
+    print_cache_summary
+from dns_latency_writer import open_results_writer, format_timestamp, CacheProbeWriter
+from dns_metrics import profiled
+
+# Configuration variables; the interval, output and other run settings are options of 'dnstk measure'
 PING_LATENCY = True
 DNS_QUERY_LATENCY = True
-ANALYSIS_INTERVAL = 600  # Print analysis every 10 minutes
 GOOGLE_DOMAIN = 'google.com'  # Always query google.com
-
-
-# Load DNS servers from file
+ROUND_TIMEOUT = 10  # seconds a measurement round may take; probes still running then are recorded as failed
+MAX_DOMAINS = 10000  # random domains kept in memory to pick from, however long the domain list is
+# Cache probes: every round each server is asked for a fresh random name under CACHE_PROBE_ZONE per record type,
+# which it has to recurse for (cold), and right after for the same name again, which it should answer from its
+# cache (warm). A zone with a wildcard record you control gives real answers; under any other zone the names
+# don't exist, but finding that out still takes the resolver a trip to the zone's authoritative servers.
+# The probes only run with a cache probe file and a zone, since they send queries into that zone every round.
+CACHE_PROBE_ZONE = None
+CACHE_PROBE_TYPES = ('A', 'AAAA', 'HTTPS')
+# A cold probe that ends in NXDOMAIN or NODATA still got its answer by recursing, so these count as answered
+CACHE_PROBE_RCODES = {dns.rcode.NOERROR, dns.rcode.NXDOMAIN}
+
+
+# Load DNS servers from file: plain addresses for UDP, or tcp://, tls:// and https:// entries
 def load_dns_servers(file_path='dns_servers.txt'):
     with open(file_path, 'r') as file:
         dns_servers = [line.strip() for line in file if line.strip()]
     return dns_servers
 
 
-# Load domains from file
-def load_domains(file_path='new_domains.txt'):
-    with open(file_path, 'r') as file:
-        domains = [line.strip() for line in file if line.strip()]
+# Load domains from a text list or a domain set, keeping a random sample of at most max_domains of them
+def load_domains(file_path='new_domains.txt', max_domains=MAX_DOMAINS, use_index=False):
+    domains, _ = sample_domains(file_path, max_domains, use_index=use_index)
     return domains
 
 
-# Measure ping latency
-def measure_ping_latency(server):
+# Measure ping latency to the host of a DNS server entry; ping3 is only loaded when pings are measured
+def measure_ping_latency(server, timeout=4):
+    from ping3 import ping
     try:
-        latency = ping(server)
-        return latency if latency is not None else np.nan
+        latency = ping(server_host(server), timeout=timeout)
+        return latency if latency is not None else math.nan
     except Exception:
-        return np.nan  # Suppress error messages
+        return math.nan  # Suppress error messages
 
 
 # Measure DNS query latency
 def measure_dns_query_latency(server, domain):
-    resolver = dns.resolver.Resolver()
-    resolver.nameservers = [server]
     try:
-        start_time = time.time()
-        resolver.resolve(domain)
-        latency = time.time() - start_time
-        return latency
+        # The engine times the query itself, from send to answer, so the thread hop isn't counted
+        result = shared_blocking_engine().query(server, domain, 'A')
+        return result.latency if has_answer(result.response, 'A') else math.nan
     except Exception:
-        return np.nan  # Suppress error messages
+        return math.nan  # Suppress error messages
 
 
-# Basic analysis function for the measurement tool
-def basic_analysis(file_path='dns_latency_results.csv'):
-    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-        print("No data available for analysis.")
-        return
+# Measure DNS query latency on an async engine; the engine times with perf_counter_ns from send to answer.
+# Returns (query latency, connection setup time), the latter 0 when a pooled connection was reused.
+async def measure_dns_query_latency_async(engine, server, domain):
+    try:
+        result = await engine.query(server, domain, 'A')
+        return (result.latency, result.setup) if has_answer(result.response, 'A') else (math.nan, result.setup)
+    except Exception:
+        return math.nan, math.nan  # Suppress error messages
 
-    df = pd.read_csv(file_path)
 
-    if df.empty:
+# One cache probe query. Returns (latency, connection setup time, response code name), with NaN times
+# and no response code if it failed.
+async def measure_cache_query(engine, server, domain, rdtype):
+    try:
+        result = await engine.query(server, domain, rdtype)
+    except Exception:
+        return math.nan, math.nan, None
+    rcode = result.response.rcode()
+    return (result.latency if rcode in CACHE_PROBE_RCODES else math.nan), result.setup, dns.rcode.to_text(rcode)
+
+
+# Ask for a name the server can't have cached, then for the same name again right away
+async def measure_cache_pair(engine, server, domain, rdtype):
+    cold = await measure_cache_query(engine, server, domain, rdtype)
+    warm = await measure_cache_query(engine, server, domain, rdtype)
+    return cold, warm
+
+
+# Cold and warm probes of every record type on all servers at once, each with its own name so no server or
+# record type warms the cache for another. Returns (server, rdtype, domain, cold, warm) per pair; pairs not
+# done by the deadline count as failed.
+async def measure_cache_round(engine, dns_servers, round_timeout):
+    pairs = [(server, rdtype, random_subdomain(CACHE_PROBE_ZONE)) for server in dns_servers
+             for rdtype in CACHE_PROBE_TYPES]
+    probes = [asyncio.ensure_future(measure_cache_pair(engine, server, domain, rdtype))
+              for server, rdtype, domain in pairs]
+    if probes:
+        await asyncio.wait(probes, timeout=round_timeout)
+    results = []
+    failed = (math.nan, math.nan, None)
+    for (server, rdtype, domain), probe in zip(pairs, probes):
+        if probe.done() and not probe.cancelled():
+            results.append((server, rdtype, domain, *probe.result()))
+        else:
+            probe.cancel()
+            results.append((server, rdtype, domain, failed, failed))
+    return results
+
+
+# Basic analysis function for the measurement tool, from the running aggregates instead of the whole CSV
+def basic_analysis(file_path='dns_latency_results.csv', aggregates=None):
+    if aggregates is None:
+        aggregates = load_aggregates(file_path)
+        if aggregates.rows:
+            aggregates.save(snapshot_path_for(file_path))
+
+    if not aggregates.rows:
         print("No data available for analysis.")
         return
 
-    # Calculate mean latencies and NaN counts
-    summary = df.groupby('server').agg({
-        'ping_latency': ['mean', lambda x: x.isna().sum()],
-        'google_query_latency': ['mean', lambda x: x.isna().sum()],
-        'domain_query_latency': ['mean', lambda x: x.isna().sum()],
-    })
-
-    summary.columns = ['ping_latency_mean', 'ping_latency_nan_count',
-                       'google_query_latency_mean', 'google_query_latency_nan_count',
-                       'domain_query_latency_mean', 'domain_query_latency_nan_count']
-
-    # Print the basic statistics
-    print("\nBasic Statistics (Average Latency in Seconds):")
-    print(summary[['ping_latency_mean', 'google_query_latency_mean', 'domain_query_latency_mean']])
-    print("\nNumber of Failed Pings/Queries:")
-    print(summary[['ping_latency_nan_count', 'google_query_latency_nan_count', 'domain_query_latency_nan_count']])
-
-
-# Run the measurement process
-def run_measurements(dns_servers, domains, interval, duration, output_file='results.csv', analysis_interval=3600):
-    start_time = time.time()
+    print_summary(aggregates)
+
+
+# Probe all servers with all probe types at once; probes not done by the deadline count as failed.
+# Returns (ping, google, domain, google setup, domain setup) times per server, in server order.
+async def measure_round(engine, ping_pool, dns_servers, selected_domain, round_timeout):
+    loop = asyncio.get_running_loop()
+    probes = []
+    for server in dns_servers:
+        probes.append(loop.run_in_executor(ping_pool, measure_ping_latency, server, round_timeout)
+                      if PING_LATENCY else None)
+        probes.append(asyncio.ensure_future(measure_dns_query_latency_async(engine, server, GOOGLE_DOMAIN))
+                      if DNS_QUERY_LATENCY else None)
+        probes.append(asyncio.ensure_future(measure_dns_query_latency_async(engine, server, selected_domain))
+                      if DNS_QUERY_LATENCY else None)
+
+    running = [probe for probe in probes if probe is not None]
+    if running:
+        await asyncio.wait(running, timeout=round_timeout)
+
+    results = []
+    for probe in probes:
+        if probe is None:
+            results.append(None)
+        elif probe.done() and not probe.cancelled():
+            results.append(probe.result())
+        else:
+            probe.cancel()
+            results.append(math.nan)
+
+    rounds = []
+    for ping_latency, google, domain in zip(results[0::3], results[1::3], results[2::3]):
+        google_latency, google_setup = google if isinstance(google, tuple) else (google, google)
+        domain_latency, domain_setup = domain if isinstance(domain, tuple) else (domain, domain)
+        rounds.append((ping_latency, google_latency, domain_latency, google_setup, domain_setup))
+    return rounds
+
+
+# Run the measurement process in rounds started on a fixed cadence, so a slow round doesn't shift the next ones
+async def run_measurements_async(dns_servers, domains, interval, duration, output_file, analysis_interval,
+                                 round_timeout, output_format, metrics=None, cache_probe_file=None):
+    # Keep the DNS retries within the round so every probe is decided by the deadline
+    if cache_probe_file is not None and CACHE_PROBE_ZONE is None:
+        raise ValueError("Cache probes need a zone to make up names under (CACHE_PROBE_ZONE)")
+    engine = QueryEngine(lifetime=min(round_timeout, 5.0), metrics=metrics)
+    ping_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(dns_servers)))
+    writer = open_results_writer(output_file, output_format)
+    # Per-server aggregates, picked up from the last snapshot and the rows written after it
+    aggregates = load_aggregates(output_file)
+    cache_writer = CacheProbeWriter(cache_probe_file) if cache_probe_file is not None else None
+    cache_stats = load_cache_probe_stats(cache_probe_file) if cache_probe_file is not None else None
+    start_time = time.monotonic()
     next_analysis_time = start_time + analysis_interval
+    round_number = 0
 
-    with open(output_file, 'a') as file:
-        if os.path.getsize(output_file) == 0:  # Add headers if the file is new
-            file.write('timestamp,server,ping_latency,google_query_latency,domain_query_latency,domain\n')
-
-        while duration is None or time.time() < start_time + duration:
+    try:
+        while duration is None or time.monotonic() < start_time + duration:
             # Pick one random domain for all servers during this interval
             selected_domain = random.choice(domains)
 
-            print(f"Measurement started: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}", end='')
+            # All rows of a round share its start time, since all its probes start together
+            timestamp_ns = time.time_ns()
+            print(f"Measurement started: {format_timestamp(timestamp_ns)}", end='')
 
-            for server in dns_servers:
-                ping_latency = measure_ping_latency(server) if PING_LATENCY else None
-
-                # Measure google.com
-                google_latency = measure_dns_query_latency(server, GOOGLE_DOMAIN) if DNS_QUERY_LATENCY else None
-
-                # Measure the selected random domain
-                domain_latency = measure_dns_query_latency(server, selected_domain) if DNS_QUERY_LATENCY else None
-
-                # Log all measurements in a single CSV line per server
-                timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                file.write(f'{timestamp},{server},{ping_latency},{google_latency},{domain_latency},{selected_domain}\n')
+            cache_round = (asyncio.ensure_future(measure_cache_round(engine, dns_servers, round_timeout))
+                           if cache_writer is not None else None)
+            latencies = await measure_round(engine, ping_pool, dns_servers, selected_domain, round_timeout)
+            rows = []
+            for server, (ping_latency, google_latency, domain_latency, google_setup, domain_setup) in \
+                    zip(dns_servers, latencies):
+                rows.append((timestamp_ns, server, ping_latency, google_latency, domain_latency, selected_domain,
+                             google_setup, domain_setup))
+                aggregates.add_row(server, [ping_latency, google_latency, domain_latency], timestamp_ns)
 
                 # Print a dot for each server
                 print('.', end='')
 
             print()  # Print a newline after all servers are processed
-
-            if time.time() >= next_analysis_time:
+            writer.write(rows)
+            if cache_round is not None:
+                cache_rows = []
+                for server, rdtype, domain, cold, warm in await cache_round:
+                    for probe, (latency, setup, rcode) in (('cold', cold), ('warm', warm)):
+                        cache_rows.append((timestamp_ns, server, probe, rdtype, domain, latency, setup, rcode))
+                        cache_stats.add(server, rdtype, probe, latency)
+                cache_writer.write(cache_rows)
+                cache_stats.csv_offset = cache_writer.offset()
+            if writer.offset() is not None:
+                aggregates.csv_offset = writer.offset()
+
+            if time.monotonic() >= next_analysis_time:
                 print('Running periodic analysis...')
-                basic_analysis(output_file)
+                basic_analysis(output_file, aggregates)
+                if cache_stats is not None:
+                    print_cache_summary(cache_stats)
+                    cache_stats.save(snapshot_path_for(cache_probe_file))
+                writer.flush()
+                aggregates.save(snapshot_path_for(output_file))
                 next_analysis_time += analysis_interval
 
-            time.sleep(interval + random.uniform(-0.1, 0.1) * interval)
+            # Next slot on the cadence (skipping any that were overrun), with the jitter around the slot
+            round_number = max(round_number + 1, int((time.monotonic() - start_time) / interval) + 1)
+            next_round = start_time + round_number * interval + random.uniform(-0.1, 0.1) * interval
+            await asyncio.sleep(max(0.0, next_round - time.monotonic()))
+    finally:
+        writer.close()
+        if cache_writer is not None:
+            cache_writer.close()
+            cache_stats.save(snapshot_path_for(cache_probe_file))
+        aggregates.save(snapshot_path_for(output_file))
+        ping_pool.shutdown(wait=False, cancel_futures=True)
+        await engine.close()
+
+
+# Run the measurement process; with metrics (a dns_metrics.QueryMetrics) every query is also recorded there,
+# with profile_file the loop is profiled by stack sampling, and with cache_probe_file every round also runs
+# cold and warm cache probes
+def run_measurements(dns_servers, domains, interval, duration, output_file='results.csv', analysis_interval=3600,
+                     round_timeout=ROUND_TIMEOUT, output_format='csv', metrics=None, profile_file=None,
+                     cache_probe_file=None):
+    with profiled(profile_file):
+        asyncio.run(run_measurements_async(dns_servers, domains, interval, duration, output_file,
+                                           analysis_interval, round_timeout, output_format, metrics,
+                                           cache_probe_file))
 
 
 if __name__ == "__main__":
-    dns_servers = load_dns_servers()
-    domains = load_domains()
-    run_measurements(dns_servers, domains, INTERVAL, DURATION, OUTPUT_FILE, ANALYSIS_INTERVAL)
+    from dnstk import script_main
+    script_main('measure')
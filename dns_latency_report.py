@@ -0,0 +1,139 @@
+import os
+import numpy as np
+import pandas as pd
+from dns_latency_analysis import iter_results, downsample_minmax, FIGSIZE, DPI, CHUNK_ROWS
+from dns_latency_stats import METRICS, LOWEST_LATENCY, BUCKET_GROWTH, LOG_GROWTH
+
+QUANTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
+KEYS = ['server', 'window', 'metric']
+# Per-window partial sums; these add up across chunks, so a window may span any number of chunks
+SUM_COLUMNS = {'samples': 'sum', 'failures': 'sum', 'total': 'sum', 'total_sq': 'sum',
+               'minimum': 'min', 'maximum': 'max'}
+
+
+# Histogram bucket of every latency, the same log-spaced buckets as the running aggregates use
+def bucket_indexes(latencies):
+    scaled = np.maximum(latencies, LOWEST_LATENCY) / LOWEST_LATENCY
+    return np.where(latencies <= LOWEST_LATENCY, 0, np.floor(np.log(scaled) / LOG_GROWTH) + 1).astype(np.int32)
+
+
+def bucket_values(buckets):
+    return np.where(buckets == 0, LOWEST_LATENCY, LOWEST_LATENCY * BUCKET_GROWTH ** (buckets - 0.5))
+
+
+# Partial window sums and latency histograms of one chunk of results, in long (server, window, metric) form.
+# Failed measurements are inf (see iter_results); NaN means the probe was disabled, and isn't a sample at all.
+def summarize_chunk(chunk, window, metrics):
+    chunk = chunk.assign(window=chunk['timestamp'].dt.floor(window))
+    long = chunk.melt(id_vars=['server', 'window'], value_vars=metrics, var_name='metric', value_name='latency')
+    latency = long['latency'].to_numpy(dtype=float)
+    measured = ~np.isnan(latency)
+    long, latency = long[measured], latency[measured]
+    failed = np.isinf(latency)
+    latency = np.where(failed, np.nan, latency)
+    long = long.assign(latency=latency, failures=failed, total=np.where(failed, 0.0, latency),
+                       total_sq=np.where(failed, 0.0, latency * latency))
+
+    sums = long.groupby(KEYS, observed=True).agg(
+        samples=('failures', 'size'), failures=('failures', 'sum'), total=('total', 'sum'),
+        total_sq=('total_sq', 'sum'), minimum=('latency', 'min'), maximum=('latency', 'max'))
+
+    answered = long[~failed]
+    histogram = answered.assign(bucket=bucket_indexes(answered['latency'].to_numpy(dtype=float))) \
+        .groupby(KEYS + ['bucket'], observed=True).size().rename('count')
+    return sums, histogram
+
+
+# Quantiles per (server, window, metric) from the merged histograms, without looping over groups
+def histogram_quantiles(histogram, sums):
+    histogram = histogram.sort_index().reset_index()
+    histogram['seen'] = histogram.groupby(KEYS, observed=True)['count'].cumsum()
+    answered = (sums['samples'] - sums['failures']).rename('answered')
+    histogram = histogram.join(answered, on=KEYS)
+
+    quantiles = {}
+    for name, q in QUANTILES.items():
+        # The quantile is in the first bucket whose running count passes its rank
+        reached = histogram[histogram['seen'] > q * (histogram['answered'] - 1)]
+        first = reached.groupby(KEYS, observed=True)['bucket'].first()
+        quantiles[name] = pd.Series(bucket_values(first.to_numpy()), index=first.index)
+    quantiles = pd.DataFrame(quantiles).reindex(sums.index)
+    # Bucket midpoints can fall outside what was observed
+    return quantiles.clip(lower=sums['minimum'], upper=sums['maximum'], axis=0)
+
+
+# Per-server tail latency and availability per time window (e.g. '1min', '1h', '1D').
+# Results are streamed in chunks and only per-window sums and histograms are kept, so memory grows with
+# the number of windows and not with the number of rows.
+def windowed_report(file_path='dns_latency_results.csv', window='1h', metrics=METRICS, start=None, end=None,
+                    chunk_rows=CHUNK_ROWS):
+    sums = None
+    histogram = None
+    for chunk in iter_results(file_path, ['server'] + list(metrics), start, end, chunk_rows, mark_failed=True):
+        if chunk.empty:
+            continue
+        chunk_sums, chunk_histogram = summarize_chunk(chunk, window, list(metrics))
+        if sums is None:
+            sums, histogram = chunk_sums, chunk_histogram
+        else:
+            sums = pd.concat([sums, chunk_sums]).groupby(level=KEYS, observed=True).agg(SUM_COLUMNS)
+            histogram = pd.concat([histogram, chunk_histogram]).groupby(level=KEYS + ['bucket'], observed=True).sum()
+
+    if sums is None:
+        return pd.DataFrame(columns=KEYS + ['samples', 'failures', 'failure_ratio', 'mean', 'jitter']
+                            + list(QUANTILES) + ['max'])
+
+    answered = sums['samples'] - sums['failures']
+    report = pd.DataFrame({
+        'samples': sums['samples'],
+        'failures': sums['failures'],
+        'failure_ratio': sums['failures'] / sums['samples'],
+        'mean': sums['total'] / answered.where(answered > 0),
+        # Jitter as the standard deviation of latency within the window
+        'jitter': np.sqrt(((sums['total_sq'] - sums['total'] ** 2 / answered.where(answered > 0))
+                           / (answered - 1).where(answered > 1)).clip(lower=0)),
+    })
+    report = report.join(histogram_quantiles(histogram, sums))
+    report['max'] = sums['maximum']
+    return report.reset_index().sort_values(KEYS, ignore_index=True)
+
+
+# Write the report as CSV, or as Parquet when the path ends in .parquet
+def export_report(report, path):
+    if path.endswith('.parquet'):
+        report.to_parquet(path, index=False)
+    else:
+        report.to_csv(path, index=False, float_format='%.6f')
+
+
+# One PNG per metric: p50/p99 latency per server over time, and failure ratio below it
+def plot_report(report, output_dir='plots'):
+    import matplotlib.pyplot as plt
+    os.makedirs(output_dir, exist_ok=True)
+    plt.switch_backend('Agg')
+    for metric, metric_report in report.groupby('metric', sort=False):
+        figure, (latency_axes, failure_axes) = plt.subplots(2, 1, figsize=FIGSIZE, sharex=True,
+                                                            gridspec_kw={'height_ratios': [3, 1]})
+        for server, server_report in metric_report.groupby('server', sort=False):
+            windows = server_report['window'].to_numpy()
+            latency_axes.plot(*downsample_minmax(windows, server_report['p50'].to_numpy()), label=f'{server} p50')
+            latency_axes.plot(*downsample_minmax(windows, server_report['p99'].to_numpy()), linestyle='--',
+                              label=f'{server} p99')
+            failure_axes.plot(*downsample_minmax(windows, server_report['failure_ratio'].to_numpy()), label=server)
+        latency_axes.set_title(f'{metric} per window (p50 solid, p99 dashed)')
+        latency_axes.set_ylabel('Latency (s)')
+        latency_axes.legend(loc='upper right', fontsize='small', ncol=2)
+        failure_axes.set_ylabel('Failure ratio')
+        failure_axes.set_ylim(0, 1)
+        failure_axes.set_xlabel('Window')
+        plt.xticks(rotation=45)
+        plt.tight_layout()
+        plot_filename = f"{output_dir}/report_{metric}.png"
+        figure.savefig(plot_filename, dpi=DPI)
+        plt.close(figure)
+        print(f"Saved windowed report plot for {metric} as {plot_filename}")
+
+
+if __name__ == "__main__":
+    from dnstk import script_main
+    script_main('report')
@@ -0,0 +1,309 @@
+import json
+import math
+import os
+from dns_latency_writer import read_rows
+
+METRICS = ['ping_latency', 'google_query_latency', 'domain_query_latency']
+QUANTILES = [0.5, 0.95, 0.99]
+LOWEST_LATENCY = 1e-6  # seconds; smaller latencies share the first histogram bucket
+BUCKET_GROWTH = 1.02  # ratio between histogram bucket bounds, so quantiles are within ~1%
+LOG_GROWTH = math.log(BUCKET_GROWTH)
+
+
+# Running statistics of one latency series: count, mean and variance (Welford's method), failures,
+# min/max and a log-bucketed histogram for quantiles. Two instances can be merged.
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared differences from the mean
+        self.failures = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.buckets = {}  # bucket index -> count
+
+    def add(self, value):
+        if value is None or math.isnan(value):
+            self.failures += 1
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        bucket = bucket_index(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    # Combine another series into this one (Chan et al. parallel variance)
+    def merge(self, other):
+        if other.count:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.mean += delta * other.count / count
+            self.count = count
+            self.minimum = min(self.minimum, other.minimum)
+            self.maximum = max(self.maximum, other.maximum)
+            for bucket, bucket_count in other.buckets.items():
+                self.buckets[bucket] = self.buckets.get(bucket, 0) + bucket_count
+        self.failures += other.failures
+
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else math.nan
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    # Approximate quantile from the histogram, clamped to the observed min/max
+    def quantile(self, q):
+        if not self.count:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                return min(max(bucket_value(bucket), self.minimum), self.maximum)
+        return self.maximum
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2, 'failures': self.failures,
+                'minimum': self.minimum if self.count else None, 'maximum': self.maximum if self.count else None,
+                'buckets': {str(bucket): count for bucket, count in self.buckets.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.count = data['count']
+        stats.mean = data['mean']
+        stats.m2 = data['m2']
+        stats.failures = data['failures']
+        stats.minimum = data['minimum'] if data['minimum'] is not None else math.inf
+        stats.maximum = data['maximum'] if data['maximum'] is not None else -math.inf
+        stats.buckets = {int(bucket): count for bucket, count in data['buckets'].items()}
+        return stats
+
+
+def bucket_index(value):
+    if value <= LOWEST_LATENCY:
+        return 0
+    return int(math.log(value / LOWEST_LATENCY) / LOG_GROWTH) + 1
+
+
+# Representative value of a bucket: the geometric middle of its bounds
+def bucket_value(bucket):
+    if bucket == 0:
+        return LOWEST_LATENCY
+    return LOWEST_LATENCY * BUCKET_GROWTH ** (bucket - 0.5)
+
+
+# Parse a latency field as written by run_measurements; None means the probe was disabled
+def parse_latency(field):
+    if field in ('None', ''):
+        return None
+    try:
+        return float(field)
+    except ValueError:
+        return math.nan  # ping3 reports some failures as False
+
+
+# Per-server RunningStats for every latency metric, plus how far into the results they reach
+class LatencyAggregates:
+    def __init__(self):
+        self.servers = {}  # server -> {metric: RunningStats}
+        self.csv_offset = 0  # bytes of the results CSV already counted
+        self.last_timestamp_ns = None  # newest row counted from a columnar results directory
+        self.rows = 0
+
+    def add_row(self, server, latencies, timestamp_ns=None):
+        stats = self.servers.get(server)
+        if stats is None:
+            stats = self.servers[server] = {metric: RunningStats() for metric in METRICS}
+        for metric, latency in zip(METRICS, latencies):
+            if latency is not None:
+                stats[metric].add(latency)
+        self.rows += 1
+        if timestamp_ns is not None:
+            self.last_timestamp_ns = max(timestamp_ns, self.last_timestamp_ns or timestamp_ns)
+
+    # Count the rows the results CSV gained since csv_offset
+    def read_csv_tail(self, csv_file):
+        if not os.path.exists(csv_file):
+            return
+        if os.path.getsize(csv_file) < self.csv_offset:
+            # The CSV was replaced or truncated, so start over from its beginning
+            self.__init__()
+        with open(csv_file, 'rb') as file:
+            file.seek(self.csv_offset)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break  # a row still being written
+                self.csv_offset += len(line)
+                fields = line.decode('utf-8').rstrip('\r\n').split(',')
+                if fields[0] == 'timestamp' or len(fields) < 5:
+                    continue
+                self.add_row(fields[1], [parse_latency(field) for field in fields[2:5]])
+
+    # Count the rows of a columnar results directory newer than the last one counted
+    def read_store_tail(self, directory):
+        start_ns = self.last_timestamp_ns + 1 if self.last_timestamp_ns is not None else None
+        for row in read_rows(directory, start_ns, columns=['timestamp', 'server'] + METRICS):
+            self.add_row(row['server'], [row[metric] for metric in METRICS], row['timestamp'])
+
+    def to_dict(self):
+        return {'csv_offset': self.csv_offset, 'last_timestamp_ns': self.last_timestamp_ns, 'rows': self.rows,
+                'servers': {server: {metric: stats.to_dict() for metric, stats in metrics.items()}
+                            for server, metrics in self.servers.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        aggregates = cls()
+        aggregates.csv_offset = data['csv_offset']
+        aggregates.last_timestamp_ns = data.get('last_timestamp_ns')
+        aggregates.rows = data['rows']
+        aggregates.servers = {server: {metric: RunningStats.from_dict(stats) for metric, stats in metrics.items()}
+                              for server, metrics in data['servers'].items()}
+        return aggregates
+
+    def save(self, snapshot_file):
+        save_snapshot(self.to_dict(), snapshot_file)
+
+
+# RunningStats of the cache probes per server, record type and probe ('cold' or 'warm'), plus how far into
+# the cache probe CSV they reach
+class CacheProbeStats:
+    def __init__(self):
+        self.series = {}  # (server, rdtype, probe) -> RunningStats
+        self.csv_offset = 0  # bytes of the cache probe CSV already counted
+
+    def add(self, server, rdtype, probe, latency):
+        stats = self.series.get((server, rdtype, probe))
+        if stats is None:
+            stats = self.series[server, rdtype, probe] = RunningStats()
+        stats.add(latency)
+
+    # Count the probes the cache probe CSV gained since csv_offset
+    def read_csv_tail(self, csv_file):
+        if not os.path.exists(csv_file):
+            return
+        if os.path.getsize(csv_file) < self.csv_offset:
+            self.__init__()
+        with open(csv_file, 'rb') as file:
+            file.seek(self.csv_offset)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break
+                self.csv_offset += len(line)
+                fields = line.decode('utf-8').rstrip('\r\n').split(',')
+                if fields[0] == 'timestamp' or len(fields) < 6:
+                    continue
+                self.add(fields[1], fields[3], fields[2], parse_latency(fields[5]))
+
+    def to_dict(self):
+        return {'csv_offset': self.csv_offset,
+                'series': [[server, rdtype, probe, stats.to_dict()]
+                           for (server, rdtype, probe), stats in self.series.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.csv_offset = data['csv_offset']
+        stats.series = {(server, rdtype, probe): RunningStats.from_dict(series)
+                        for server, rdtype, probe, series in data['series']}
+        return stats
+
+    def save(self, snapshot_file):
+        save_snapshot(self.to_dict(), snapshot_file)
+
+
+def save_snapshot(data, snapshot_file):
+    temporary_file = snapshot_file + '.tmp'
+    with open(temporary_file, 'w') as file:
+        json.dump(data, file)
+    os.replace(temporary_file, snapshot_file)
+
+
+# Cache probe statistics of a cache probe CSV, as written by run_measurements: the saved snapshot plus
+# whatever probes were written after it
+def load_cache_probe_stats(csv_file, snapshot_file=None):
+    try:
+        with open(snapshot_file or snapshot_path_for(csv_file), 'r') as file:
+            stats = CacheProbeStats.from_dict(json.load(file))
+    except (FileNotFoundError, ValueError, KeyError):
+        stats = CacheProbeStats()
+    stats.read_csv_tail(csv_file)
+    return stats
+
+
+# Default snapshot location for a results CSV or columnar results directory
+def snapshot_path_for(results_path):
+    if os.path.isdir(results_path):
+        return os.path.join(results_path, 'stats.json')
+    return results_path + '.stats.json'
+
+
+# Aggregates for a results CSV or directory: the saved snapshot plus whatever rows were written after it
+def load_aggregates(results_path, snapshot_file=None):
+    snapshot_file = snapshot_file or snapshot_path_for(results_path)
+    try:
+        with open(snapshot_file, 'r') as file:
+            aggregates = LatencyAggregates.from_dict(json.load(file))
+    except (FileNotFoundError, ValueError, KeyError):
+        aggregates = LatencyAggregates()
+    if os.path.isdir(results_path):
+        aggregates.read_store_tail(results_path)
+    else:
+        aggregates.read_csv_tail(results_path)
+    return aggregates
+
+
+def format_table(title, columns, rows):
+    widths = [max(len(str(value)) for value in column) for column in zip(columns, *rows)]
+    lines = [title, '  '.join(str(value).ljust(width) for value, width in zip(columns, widths))]
+    lines += ['  '.join(str(value).ljust(width) for value, width in zip(row, widths)) for row in rows]
+    return '\n'.join(lines)
+
+
+def format_latency(value):
+    return 'nan' if math.isnan(value) else f'{value:.6f}'
+
+
+# Print mean and quantile latencies and failure counts per server, in O(servers)
+def print_summary(aggregates):
+    servers = sorted(aggregates.servers)
+    mean_rows = [[server] + [format_latency(aggregates.servers[server][metric].mean
+                                            if aggregates.servers[server][metric].count else math.nan)
+                             for metric in METRICS] for server in servers]
+    print()
+    print(format_table("Basic Statistics (Average Latency in Seconds):",
+                       ['server'] + [f'{metric}_mean' for metric in METRICS], mean_rows))
+
+    quantile_columns = [f'{metric}_p{int(q * 100)}' for metric in METRICS for q in QUANTILES]
+    quantile_rows = [[server] + [format_latency(aggregates.servers[server][metric].quantile(q))
+                                 for metric in METRICS for q in QUANTILES] for server in servers]
+    print()
+    print(format_table("Latency Percentiles in Seconds:", ['server'] + quantile_columns, quantile_rows))
+
+    failure_rows = [[server] + [aggregates.servers[server][metric].failures for metric in METRICS]
+                    for server in servers]
+    print()
+    print(format_table("Number of Failed Pings/Queries:",
+                       ['server'] + [f'{metric}_nan_count' for metric in METRICS], failure_rows))
+
+
+# Print cold and warm cache latencies per server and record type. The difference of the medians is about the
+# time the resolver spends recursing, which is what the cold probes are there to show.
+def print_cache_summary(stats):
+    keys = sorted({(server, rdtype) for server, rdtype, _ in stats.series})
+    rows = []
+    for server, rdtype in keys:
+        cold = stats.series.get((server, rdtype, 'cold'), RunningStats())
+        warm = stats.series.get((server, rdtype, 'warm'), RunningStats())
+        rows.append([server, rdtype, format_latency(cold.quantile(0.5)), format_latency(cold.quantile(0.95)),
+                     format_latency(warm.quantile(0.5)), format_latency(warm.quantile(0.95)),
+                     format_latency(cold.quantile(0.5) - warm.quantile(0.5)), cold.failures, warm.failures])
+    print()
+    print(format_table("Cold vs Warm Cache Latency in Seconds:",
+                       ['server', 'rdtype', 'cold_p50', 'cold_p95', 'warm_p50', 'warm_p95', 'recursion_p50',
+                        'cold_nan_count', 'warm_nan_count'], rows))
@@ -0,0 +1,356 @@
+import datetime
+import json
+import math
+import os
+import time
+
+pa = pc = pq = None  # pyarrow, imported by load_pyarrow on first use; only the parquet backend needs it
+
+CSV_HEADER = ('timestamp,server,ping_latency,google_query_latency,domain_query_latency,domain,'
+              'google_query_setup,domain_query_setup\n')
+# Results files written before connection setup was recorded separately end at the domain column
+LEGACY_CSV_HEADER = 'timestamp,server,ping_latency,google_query_latency,domain_query_latency,domain\n'
+COLUMNS = ['timestamp', 'server', 'ping_latency', 'google_query_latency', 'domain_query_latency', 'domain',
+           'google_query_setup', 'domain_query_setup']
+# Cache probes are written to their own file, one row per query, tagged with the probe ('cold' or 'warm')
+CACHE_PROBE_HEADER = 'timestamp,server,probe,rdtype,domain,latency,setup,rcode\n'
+BATCH_ROWS = 1000  # rows buffered before a batch is written
+ROTATE_SECONDS = 24 * 3600  # start a new segment after this long; the open one is journaled against crashes
+ROTATE_BYTES = 64 * 1024 * 1024  # or once a segment reaches this size
+MANIFEST_FILE = 'manifest.json'
+JOURNAL_SUFFIX = '.journal'  # rows of the open segment, next to it
+
+
+# Import pyarrow on first use, so processes that only write CSV don't pay for loading it
+def load_pyarrow():
+    global pa, pc, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.compute
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The parquet results backend needs pyarrow (pip install pyarrow)")
+        pa, pc, pq = pyarrow, pyarrow.compute, pyarrow.parquet
+    return pa, pc, pq
+
+
+def format_timestamp(timestamp_ns):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp_ns / 1e9))
+
+
+# Rows are (timestamp_ns, server, ping_latency, google_query_latency, domain_query_latency, domain,
+# google_query_setup, domain_query_setup); a latency of None means the probe was disabled. Setup is the
+# time spent opening a connection before the query (0 over UDP or a reused connection).
+class CsvResultsWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+        if os.path.getsize(path) == 0:  # Add headers if the file is new
+            self.file.write(CSV_HEADER)
+            self.with_setup = True
+        else:
+            # Keep appending rows in the layout the file was started with
+            with open(path, 'r') as existing:
+                self.with_setup = existing.readline() != LEGACY_CSV_HEADER
+
+    def write(self, rows):
+        for timestamp_ns, server, ping_latency, google_latency, domain_latency, domain, google_setup, domain_setup \
+                in rows:
+            # Log all measurements in a single CSV line per server
+            line = f'{format_timestamp(timestamp_ns)},{server},{ping_latency},{google_latency},{domain_latency},{domain}'
+            if self.with_setup:
+                line += f',{google_setup},{domain_setup}'
+            self.file.write(line + '\n')
+        self.file.flush()
+
+    def flush(self):
+        self.file.flush()
+
+    # Bytes of the CSV written so far, which is how far the running aggregates reach
+    def offset(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def close(self):
+        self.file.close()
+
+
+# Rows are (timestamp_ns, server, probe, rdtype, domain, latency, setup, rcode); a failed query has a NaN
+# latency and no rcode
+class CacheProbeWriter:
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        if os.path.getsize(path) == 0:
+            self.file.write(CACHE_PROBE_HEADER)
+
+    def write(self, rows):
+        for timestamp_ns, server, probe, rdtype, domain, latency, setup, rcode in rows:
+            self.file.write(f'{format_timestamp(timestamp_ns)},{server},{probe},{rdtype},{domain},{latency},{setup},'
+                            f'{rcode or ""}\n')
+        self.file.flush()
+
+    # Bytes of the CSV written so far, which is how far the running cache probe statistics reach
+    def offset(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def close(self):
+        self.file.close()
+
+
+def parquet_schema():
+    return pa.schema([
+        ('timestamp', pa.int64()),  # nanoseconds since the epoch, UTC
+        ('server', pa.dictionary(pa.int32(), pa.string())),
+        ('ping_latency', pa.float64()),
+        ('google_query_latency', pa.float64()),
+        ('domain_query_latency', pa.float64()),
+        ('domain', pa.dictionary(pa.int32(), pa.string())),
+        ('google_query_setup', pa.float64()),
+        ('domain_query_setup', pa.float64()),
+    ])
+
+
+# Latency as stored in the columnar backend: None stays null (probe disabled), failures become NaN
+def latency_value(latency):
+    if latency is None:
+        return None
+    try:
+        return float(latency) if latency is not False else math.nan
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {'segments': []}
+
+
+def save_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+# Manifest entry for a finished segment, with its time range so readers can skip it
+def segment_entry(directory, name):
+    load_pyarrow()
+    path = os.path.join(directory, name)
+    table = pq.read_table(path, columns=['timestamp'])
+    timestamps = table.column('timestamp')
+    return {'file': name, 'rows': table.num_rows, 'bytes': os.path.getsize(path),
+            'min_timestamp_ns': pc.min(timestamps).as_py(), 'max_timestamp_ns': pc.max(timestamps).as_py()}
+
+
+# Rows as a record batch of the columnar schema
+def record_batch(rows, schema):
+    columns = list(zip(*rows))
+    return pa.record_batch([
+        pa.array(columns[0], pa.int64()),
+        pa.array(columns[1], pa.string()).dictionary_encode(),
+        pa.array([latency_value(value) for value in columns[2]], pa.float64()),
+        pa.array([latency_value(value) for value in columns[3]], pa.float64()),
+        pa.array([latency_value(value) for value in columns[4]], pa.float64()),
+        pa.array(columns[5], pa.string()).dictionary_encode(),
+        pa.array([latency_value(value) for value in columns[6]], pa.float64()),
+        pa.array([latency_value(value) for value in columns[7]], pa.float64()),
+    ], schema=schema)
+
+
+def journal_path(directory, segment_name):
+    return os.path.join(directory, segment_name[:-len('.parquet')] + JOURNAL_SUFFIX)
+
+
+# Rows of a journal, without a last line the crash cut short
+def read_journal(path):
+    rows = []
+    with open(path, 'r') as file:
+        for line in file:
+            if not line.endswith('\n'):
+                break
+            rows.append(tuple(json.loads(line)))
+    return rows
+
+
+# Columnar backend: Parquet segments with dictionary-encoded server/domain columns and integer
+# nanosecond timestamps, rolled over by time or size and listed in a manifest. A segment is only readable
+# once closed, so the rows of the open one also go to a journal (JSON lines, flushed on every write) that
+# rebuilds it after a crash; segments can then stay open for hours.
+class ParquetResultsWriter:
+    def __init__(self, directory, batch_rows=BATCH_ROWS, rotate_seconds=ROTATE_SECONDS, rotate_bytes=ROTATE_BYTES):
+        load_pyarrow()
+        self.directory = directory
+        self.batch_rows = batch_rows
+        self.rotate_seconds = rotate_seconds
+        self.rotate_bytes = rotate_bytes
+        self.schema = parquet_schema()
+        self.buffer = []
+        self.writer = None
+        self.journal = None
+        self.segment_name = None  # of the open segment, None between segments
+        self.segment_started = None
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = load_manifest(directory)
+        self.recover_segments()
+
+    # Segments missing from the manifest were left by a crash: rebuild those with a journal, keep the other
+    # readable ones and set aside the rest
+    def recover_segments(self):
+        listed = {segment['file'] for segment in self.manifest['segments']}
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(JOURNAL_SUFFIX):
+                continue
+            segment_name = name[:-len(JOURNAL_SUFFIX)] + '.parquet'
+            if segment_name not in listed:
+                self.rebuild_segment(segment_name, read_journal(os.path.join(self.directory, name)))
+                listed.add(segment_name)
+            os.remove(os.path.join(self.directory, name))
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.parquet') or name in listed:
+                continue
+            try:
+                self.manifest['segments'].append(segment_entry(self.directory, name))
+            except (OSError, pa.ArrowInvalid):
+                os.replace(os.path.join(self.directory, name), os.path.join(self.directory, name + '.partial'))
+        save_manifest(self.directory, self.manifest)
+
+    def rebuild_segment(self, segment_name, rows):
+        path = os.path.join(self.directory, segment_name)
+        if not rows:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with pq.ParquetWriter(path, self.schema, compression='zstd') as writer:
+            writer.write_batch(record_batch(rows, self.schema))
+        self.manifest['segments'].append(segment_entry(self.directory, segment_name))
+
+    # Rows of one call always end up in the same segment
+    def write(self, rows):
+        if self.segment_name is not None and self.segment_due():
+            self.close_segment()
+        if self.segment_name is None:
+            self.segment_name = f'segment-{rows[0][0]}.parquet'
+            self.journal = open(journal_path(self.directory, self.segment_name), 'a')
+            self.segment_started = time.monotonic()
+        for row in rows:
+            self.journal.write(json.dumps(row) + '\n')
+        self.journal.flush()
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.batch_rows:
+            self.flush()
+
+    def segment_due(self):
+        if time.monotonic() - self.segment_started >= self.rotate_seconds:
+            return True
+        return self.writer is not None and (os.path.getsize(os.path.join(self.directory, self.segment_name))
+                                            >= self.rotate_bytes)
+
+    # Write the buffered rows to the open segment as one row group
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(os.path.join(self.directory, self.segment_name), self.schema,
+                                           compression='zstd')
+        self.writer.write_batch(record_batch(self.buffer, self.schema))
+        self.buffer = []
+
+    # Finish the open segment; its journal goes only once the manifest lists it
+    def close_segment(self):
+        self.flush()
+        self.writer.close()
+        self.writer = None
+        self.manifest['segments'].append(segment_entry(self.directory, self.segment_name))
+        save_manifest(self.directory, self.manifest)
+        self.journal.close()
+        os.remove(journal_path(self.directory, self.segment_name))
+        self.journal = None
+        self.segment_name = None
+
+    def offset(self):
+        return None
+
+    def close(self):
+        if self.segment_name is not None:
+            self.close_segment()
+
+
+# Writer for the given backend: 'csv' appends to a file, 'parquet' writes segments into a directory
+def open_results_writer(path, output_format='csv', **options):
+    if output_format == 'csv':
+        return CsvResultsWriter(path)
+    if output_format == 'parquet':
+        return ParquetResultsWriter(path, **options)
+    raise ValueError(f"Unknown results format: {output_format}")
+
+
+def local_timezone():
+    return datetime.datetime.now().astimezone().tzinfo
+
+
+# Nanoseconds since the epoch for a datetime or an ISO string; naive values are taken as local time
+def to_timestamp_ns(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=local_timezone())
+    return int(value.timestamp()) * 1_000_000_000 + value.microsecond * 1000
+
+
+# Segments of a columnar store that overlap [start_ns, end_ns)
+def segments_in_range(directory, start_ns=None, end_ns=None):
+    for segment in load_manifest(directory)['segments']:
+        if start_ns is not None and segment['max_timestamp_ns'] < start_ns:
+            continue
+        if end_ns is not None and segment['min_timestamp_ns'] >= end_ns:
+            continue
+        yield os.path.join(directory, segment['file'])
+
+
+# Requested columns a segment has; older ones lack the setup time columns
+def segment_columns(segment, columns):
+    load_pyarrow()
+    names = pq.read_schema(segment).names
+    return [column for column in columns if column in names]
+
+
+# Parquet read filters for rows in [start_ns, end_ns), or None for all rows
+def timestamp_filters(start_ns=None, end_ns=None):
+    filters = []
+    if start_ns is not None:
+        filters.append(('timestamp', '>=', start_ns))
+    if end_ns is not None:
+        filters.append(('timestamp', '<', end_ns))
+    return filters or None
+
+
+# Rows of a columnar store in [start_ns, end_ns), as dicts, one segment in memory at a time; with columns,
+# only those are read. Rows outside the window are filtered out before they become dicts.
+def read_rows(directory, start_ns=None, end_ns=None, columns=None):
+    load_pyarrow()
+    for segment in segments_in_range(directory, start_ns, end_ns):
+        yield from pq.read_table(segment, columns=segment_columns(segment, columns) if columns is not None else None,
+                                 filters=timestamp_filters(start_ns, end_ns)).to_pylist()
+
+
+# Export a columnar store (or part of it) to the CSV format run_measurements writes
+def export_csv(directory, csv_path, start=None, end=None):
+    if not os.path.isdir(directory):
+        raise FileNotFoundError(f"No columnar results store at {directory}")
+    with open(csv_path, 'w') as file:
+        file.write(CSV_HEADER)
+        for row in read_rows(directory, to_timestamp_ns(start), to_timestamp_ns(end)):
+            # Segments written before setup times were recorded don't have those columns
+            file.write(f"{format_timestamp(row['timestamp'])},{row['server']},{row['ping_latency']},"
+                       f"{row['google_query_latency']},{row['domain_query_latency']},{row['domain']},"
+                       f"{row.get('google_query_setup')},{row.get('domain_query_setup')}\n")
+
+
+if __name__ == "__main__":
+    from dnstk import script_main
+    script_main('export-latency')
@@ -0,0 +1,247 @@
+import asyncio
+import bisect
+import itertools
+import json
+import random
+import time
+import numpy as np
+import dns.rcode
+from dns_domain_sampling import sample_domains, random_subdomain
+from dns_query_engine import QueryEngine
+from dns_latency_stats import format_table
+from dns_latency_writer import open_results_writer
+
+# Configuration variables
+POPULAR_DOMAINS_FILE = 'new_domains.txt'  # names a resolver likely has cached, most popular first
+BLOCKED_DOMAINS_FILE = 'domains.txt'  # blocklisted names, as checked by dns_domain_list_check.py
+MAX_DOMAINS = 10000  # names kept in memory per source
+# Share of each kind of name in the query mix: popular names (Zipf-distributed, so a few are very hot),
+# random subdomains of popular names (never cached, the resolver has to recurse) and blocklisted names
+QUERY_MIX = {'popular': 0.7, 'random': 0.2, 'blocked': 0.1}
+ARRIVALS = 'poisson'  # 'poisson' (exponential gaps between queries) or 'constant' (evenly spaced)
+QUERY_TIMEOUT = 2.0  # seconds before a query counts as failed; no retries, so each query is one packet
+MAX_PENDING = 20000  # queries waiting for an answer; beyond that new queries are dropped and counted as failed
+WRITE_INTERVAL = 0.5  # seconds between writes of result rows
+# A step holds if the server answers at least this share of the target rate, fails at most this share
+# of queries, and keeps the p99 latency under this many seconds; the last step that holds is its capacity
+HOLD_ANSWERED_SHARE = 0.95
+HOLD_FAILURE_RATIO = 0.01
+HOLD_P99 = 0.5
+# Answers that mean the resolver did its job; SERVFAIL and REFUSED under load mean it didn't
+ANSWERED_RCODES = {dns.rcode.NOERROR, dns.rcode.NXDOMAIN}
+
+
+# Ramp profile of (queries per second, seconds) steps, multiplying the rate by factor from start up to stop
+def ramp_profile(start_qps, stop_qps, factor=2, step_seconds=15):
+    steps = []
+    qps = start_qps
+    while qps <= stop_qps:
+        steps.append((qps, step_seconds))
+        qps *= factor
+    return steps
+
+
+# Draws query names from the configured mix of sources
+class QueryMix:
+    def __init__(self, popular, blocked, mix=QUERY_MIX, rng=random):
+        self.popular = popular
+        self.blocked = blocked
+        self.rng = rng
+        kinds = [kind for kind in ('popular', 'random', 'blocked') if mix.get(kind)]
+        if not popular:
+            kinds = [kind for kind in kinds if kind == 'blocked']
+        if not blocked:
+            kinds = [kind for kind in kinds if kind != 'blocked']
+        if not kinds:
+            raise ValueError("No domains to draw queries from")
+        self.kinds = kinds
+        self.kind_weights = list(itertools.accumulate(mix[kind] for kind in kinds))
+        # Zipf weights with exponent 1: the n-th most popular name is queried 1/n as often as the first
+        self.popular_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(popular) + 1)))
+
+    def popular_name(self):
+        position = bisect.bisect(self.popular_weights, self.rng.random() * self.popular_weights[-1])
+        return self.popular[min(position, len(self.popular) - 1)]
+
+    # Kind and name of the next query
+    def next(self):
+        kind = self.kinds[bisect.bisect(self.kind_weights, self.rng.random() * self.kind_weights[-1])]
+        if kind == 'popular':
+            return kind, self.popular_name()
+        if kind == 'random':
+            return kind, random_subdomain(self.popular_name(), self.rng)
+        return kind, self.rng.choice(self.blocked)
+
+
+def load_query_mix(popular_file=POPULAR_DOMAINS_FILE, blocked_file=BLOCKED_DOMAINS_FILE, mix=QUERY_MIX,
+                   max_domains=MAX_DOMAINS):
+    # Popular names keep their order in the file, which is their rank
+    with open(popular_file, 'r') as file:
+        popular = list(itertools.islice((line.strip() for line in file if line.strip()), max_domains))
+    blocked, _ = sample_domains(blocked_file, max_domains) if mix.get('blocked') else ([], 0)
+    return QueryMix(popular, blocked, mix)
+
+
+# Nanosecond gaps between the queries of a step, open-loop: they don't depend on when answers come back
+def arrival_gaps(qps, arrivals=ARRIVALS, rng=random):
+    if arrivals == 'constant':
+        return itertools.repeat(int(1e9 / qps))
+    if arrivals == 'poisson':
+        return (int(rng.expovariate(qps) * 1e9) for _ in itertools.count())
+    raise ValueError(f"Unknown arrival process: {arrivals}")
+
+
+# Latencies and failures of one step against one server
+class StepResult:
+    def __init__(self, server, qps, seconds):
+        self.server = server
+        self.qps = qps
+        self.seconds = seconds
+        self.latencies = []  # from the scheduled send time, so queueing in the client counts too
+        self.service_latencies = []  # from the actual send time, as the engine measures it
+        self.failures = 0
+        self.dropped = 0
+
+    def summary(self):
+        latencies = np.array(self.latencies)
+        service = np.array(self.service_latencies)
+        sent = len(latencies) + self.failures
+        quantile = (lambda values, q: float(np.quantile(values, q)) if len(values) else float('nan'))
+        return {
+            'server': self.server, 'target_qps': self.qps, 'sent': sent,
+            'answered_qps': round(len(latencies) / self.seconds, 1),
+            'failure_ratio': round(self.failures / sent, 4) if sent else float('nan'), 'dropped': self.dropped,
+            'p50': quantile(latencies, 0.5), 'p90': quantile(latencies, 0.9), 'p99': quantile(latencies, 0.99),
+            'max': float(latencies.max()) if len(latencies) else float('nan'),
+            'service_p50': quantile(service, 0.5), 'service_p99': quantile(service, 0.99),
+        }
+
+
+# Whether a server kept up with a step
+def step_holds(summary):
+    return (summary['answered_qps'] >= HOLD_ANSWERED_SHARE * summary['target_qps']
+            and summary['failure_ratio'] <= HOLD_FAILURE_RATIO and summary['p99'] <= HOLD_P99)
+
+
+# One query of the schedule. Its latency counts from when it was due, not from when it went out, so a client
+# falling behind shows up as latency instead of hiding it (coordinated omission).
+async def scheduled_query(engine, server, name, due_ns, due_wall_ns, step, rows):
+    try:
+        result = await engine.query(server, name, 'A')
+    except Exception:
+        result = None
+    if result is not None and result.response.rcode() in ANSWERED_RCODES:
+        latency = (time.perf_counter_ns() - due_ns) / 1e9
+        step.latencies.append(latency)
+        step.service_latencies.append(result.latency)
+        rows.append((due_wall_ns, server, None, None, latency, name, None, result.setup))
+    else:
+        step.failures += 1
+        rows.append((due_wall_ns, server, None, None, float('nan'), name, None, float('nan')))
+
+
+# Send queries to a server at qps for seconds on an open-loop schedule, writing a result row per query
+async def run_step(engine, server, mix, qps, seconds, writer, arrivals=ARRIVALS, max_pending=MAX_PENDING):
+    step = StepResult(server, qps, seconds)
+    rows = []
+    pending = set()
+    started = time.perf_counter_ns()
+    wall_offset = time.time_ns() - started
+    end = started + int(seconds * 1e9)
+    next_write = started + int(WRITE_INTERVAL * 1e9)
+    due = started
+    sent_late = 0
+    for gap in arrival_gaps(qps, arrivals):
+        due += gap
+        if due >= end:
+            break
+        now = time.perf_counter_ns()
+        if due > now:
+            await asyncio.sleep((due - now) / 1e9)
+        else:
+            # Behind schedule: send right away, but let answers in every so often
+            sent_late += 1
+            if sent_late % 64 == 0:
+                await asyncio.sleep(0)
+        _, name = mix.next()
+        if len(pending) >= max_pending:
+            step.dropped += 1
+            step.failures += 1
+            rows.append((due + wall_offset, server, None, None, float('nan'), name, None, float('nan')))
+        else:
+            task = asyncio.ensure_future(scheduled_query(engine, server, name, due, due + wall_offset, step, rows))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if now >= next_write:
+            writer.write(rows)
+            rows.clear()
+            next_write = now + int(WRITE_INTERVAL * 1e9)
+
+    # Queries still out get until their timeout to come back
+    if pending:
+        await asyncio.wait(pending)
+    writer.write(rows)
+    return step.summary()
+
+
+# Run the profile against every server in turn, so the servers don't compete for the client
+async def run_load_test_async(dns_servers, mix, profile, output_file, output_format, arrivals, timeout,
+                              stop_at_saturation, metrics=None):
+    # No retries and no circuit breaker: the point is to see how the server itself copes
+    engine = QueryEngine(timeout=timeout, retries=0, lifetime=timeout, metrics=metrics, adaptive=False)
+    writer = open_results_writer(output_file, output_format)
+    summaries = []
+    try:
+        for server in dns_servers:
+            for qps, seconds in profile:
+                summary = await run_step(engine, server, mix, qps, seconds, writer, arrivals)
+                summaries.append(summary)
+                print(f"{server} at {qps} queries/s: {summary['answered_qps']} answered/s, "
+                      f"failure ratio {summary['failure_ratio']}, p99 {summary['p99']:.4f} s")
+                if stop_at_saturation and not step_holds(summary):
+                    break
+    finally:
+        writer.close()
+        await engine.close()
+    return summaries
+
+
+# Highest target rate each server held, or None if it didn't hold the first step
+def saturation_points(summaries):
+    points = {}
+    for summary in summaries:
+        points.setdefault(summary['server'], None)
+        if step_holds(summary):
+            points[summary['server']] = max(points[summary['server']] or 0, summary['target_qps'])
+    return points
+
+
+def print_load_report(summaries):
+    columns = ['server', 'target_qps', 'answered_qps', 'failure_ratio', 'dropped', 'p50', 'p90', 'p99', 'max',
+               'service_p99']
+    rows = [[summary[column] if not isinstance(summary[column], float) or column in ('answered_qps', 'failure_ratio')
+             else f'{summary[column]:.4f}' for column in columns] for summary in summaries]
+    print()
+    print(format_table("Load test steps (latencies in seconds, from the scheduled send time):", columns, rows))
+    print()
+    for server, qps in saturation_points(summaries).items():
+        print(f"{server}: {'held ' + str(qps) + ' queries/s' if qps else 'did not hold the first step'}")
+
+
+# Run a load test: the profile's steps against each server, results appended to output_file in the
+# format of dns_latency_measurement.py (the query latency in domain_query_latency, ping and google empty).
+# With metrics (a dns_metrics.QueryMetrics) every query is also recorded there.
+def run_load_test(dns_servers, mix, profile, output_file='dns_load_results.csv', output_format='csv',
+                  arrivals=ARRIVALS, timeout=QUERY_TIMEOUT, stop_at_saturation=True, summary_file=None, metrics=None):
+    summaries = asyncio.run(run_load_test_async(dns_servers, mix, profile, output_file, output_format, arrivals,
+                                                timeout, stop_at_saturation, metrics))
+    print_load_report(summaries)
+    if summary_file is not None:
+        with open(summary_file, 'w') as file:
+            json.dump({'summaries': summaries, 'saturation_qps': saturation_points(summaries)}, file, indent=2)
+    return summaries
+
+
+if __name__ == "__main__":
+    from dnstk import script_main
+    script_main('load')
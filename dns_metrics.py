@@ -0,0 +1,258 @@
+import bisect
+import collections
+import contextlib
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import dns.exception
+import dns.rcode
+
+# Outcome classes of a query; other response codes count as 'other', and queries skipped because the server
+# is out of use (see dns_query_engine.ServerHealth) as 'unavailable'
+OUTCOMES = ('NOERROR', 'NXDOMAIN', 'SERVFAIL', 'REFUSED', 'other', 'timeout', 'error', 'unavailable')
+RCODE_OUTCOMES = {rcode: dns.rcode.to_text(rcode) for rcode in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN,
+                                                                 dns.rcode.SERVFAIL, dns.rcode.REFUSED)}
+# Where the time of a query goes: building the query, setting up a connection, handing it to the socket,
+# waiting for the answer (retries included) and parsing the answer
+PHASES = ('encode', 'connect', 'send', 'wait', 'parse')
+# Upper bounds of the latency histogram buckets in seconds, from 10 us to 10 s in steps of about 1.8x
+LATENCY_BUCKETS = tuple(round(10 ** (exponent / 4), 6) for exponent in range(-20, 5))
+METRICS_PORT = 9153  # port of the Prometheus endpoint
+DUMP_INTERVAL = 10  # seconds between JSON dumps
+PROFILE_INTERVAL = 0.005  # seconds between stack samples of the profiler
+
+
+# Outcome class of a query from its response code, or from the exception it failed with
+def outcome_of(rcode=None, error=None):
+    if error is not None:
+        return 'timeout' if isinstance(error, dns.exception.Timeout) else 'error'
+    return RCODE_OUTCOMES.get(rcode, 'other')
+
+
+# Fixed-bucket histogram; observing is a bisect and two additions
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Upper bound of the bucket holding the q-th quantile, the way Prometheus estimates it without interpolating
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'mean': round(self.sum / self.count, 6) if self.count else None,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)}
+
+
+# Per-server query counters and histograms, shared by the query engine and the exporters.
+# Recording takes a lock, so the HTTP endpoint and the JSON dump can read from their own threads.
+class QueryMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.outcomes = collections.Counter()  # (server, outcome) -> queries
+        self.retries = collections.Counter()  # server -> tries beyond the first
+        self.durations = collections.defaultdict(Histogram)  # server -> whole query time
+        self.phases = collections.defaultdict(Histogram)  # (server, phase) -> time spent in the phase
+
+    # Record one query; phase_seconds follows PHASES, None (or 0 for connect) where a phase didn't happen
+    def record(self, server, outcome, phase_seconds, tries=1):
+        with self.lock:
+            self.outcomes[server, outcome] += 1
+            if tries > 1:
+                self.retries[server] += tries - 1
+            total = 0.0
+            for phase, seconds in zip(PHASES, phase_seconds):
+                if seconds is not None and (seconds or phase != 'connect'):
+                    self.phases[server, phase].observe(seconds)
+                    total += seconds
+            self.durations[server].observe(total)
+
+    def servers(self):
+        return sorted({server for server, _ in self.outcomes})
+
+    # Plain-data copy of all metrics, with quantile estimates per histogram
+    def snapshot(self):
+        with self.lock:
+            servers = {}
+            for server in self.servers():
+                servers[server] = {
+                    'queries': sum(self.outcomes[server, outcome] for outcome in OUTCOMES),
+                    'outcomes': {outcome: self.outcomes[server, outcome] for outcome in OUTCOMES},
+                    'retries': self.retries[server],
+                    'duration': self.durations[server].summary(),
+                    'phases': {phase: self.phases[server, phase].summary() for phase in PHASES
+                               if (server, phase) in self.phases},
+                }
+        return {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'uptime': round(time.time() - self.started, 3),
+                'servers': servers}
+
+    # All metrics in the Prometheus text exposition format
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            lines.append('# HELP dns_queries_total DNS queries by server and outcome.')
+            lines.append('# TYPE dns_queries_total counter')
+            for (server, outcome), count in sorted(self.outcomes.items()):
+                lines.append(f'dns_queries_total{{server="{escape_label(server)}",outcome="{outcome}"}} {count}')
+            lines.append('# HELP dns_query_retries_total Tries beyond the first one, by server.')
+            lines.append('# TYPE dns_query_retries_total counter')
+            for server, count in sorted(self.retries.items()):
+                lines.append(f'dns_query_retries_total{{server="{escape_label(server)}"}} {count}')
+            lines.append('# HELP dns_query_duration_seconds Time of whole queries, by server.')
+            lines.append('# TYPE dns_query_duration_seconds histogram')
+            for server, histogram in sorted(self.durations.items()):
+                histogram_lines(lines, 'dns_query_duration_seconds', f'server="{escape_label(server)}"', histogram)
+            lines.append('# HELP dns_query_phase_seconds Time spent in each phase of a query, by server.')
+            lines.append('# TYPE dns_query_phase_seconds histogram')
+            for (server, phase), histogram in sorted(self.phases.items()):
+                histogram_lines(lines, 'dns_query_phase_seconds', f'server="{escape_label(server)}",phase="{phase}"',
+                                histogram)
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def histogram_lines(lines, name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.bounds + ('+Inf',), histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+
+# Write a metrics snapshot as JSON, replacing the file in one step so readers never see half of it
+def dump_json(metrics, json_file):
+    temporary_file = json_file + '.tmp'
+    with open(temporary_file, 'w') as file:
+        json.dump(metrics.snapshot(), file, indent=2)
+    os.replace(temporary_file, json_file)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would drown the progress output
+
+
+# Serve metrics over HTTP for Prometheus (port None: no endpoint) and dump them as JSON every interval
+# (json_file None: no dump) from background threads, until closed
+class MetricsExporter:
+    def __init__(self, metrics, port=METRICS_PORT, json_file=None, interval=DUMP_INTERVAL, address=''):
+        self.metrics = metrics
+        self.json_file = json_file
+        self.interval = interval
+        self.http_server = None
+        self.stopped = threading.Event()
+        self.threads = []
+        if port is not None:
+            self.http_server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+            self.http_server.daemon_threads = True
+            self.http_server.metrics = metrics
+            self.threads.append(threading.Thread(target=self.http_server.serve_forever, daemon=True))
+        if json_file is not None:
+            self.threads.append(threading.Thread(target=self.dump_periodically, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def dump_periodically(self):
+        while not self.stopped.wait(self.interval):
+            dump_json(self.metrics, self.json_file)
+
+    def close(self):
+        self.stopped.set()
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.json_file is not None:
+            dump_json(self.metrics, self.json_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Sampling profiler for one thread: a background thread records its call stack every interval, so the cost
+# doesn't grow with the number of calls like a tracing profiler's does
+class StackSampler:
+    def __init__(self, interval=PROFILE_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    # Samples in the collapsed-stack format read by flamegraph.pl and speedscope
+    def write(self, output_file):
+        with open(output_file, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+
+
+# Profile the calling thread while the block runs, writing the samples to output_file; None disables it
+@contextlib.contextmanager
+def profiled(output_file, interval=PROFILE_INTERVAL):
+    if output_file is None:
+        yield
+        return
+    sampler = StackSampler(interval)
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        sampler.write(output_file)
@@ -0,0 +1,652 @@
+import asyncio
+import collections
+import functools
+import random
+import socket
+import ssl
+import struct
+import threading
+import time
+import urllib.parse
+import dns.exception
+import dns.message
+import dns.rcode
+import dns.rdatatype
+from dns_metrics import outcome_of
+
+httpx = None  # imported by load_httpx on first use; only DNS over HTTPS needs it
+
+# Engine defaults, chosen to match dnspython's stub resolver
+DNS_PORT = 53
+TIMEOUT = 2.0  # seconds to wait for one try
+RETRIES = 2  # extra tries after the first one times out
+LIFETIME = 5.0  # seconds a query may take in total, retries included
+MAX_OUTSTANDING = 4096  # queries waiting for an answer on one socket
+EDNS_PAYLOAD = 1232  # advertised UDP payload size for DNSSEC queries
+TLS_PORT = 853
+HTTPS_PORT = 443
+POOL_SIZE = 2  # long-lived TCP/TLS/HTTPS connections per server; queries are pipelined or multiplexed on them
+TRANSPORTS = ('udp', 'tcp', 'tls', 'https')
+# Adaptive timeouts: the timeout of a UDP try follows the server's smoothed RTT like TCP's RTO (RFC 6298),
+# starting at TIMEOUT and doubling on every retry
+MIN_TIMEOUT = 0.2  # lowest timeout of a try, however fast the server answered so far
+RTT_ALPHA = 1 / 8  # weight of a new RTT sample in the smoothed RTT
+RTT_BETA = 1 / 4  # weight of a new sample in the RTT variation
+RETRY_BUDGET_RATIO = 0.2  # retries earned per query, so retries stay a bounded share of the traffic
+RETRY_BUDGET_PER_SECOND = 10  # retries earned per second regardless of traffic, so slow loops can retry too
+RETRY_BUDGET_BURST = 20  # retries a server can spend at once
+BREAKER_FAILURES = 5  # failed queries in a row that take a server out of use...
+BREAKER_SILENCE = 2.0  # ...if it hasn't answered anything for this many seconds either
+BREAKER_COOLDOWN = 1.0  # seconds before the first probe of a server taken out of use, doubled per failed probe
+BREAKER_MAX_COOLDOWN = 60.0
+
+# Outcome of a query: the parsed response, the time from sending it to the answer, how many tries it took,
+# and the time spent setting up the connection it went out on (0 when a pooled connection was reused)
+QueryResult = collections.namedtuple('QueryResult', ['response', 'latency', 'tries', 'setup'], defaults=(0.0,))
+# Answer bytes of a query before parsing, with the timing of QueryResult and the seconds spent handing the
+# query to the socket
+RawAnswer = collections.namedtuple('RawAnswer', ['data', 'latency', 'tries', 'setup', 'send'])
+# How to reach a DNS server; port is None when the entry doesn't name one
+ServerAddress = collections.namedtuple('ServerAddress', ['transport', 'host', 'port', 'url'])
+
+
+# Timeout of a query, telling how many tries it made
+class QueryTimeout(dns.exception.Timeout):
+    supp_kwargs = {'timeout', 'tries'}
+    fmt = "The DNS operation timed out after {timeout:.3f} seconds and {tries} tries"
+
+
+# Query not sent because its server failed repeatedly and is waiting to be probed again
+class ServerUnavailable(dns.exception.DNSException):
+    supp_kwargs = {'server', 'retry_in'}
+    fmt = "DNS server {server} is unavailable, probing it again in {retry_in:.1f} seconds"
+
+
+# Parse a DNS server entry: a plain address for UDP, or a URL such as tcp://9.9.9.9, tls://1.1.1.1:853
+# or https://dns.google/dns-query
+@functools.lru_cache(maxsize=1024)
+def parse_server(server):
+    if '://' not in server:
+        return ServerAddress('udp', server, None, None)
+    parts = urllib.parse.urlsplit(server)
+    transport = parts.scheme.lower()
+    if transport not in TRANSPORTS or not parts.hostname:
+        raise ValueError(f"Unsupported DNS server entry: {server}")
+    if transport == 'https':
+        return ServerAddress(transport, parts.hostname, parts.port or HTTPS_PORT,
+                             urllib.parse.urlunsplit(parts._replace(scheme=transport, path=parts.path or '/dns-query')))
+    return ServerAddress(transport, parts.hostname, parts.port or (TLS_PORT if transport == 'tls' else None), None)
+
+
+# Host of a DNS server entry, e.g. for pinging it
+def server_host(server):
+    return parse_server(server).host
+
+
+# Pre-serialized query for a name; only the two ID bytes at the front are patched per query
+@functools.lru_cache(maxsize=8192)
+def query_template(domain, rdtype='A', want_dnssec=False):
+    if want_dnssec:
+        query = dns.message.make_query(domain, rdtype, want_dnssec=True, payload=EDNS_PAYLOAD)
+    else:
+        query = dns.message.make_query(domain, rdtype)
+    query.id = 0
+    return query.to_wire()
+
+
+# Offset where the question section of a query template ends, used to check that an answer belongs to it
+def question_end(template):
+    # Header is 12 bytes; the question is the QNAME labels followed by QTYPE and QCLASS
+    offset = 12
+    while template[offset] != 0:
+        offset += template[offset] + 1
+    return offset + 5
+
+
+# First address of the given type in the answer section, or None
+def first_address(response, rdtype='A'):
+    rdtype = dns.rdatatype.RdataType.make(rdtype)
+    for rrset in response.answer:
+        if rrset.rdtype == rdtype and len(rrset) > 0:
+            return rrset[0].to_text()
+    return None
+
+
+# Whether a response carries an answer of the given type, the same cases dnspython's resolve() accepts
+def has_answer(response, rdtype='A'):
+    return response.rcode() == dns.rcode.NOERROR and first_address(response, rdtype) is not None
+
+
+# One long-lived UDP socket towards a DNS server, matching answers to queries by transaction ID
+class ServerChannel(asyncio.DatagramProtocol):
+    def __init__(self, max_outstanding):
+        self.transport = None
+        self.pending = {}  # transaction ID -> (future, question section bytes)
+        self.slots = asyncio.Semaphore(max_outstanding)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        received = time.perf_counter_ns()
+        if len(data) < 12:
+            return
+        entry = self.pending.get(struct.unpack('!H', data[:2])[0])
+        if entry is None:
+            return
+        future, question = entry
+        # Ignore answers whose question doesn't match, they are late or spoofed
+        if data[12:12 + len(question)].lower() != question.lower() or future.done():
+            return
+        future.set_result((data, received))
+
+    def error_received(self, exc):
+        # ICMP errors (port unreachable etc.) are not tied to a query; those time out instead
+        pass
+
+    def connection_lost(self, exc):
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("DNS socket closed"))
+        self.pending.clear()
+
+
+# Unused random transaction ID among the pending queries of a socket or connection
+def unused_id(pending):
+    while True:
+        query_id = random.getrandbits(16)
+        if query_id not in pending:
+            return query_id
+
+
+# TLS client context that offers each server its last session again, so reconnects skip the full handshake
+class ResumingTLSContext(ssl.SSLContext):
+    def __new__(cls):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self):
+        self.sessions = {}  # server name -> ssl.SSLSession
+        self.load_default_certs()
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname,
+                                session=session or self.sessions.get(server_hostname))
+
+
+# One TCP or TLS connection to a DNS server; queries are pipelined on it and answers matched by ID (RFC 7766)
+class StreamConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}  # transaction ID -> (future, question section bytes)
+        self.closed = False
+        self.reading = asyncio.ensure_future(self.read_answers())
+
+    async def read_answers(self):
+        error = None
+        try:
+            while True:
+                length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+                data = await self.reader.readexactly(length)
+                received = time.perf_counter_ns()
+                entry = self.pending.get(struct.unpack('!H', data[:2])[0]) if len(data) >= 12 else None
+                if entry is None:
+                    continue
+                future, question = entry
+                if data[12:12 + len(question)].lower() == question.lower() and not future.done():
+                    future.set_result((data, received))
+        except (asyncio.IncompleteReadError, OSError) as e:
+            error = e
+        finally:
+            # Servers close idle connections; queries still waiting are retried on a new one
+            self.closed = True
+            for future, _ in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"DNS connection closed: {error}"))
+            self.writer.close()
+
+    def send(self, template, question):
+        if self.closed:
+            raise ConnectionError("DNS connection closed")
+        query_id = unused_id(self.pending)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[query_id] = (future, question)
+        wire = struct.pack('!H', query_id) + template[2:]
+        self.writer.write(struct.pack('!H', len(wire)) + wire)
+        return query_id, future
+
+    def release(self, query_id):
+        future, _ = self.pending.pop(query_id)
+        if not future.done():
+            future.cancel()
+
+    def close(self):
+        self.reading.cancel()
+        self.writer.close()
+
+
+# Long-lived TCP or TLS connections to one server, opened on demand up to a limit and replaced once closed
+class StreamPool:
+    def __init__(self, host, port, tls_context=None, size=POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.tls_context = tls_context
+        self.size = size
+        self.connections = []  # futures resolving to StreamConnections
+        self.last_tls = None  # SSLObject of the newest connection, whose session the next one resumes
+
+    # An open connection to send on right away, or None when the query has to wait for one being set up
+    def ready_connection(self):
+        self.connections = [connection for connection in self.connections
+                            if not connection.done() or (not connection.cancelled() and connection.exception() is None
+                                                         and not connection.result().closed)]
+        ready = [connection.result() for connection in self.connections if connection.done()]
+        idle = [connection for connection in ready if not connection.pending]
+        if idle:
+            return idle[0]
+        if ready and len(self.connections) >= self.size:
+            return min(ready, key=lambda connection: len(connection.pending))
+        return None
+
+    # Future of a connection being set up: a new one if the pool has room, otherwise one already opening
+    def opening_connection(self):
+        if len(self.connections) >= self.size:
+            return next(connection for connection in self.connections if not connection.done())
+        opening = asyncio.ensure_future(self.open())
+        opening.add_done_callback(self.forget_failed)
+        self.connections.append(opening)
+        return opening
+
+    def forget_failed(self, opening):
+        if (opening.cancelled() or opening.exception() is not None) and opening in self.connections:
+            self.connections.remove(opening)
+
+    async def open(self):
+        if self.tls_context is not None and self.last_tls is not None and self.last_tls.session is not None:
+            self.tls_context.sessions[self.host] = self.last_tls.session
+        reader, writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.tls_context, server_hostname=self.host if self.tls_context else None)
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.tls_context is not None:
+            self.last_tls = writer.get_extra_info('ssl_object')
+        return StreamConnection(reader, writer)
+
+    def close(self):
+        for connection in self.connections:
+            if connection.done() and not connection.cancelled() and connection.exception() is None:
+                connection.result().close()
+            else:
+                connection.cancel()
+        self.connections = []
+
+
+# Import httpx on first use, so UDP, TCP and TLS queries don't pay for loading it
+def load_httpx():
+    global httpx
+    if httpx is None:
+        try:
+            import httpx as module
+        except ImportError:
+            raise ImportError("DNS over HTTPS needs httpx with HTTP/2 support (pip install 'httpx[http2]')")
+        httpx = module
+    return httpx
+
+
+# DNS over HTTPS (RFC 8484) towards one URL: HTTP/2 connections kept open, queries multiplexed on them
+class HttpsChannel:
+    # Connection events whose time counts as setup rather than query time
+    SETUP_EVENTS = ('connection.connect_tcp', 'connection.start_tls', 'http2.send_connection_init')
+
+    def __init__(self, url, tls_context, timeout):
+        load_httpx()
+        self.url = url
+        self.client = httpx.AsyncClient(
+            http2=True, verify=tls_context, timeout=timeout,
+            limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE,
+                                keepalive_expiry=None))
+
+    # Answer bytes and the seconds this query spent setting up a connection
+    async def exchange(self, template):
+        setup = {}
+
+        async def trace(event, info):
+            name, _, stage = event.rpartition('.')
+            if name in self.SETUP_EVENTS:
+                setup[name] = time.perf_counter_ns() - setup[name] if stage != 'started' else time.perf_counter_ns()
+
+        # Transaction ID 0 as RFC 8484 recommends, so answers are cacheable
+        response = await self.client.post(self.url, content=template, extensions={'trace': trace},
+                                          headers={'content-type': 'application/dns-message',
+                                                   'accept': 'application/dns-message'})
+        response.raise_for_status()
+        return response.content, sum(setup.values()) / 1e9
+
+    async def close(self):
+        await self.client.aclose()
+
+
+# How one server has been doing: its retransmission timeout from the RTTs of answered queries, a retry budget
+# refilled by every query and over time, and a circuit breaker. After BREAKER_FAILURES failures in a row and
+# BREAKER_SILENCE seconds without an answer (failed queries of a lossy server come in bursts, while its answers
+# keep coming) the breaker opens and queries fail right away; once the cooldown is over one probe query goes
+# out, closing the breaker if it's answered and doubling the cooldown if not.
+class ServerHealth:
+    def __init__(self, timeout, max_timeout):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = timeout
+        self.max_timeout = max_timeout
+        self.retry_tokens = RETRY_BUDGET_BURST
+        self.tokens_updated = None
+        self.failures = 0
+        self.last_answer = None
+        self.cooldown = BREAKER_COOLDOWN
+        self.reopen_at = None  # while the breaker is open, when the next probe may go out
+        self.probe_started = None  # send time of the probe in flight
+
+    # Whether a query may go out now; while the breaker is open, only one probe at a time after the cooldown
+    def allow(self, now):
+        if self.reopen_at is None:
+            return True
+        if now < self.reopen_at:
+            return False
+        # A probe that never came back (cancelled with its caller) doesn't block the next one forever
+        if self.probe_started is not None and now - self.probe_started < self.max_timeout:
+            return False
+        self.probe_started = now
+        return True
+
+    def retry_in(self, now):
+        return max(self.reopen_at - now, 0.0)
+
+    def sent(self):
+        self.retry_tokens = min(RETRY_BUDGET_BURST, self.retry_tokens + RETRY_BUDGET_RATIO)
+
+    def take_retry(self, now):
+        if self.tokens_updated is not None:
+            self.retry_tokens = min(RETRY_BUDGET_BURST,
+                                    self.retry_tokens + (now - self.tokens_updated) * RETRY_BUDGET_PER_SECOND)
+        self.tokens_updated = now
+        if self.retry_tokens < 1:
+            return False
+        self.retry_tokens -= 1
+        return True
+
+    # Timeout of a try, doubled for every retry
+    def try_timeout(self, tries):
+        return min(self.rto * 2 ** (tries - 1), self.max_timeout)
+
+    def answered(self, now, rtt, tries):
+        # Only first tries give RTT samples: an answer after a retry may belong to either try (Karn's algorithm)
+        if tries == 1:
+            if self.srtt is None:
+                self.srtt, self.rttvar = rtt, rtt / 2
+            else:
+                self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+                self.srtt += RTT_ALPHA * (rtt - self.srtt)
+            self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_TIMEOUT), self.max_timeout)
+        self.failures = 0
+        self.last_answer = now
+        if self.reopen_at is not None:
+            self.reopen_at = self.probe_started = None
+            self.cooldown = BREAKER_COOLDOWN
+
+    # A failed query; queries sent before the breaker opened don't count as failed probes
+    def failed(self, now, probe=False):
+        self.failures += 1
+        if probe:
+            self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+            self.reopen_at, self.probe_started = now + self.cooldown, None
+        elif self.reopen_at is None and self.failures >= BREAKER_FAILURES and \
+                (self.last_answer is None or now - self.last_answer >= BREAKER_SILENCE):
+            self.reopen_at = now + self.cooldown
+
+
+# Shared low-level query engine: one UDP socket per server with many outstanding queries on it, and pooled
+# long-lived connections for servers reached over TCP, TLS (DoT) or HTTPS (DoH).
+# With metrics (a dns_metrics.QueryMetrics), the outcome and time breakdown of every query is recorded.
+# With adaptive, every server gets a ServerHealth: UDP tries time out after its RTO instead of the fixed
+# timeout, retries draw on its retry budget, and a server failing repeatedly is skipped (ServerUnavailable)
+# until a probe gets an answer again.
+class QueryEngine:
+    def __init__(self, timeout=TIMEOUT, retries=RETRIES, lifetime=LIFETIME, port=DNS_PORT,
+                 max_outstanding=MAX_OUTSTANDING, pool_size=POOL_SIZE, metrics=None, adaptive=True):
+        self.timeout = timeout
+        self.retries = retries
+        self.lifetime = lifetime
+        self.port = port  # for UDP and TCP servers whose entry doesn't name a port
+        self.max_outstanding = max_outstanding
+        self.pool_size = pool_size
+        self.channels = {}  # (host, port) -> future resolving to its ServerChannel
+        self.pools = {}  # (transport, host, port) -> StreamPool
+        self.https_channels = {}  # URL -> HttpsChannel
+        self.tls_context = None
+        self.metrics = metrics
+        self.adaptive = adaptive
+        self.health = {}  # server entry -> ServerHealth
+
+    async def channel(self, host, port):
+        channel = self.channels.get((host, port))
+        if channel is None:
+            # Store the future right away so concurrent first queries share one socket
+            channel = asyncio.ensure_future(self.open_channel(host, port))
+            self.channels[host, port] = channel
+        try:
+            return await asyncio.shield(channel)
+        except Exception:
+            self.channels.pop((host, port), None)
+            raise
+
+    async def open_channel(self, host, port):
+        loop = asyncio.get_running_loop()
+        _, protocol = await loop.create_datagram_endpoint(
+            lambda: ServerChannel(self.max_outstanding), remote_addr=(host, port))
+        return protocol
+
+    def client_tls_context(self):
+        if self.tls_context is None:
+            self.tls_context = ResumingTLSContext()
+        return self.tls_context
+
+    def stream_pool(self, transport, host, port):
+        pool = self.pools.get((transport, host, port))
+        if pool is None:
+            tls_context = self.client_tls_context() if transport == 'tls' else None
+            pool = self.pools[transport, host, port] = StreamPool(host, port, tls_context, self.pool_size)
+        return pool
+
+    def server_health(self, server):
+        health = self.health.get(server)
+        if health is None:
+            health = self.health[server] = ServerHealth(self.timeout, self.lifetime)
+        return health
+
+    # Send a query to a server entry (see parse_server) and wait for the answer
+    async def query(self, server, domain, rdtype='A', want_dnssec=False):
+        started = time.perf_counter_ns()
+        address = parse_server(server)
+        template = query_template(domain, rdtype, want_dnssec)
+        encoded = time.perf_counter_ns()
+        health = self.server_health(server) if self.adaptive else None
+        if health is not None:
+            if not health.allow(encoded / 1e9):
+                if self.metrics is not None:
+                    self.metrics.record(server, 'unavailable', ((encoded - started) / 1e9,))
+                raise ServerUnavailable(server=server, retry_in=health.retry_in(encoded / 1e9))
+            health.sent()
+            probe = health.reopen_at is not None
+        try:
+            if address.transport == 'udp':
+                answer = await self.query_udp(address.host, address.port or self.port, template, health)
+            elif address.transport == 'https':
+                answer = await self.query_https(address.url, template)
+            else:
+                data, sent, received, setup, tries, send = await self.exchange_stream(
+                    address.transport, address.host, address.port or self.port, template,
+                    encoded + int(self.lifetime * 1e9))
+                answer = RawAnswer(data, (received - sent + send) / 1e9, tries, setup, send / 1e9)
+            answered = time.perf_counter_ns()
+            response = dns.message.from_wire(answer.data)
+        except Exception as e:
+            # Only silence and broken connections count against a server; any answer shows it's up
+            if health is not None and isinstance(e, (dns.exception.Timeout, OSError)):
+                health.failed(time.perf_counter_ns() / 1e9, probe)
+            if self.metrics is not None:
+                tries = e.kwargs['tries'] if isinstance(e, QueryTimeout) else 1
+                # Time up to the failure counts as waiting, so timeouts show in the wait times
+                self.metrics.record(server, outcome_of(error=e), ((encoded - started) / 1e9, None, None,
+                                                                  (time.perf_counter_ns() - encoded) / 1e9), tries)
+            raise
+        if health is not None:
+            health.answered(answered / 1e9, answer.latency, answer.tries)
+        if self.metrics is not None:
+            self.metrics.record(server, outcome_of(response.rcode()),
+                                ((encoded - started) / 1e9, answer.setup, answer.send, answer.latency - answer.send,
+                                 (time.perf_counter_ns() - answered) / 1e9), answer.tries)
+        return QueryResult(response, answer.latency, answer.tries, answer.setup)
+
+    # Query over UDP, retrying on timeout and falling back to TCP on truncation. With a ServerHealth, tries
+    # time out after its RTO and retries need its retry budget.
+    async def query_udp(self, host, port, template, health=None):
+        question = template[12:question_end(template)]
+        channel = await self.channel(host, port)
+        loop = asyncio.get_running_loop()
+
+        async with channel.slots:
+            query_id = unused_id(channel.pending)
+            wire = struct.pack('!H', query_id) + template[2:]
+            future = loop.create_future()
+            channel.pending[query_id] = (future, question)
+            started = time.perf_counter_ns()
+            deadline = started + int(self.lifetime * 1e9)
+            tries = 0
+            send = 0
+            try:
+                while True:
+                    tries += 1
+                    sending = time.perf_counter_ns()
+                    channel.transport.sendto(wire)
+                    send += time.perf_counter_ns() - sending
+                    remaining = (deadline - time.perf_counter_ns()) / 1e9
+                    if health is None:
+                        timeout = self.timeout
+                    elif tries <= self.retries:
+                        timeout = health.try_timeout(tries)
+                    else:
+                        # The RTO only decides when to send again; after the last try, wait out the lifetime
+                        timeout = remaining
+                    try:
+                        data, received = await asyncio.wait_for(asyncio.shield(future),
+                                                                min(timeout, max(remaining, 0)))
+                        break
+                    except asyncio.TimeoutError:
+                        # Out of retry budget the query fails right away, rather than holding its slot
+                        if tries > self.retries or time.perf_counter_ns() >= deadline or \
+                                (health is not None and not health.take_retry(time.perf_counter_ns() / 1e9)):
+                            raise QueryTimeout(timeout=(time.perf_counter_ns() - started) / 1e9, tries=tries)
+            finally:
+                del channel.pending[query_id]
+                if not future.done():
+                    future.cancel()
+
+        # The TC bit is checked on the raw header, so truncated answers are never parsed
+        if data[2] & 0x02:
+            data, _, received, setup, _, stream_send = await self.exchange_stream('tcp', host, port, template,
+                                                                                 deadline)
+            return RawAnswer(data, (received - started) / 1e9 - setup, tries, setup, (send + stream_send) / 1e9)
+        return RawAnswer(data, (received - started) / 1e9, tries, 0.0, send / 1e9)
+
+    # Query over a pooled TCP or TLS connection. A connection the server closed before answering (idle
+    # timeouts are common) is replaced and the query sent again.
+    # Returns (answer bytes, send time, answer time, setup seconds, tries, nanoseconds spent sending).
+    async def exchange_stream(self, transport, host, port, template, deadline):
+        pool = self.stream_pool(transport, host, port)
+        question = template[12:question_end(template)]
+        setup = 0.0
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                # Sending right after picking the connection, so concurrent queries see it as busy
+                connection = pool.ready_connection()
+                if connection is None:
+                    waiting = time.perf_counter_ns()
+                    connection = await asyncio.wait_for(asyncio.shield(pool.opening_connection()),
+                                                        self.remaining(deadline))
+                    setup += (time.perf_counter_ns() - waiting) / 1e9
+                sending = time.perf_counter_ns()
+                query_id, future = connection.send(template, question)
+                sent = time.perf_counter_ns()
+                try:
+                    data, received = await asyncio.wait_for(asyncio.shield(future), self.remaining(deadline))
+                finally:
+                    connection.release(query_id)
+                return data, sent, received, setup, tries, sent - sending
+            except asyncio.TimeoutError:
+                raise QueryTimeout(timeout=self.lifetime, tries=tries)
+            except OSError:
+                if tries > self.retries or time.perf_counter_ns() >= deadline:
+                    raise
+
+    def remaining(self, deadline):
+        return max((deadline - time.perf_counter_ns()) / 1e9, 0)
+
+    async def query_https(self, url, template):
+        channel = self.https_channels.get(url)
+        if channel is None:
+            channel = self.https_channels[url] = HttpsChannel(url, self.client_tls_context(), self.lifetime)
+        started = time.perf_counter_ns()
+        try:
+            data, setup = await asyncio.wait_for(channel.exchange(template), self.lifetime)
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            raise QueryTimeout(timeout=self.lifetime, tries=1)
+        except httpx.HTTPError as e:
+            raise ConnectionError(f"DNS over HTTPS query to {url} failed: {e}")
+        received = time.perf_counter_ns()
+        # Sending and waiting can't be told apart inside the HTTP client, so all of it counts as waiting
+        return RawAnswer(data, (received - started) / 1e9 - setup, 1, setup, 0.0)
+
+    async def close(self):
+        for channel in self.channels.values():
+            if channel.done() and not channel.cancelled() and channel.exception() is None:
+                channel.result().transport.close()
+        self.channels.clear()
+        for pool in self.pools.values():
+            pool.close()
+        self.pools.clear()
+        for channel in self.https_channels.values():
+            await channel.close()
+        self.https_channels.clear()
+
+
+# QueryEngine for blocking code: the engine runs on its own event loop in a background thread
+class BlockingQueryEngine:
+    def __init__(self, **engine_options):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.engine = QueryEngine(**engine_options)
+
+    def query(self, server, domain, rdtype='A', want_dnssec=False):
+        return asyncio.run_coroutine_threadsafe(
+            self.engine.query(server, domain, rdtype, want_dnssec), self.loop).result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.engine.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+_shared_engine = None
+_shared_engine_lock = threading.Lock()
+
+
+# Process-wide BlockingQueryEngine, so sockets are reused across calls from blocking code
+def shared_blocking_engine():
+    global _shared_engine
+    with _shared_engine_lock:
+        if _shared_engine is None:
+            _shared_engine = BlockingQueryEngine()
+        return _shared_engine
@@ -0,0 +1,275 @@
+import hashlib
+import json
+import os
+import numpy as np
+from dns_results_store import ResultsStore, UNAVAILABLE
+from dns_latency_stats import format_table
+
+# Bit planes of the matrix, one bit per domain and server each; a pair that wasn't tested has no bit set.
+# BLOCKED is any answer without a usable address, ERROR a server that couldn't be asked (out of use).
+RESOLVED, BLOCKED, ERROR = range(3)
+PLANES = 3
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)  # set bits per byte
+FETCH_ROWS = 100000  # results read from the store at once
+REPORT_DOMAINS = 10  # domains listed per server in the printed reports
+
+
+# 64-bit key of a domain, used to line up the domains of different runs
+def domain_hash(domain):
+    return int.from_bytes(hashlib.blake2b(domain.lower().encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def bit_count(row):
+    return int(POPCOUNT[row].sum(dtype=np.int64))
+
+
+# Column numbers of the set bits of a packed row
+def bit_positions(row, size):
+    return np.flatnonzero(np.unpackbits(row, count=size))
+
+
+# Results of one run as packed bits: bits[plane, server] is a row of one bit per domain, in the run's sampling
+# order (a column per domain). The arrays are memory-mapped from the matrix directory, so only the rows a
+# report touches are read, and domain names are looked up by line offset.
+class ResultMatrix:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        self.run_id = meta['run_id']
+        self.servers = meta['servers']
+        self.size = meta['domains']
+        self.bits = np.load(os.path.join(directory, 'bits.npy'), mmap_mode='r')
+        # Domain hashes in ascending order, and the column of each
+        self.hashes = np.load(os.path.join(directory, 'hashes.npy'), mmap_mode='r')
+        self.order = np.load(os.path.join(directory, 'order.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r')
+        self.domains_file = open(os.path.join(directory, 'domains.txt'), 'rb')
+
+    def close(self):
+        self.domains_file.close()
+
+    def domain(self, column):
+        self.domains_file.seek(int(self.offsets[column]))
+        return self.domains_file.readline().decode('utf-8').rstrip('\n')
+
+    def row(self, plane, server):
+        return np.asarray(self.bits[plane, self.servers.index(server)])
+
+    # Domains resolved by at least one server; like print_dns_stats, only these count as blocked anywhere
+    def active(self):
+        return np.bitwise_or.reduce(np.asarray(self.bits[RESOLVED]), axis=0)
+
+    # Blocked rows of all servers, limited to active domains
+    def blocked(self):
+        return np.asarray(self.bits[BLOCKED]) & self.active()
+
+
+# Build the matrix of a run of the store into directory, and open it
+def build_matrix(store, run_id, directory):
+    store.flush()
+    os.makedirs(directory, exist_ok=True)
+    servers = store.run_servers(run_id)
+    server_index = {server: index for index, server in enumerate(servers)}
+
+    # Domain names in column order, with their offsets, hashes and positions in the run
+    positions = []
+    hashes = []
+    offsets = []
+    offset = 0
+    with open(os.path.join(directory, 'domains.txt'), 'wb') as file:
+        for position, domain in store.connection.execute(
+                'SELECT position, domain FROM run_domains WHERE run_id = ? ORDER BY position', (run_id,)):
+            line = domain.encode('utf-8') + b'\n'
+            file.write(line)
+            positions.append(position)
+            offsets.append(offset)
+            offset += len(line)
+            hashes.append(domain_hash(domain))
+    size = len(hashes)
+    hashes = np.array(hashes, dtype=np.uint64)
+    # Merged shards leave gaps between positions, so a domain's column is the rank of its position
+    positions = np.array(positions, dtype=np.int64)
+    bits = np.zeros((PLANES, len(servers), (size + 7) // 8), dtype=np.uint8)
+    cursor = store.connection.execute(
+        'SELECT d.position, r.server, r.resolved FROM run_domains d '
+        'JOIN results r ON r.run_id = d.run_id AND r.domain = d.domain WHERE d.run_id = ?', (run_id,))
+    while True:
+        rows = cursor.fetchmany(FETCH_ROWS)
+        if not rows:
+            break
+        position, server, resolved = zip(*rows)
+        column = np.searchsorted(positions, np.array(position, dtype=np.int64))
+        server = np.array([server_index[name] for name in server], dtype=np.int64)
+        resolved = np.array(resolved, dtype=np.int64)
+        plane = np.where(resolved == UNAVAILABLE, ERROR, np.where(resolved != 0, RESOLVED, BLOCKED))
+        np.bitwise_or.at(bits, (plane, server, column >> 3), (0x80 >> (column & 7)).astype(np.uint8))
+
+    np.save(os.path.join(directory, 'bits.npy'), bits)
+    order = np.argsort(hashes, kind='stable')
+    np.save(os.path.join(directory, 'hashes.npy'), hashes[order])
+    np.save(os.path.join(directory, 'order.npy'), order)
+    np.save(os.path.join(directory, 'offsets.npy'), np.array(offsets, dtype=np.uint64))
+    # The metadata goes last, so a matrix without it is an unfinished build
+    with open(os.path.join(directory, 'meta.json'), 'w') as file:
+        json.dump({'run_id': run_id, 'servers': servers, 'domains': size}, file, indent=1)
+    return ResultMatrix(directory)
+
+
+# Matrix of a run, kept under matrix_dir; finished runs are built once, unfinished ones every time
+def matrix_for_run(store, run_id, matrix_dir):
+    directory = os.path.join(matrix_dir, f'run-{run_id}')
+    finished = store.run_info(run_id)[3] is not None
+    if finished and os.path.exists(os.path.join(directory, 'meta.json')):
+        return ResultMatrix(directory)
+    if os.path.exists(os.path.join(directory, 'meta.json')):
+        os.remove(os.path.join(directory, 'meta.json'))
+    return build_matrix(store, run_id, directory)
+
+
+# Per server, the active domains it blocks and no other server does, as packed rows
+def unique_blocks(matrix):
+    blocked = matrix.blocked()
+    # Blocks of the servers before and after each one, so every server takes two ORs instead of one per server
+    before = np.zeros_like(blocked)
+    after = np.zeros_like(blocked)
+    for index in range(1, len(blocked)):
+        before[index] = before[index - 1] | blocked[index - 1]
+    for index in range(len(blocked) - 2, -1, -1):
+        after[index] = after[index + 1] | blocked[index + 1]
+    return {server: blocked[index] & ~(before[index] | after[index]) for index, server in enumerate(matrix.servers)}
+
+
+# Pairwise blocked domains in common and Jaccard index (common / blocked by either) of the servers
+def blocking_overlap(matrix):
+    blocked = matrix.blocked()
+    counts = [bit_count(row) for row in blocked]
+    common = np.zeros((len(blocked), len(blocked)), dtype=np.int64)
+    jaccard = np.ones((len(blocked), len(blocked)))
+    for first in range(len(blocked)):
+        common[first, first] = counts[first]
+        for second in range(first + 1, len(blocked)):
+            both = bit_count(blocked[first] & blocked[second])
+            either = counts[first] + counts[second] - both
+            common[first, second] = common[second, first] = both
+            jaccard[first, second] = jaccard[second, first] = both / either if either else 1.0
+    return common, jaccard
+
+
+# Active domains blocked by any server, and the blocked count and share of that union per server
+def blocking_coverage(matrix):
+    blocked = matrix.blocked()
+    union = bit_count(np.bitwise_or.reduce(blocked, axis=0)) if len(blocked) else 0
+    coverage = {}
+    for server, row in zip(matrix.servers, blocked):
+        count = bit_count(row)
+        coverage[server] = (count, count / union if union else 0.0)
+    return union, coverage
+
+
+# Changes per server between two runs, on the domains both runs tested: domains blocked now that the server
+# resolved before, and domains it resolves now that it blocked before. Returns server -> (newly blocked,
+# unblocked) columns of the current run.
+def diff_runs(previous, current):
+    # Line up the columns of both runs by domain hash
+    previous_hashes = np.asarray(previous.hashes)
+    current_hashes = np.asarray(current.hashes)
+    found = np.searchsorted(previous_hashes, current_hashes)
+    found[found == len(previous_hashes)] = 0
+    matched = (previous_hashes[found] == current_hashes if len(previous_hashes)
+               else np.zeros(current.size, dtype=bool))
+    current_columns = np.asarray(current.order)[matched]
+    previous_columns = np.asarray(previous.order)[found[matched]]
+
+    def aligned(matrix, row, columns):
+        return np.unpackbits(row, count=matrix.size)[columns].astype(bool)
+
+    current_active = aligned(current, current.active(), current_columns)
+    previous_active = aligned(previous, previous.active(), previous_columns)
+    changes = {}
+    for server in current.servers:
+        if server not in previous.servers:
+            continue
+        blocked_now = aligned(current, current.row(BLOCKED, server), current_columns) & current_active
+        resolved_now = aligned(current, current.row(RESOLVED, server), current_columns)
+        blocked_before = aligned(previous, previous.row(BLOCKED, server), previous_columns) & previous_active
+        resolved_before = aligned(previous, previous.row(RESOLVED, server), previous_columns)
+        changes[server] = (current_columns[blocked_now & resolved_before],
+                           current_columns[resolved_now & blocked_before])
+    return changes
+
+
+def domain_sample(matrix, columns):
+    names = [matrix.domain(column) for column in columns[:REPORT_DOMAINS]]
+    return ', '.join(names) + (', ...' if len(columns) > REPORT_DOMAINS else '')
+
+
+# Print the cross-server blocking reports of a run, and its changes since previous (another ResultMatrix)
+def print_blocking_report(matrix, previous=None):
+    active = bit_count(matrix.active())
+    print(f"\nBlocking report of run {matrix.run_id}: {matrix.size} domains, {active} active")
+
+    union, coverage = blocking_coverage(matrix)
+    print()
+    print(format_table(f"Coverage of the {union} domains blocked by any server:", ['server', 'blocked', 'coverage'],
+                       [[server, count, f'{share:.1%}'] for server, (count, share) in coverage.items()]))
+
+    common, jaccard = blocking_overlap(matrix)
+    columns = ['server'] + [f'#{index + 1}' for index in range(len(matrix.servers))]
+    print()
+    print(format_table("Blocked domains in common (Jaccard index):", columns,
+                       [[f'#{first + 1} {server}'] + [f'{common[first, second]} ({jaccard[first, second]:.2f})'
+                                                     for second in range(len(matrix.servers))]
+                        for first, server in enumerate(matrix.servers)]))
+
+    print("\nDomains only one server blocks:")
+    for server, row in unique_blocks(matrix).items():
+        unique = bit_positions(row, matrix.size)
+        print(f"{server}: {len(unique)}" + (f" ({domain_sample(matrix, unique)})" if len(unique) else ''))
+
+    if previous is not None:
+        print(f"\nChanges since run {previous.run_id}:")
+        for server, (newly_blocked, unblocked) in diff_runs(previous, matrix).items():
+            print(f"{server}: {len(newly_blocked)} newly BLOCKED, {len(unblocked)} no longer blocked")
+            if len(newly_blocked):
+                print(f"  newly blocked: {domain_sample(matrix, newly_blocked)}")
+            if len(unblocked):
+                print(f"  no longer blocked: {domain_sample(matrix, unblocked)}")
+
+
+# Export the domains only one server blocks, as server,domain rows
+def export_unique_blocks(matrix, csv_output_file):
+    with open(csv_output_file, 'w') as file:
+        file.write('server,domain\n')
+        for server, row in unique_blocks(matrix).items():
+            for column in bit_positions(row, matrix.size):
+                file.write(f'{server},{matrix.domain(column)}\n')
+
+
+# Build (or reuse) the matrices of a run and the previous finished run over the same domains, and print
+# the blocking report; the latest run by default. With unique_blocks_file, the domains only one server
+# blocks are exported there as well.
+def blocking_report(store_file, matrix_dir, run_id=None, unique_blocks_file=None):
+    store = ResultsStore(store_file)
+    try:
+        run_id = run_id or store.latest_run()
+        if run_id is None:
+            print("No runs in the results store.")
+            return
+        matrix = matrix_for_run(store, run_id, matrix_dir)
+        previous_run_id = store.previous_run(run_id)
+        previous = matrix_for_run(store, previous_run_id, matrix_dir) if previous_run_id is not None else None
+    finally:
+        store.close()
+    print_blocking_report(matrix, previous)
+    if unique_blocks_file is not None:
+        export_unique_blocks(matrix, unique_blocks_file)
+        print(f"\nExported the domains only one server blocks to {unique_blocks_file}")
+    matrix.close()
+    if previous is not None:
+        previous.close()
+
+
+if __name__ == "__main__":
+    from dnstk import script_main
+    script_main('blocking')
@@ -0,0 +1,240 @@
+import csv
+import datetime
+import itertools
+import sqlite3
+
+BATCH_SIZE = 500  # results written per transaction
+UNAVAILABLE = -1  # value of results.resolved when the server was out of use; such results are retried on resume
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    domains_file TEXT NOT NULL,
+    all_domains_count INTEGER NOT NULL,
+    started TEXT NOT NULL,
+    finished TEXT,
+    shard TEXT
+);
+CREATE TABLE IF NOT EXISTS run_domains (
+    run_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    domain TEXT NOT NULL,
+    PRIMARY KEY (run_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS run_servers (
+    run_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    server TEXT NOT NULL,
+    PRIMARY KEY (run_id, position),
+    UNIQUE (run_id, server)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL,
+    domain TEXT NOT NULL,
+    server TEXT NOT NULL,
+    resolved INTEGER NOT NULL,
+    tested TEXT NOT NULL,
+    PRIMARY KEY (run_id, domain, server)
+) WITHOUT ROWID;
+"""
+
+
+# Transactional store of scan results, keyed by (run, domain, server)
+class ResultsStore:
+    def __init__(self, path, batch_size=BATCH_SIZE):
+        self.connection = sqlite3.connect(path)
+        # WAL lets readers (exports, reports) run while a scan is writing
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.batch_size = batch_size
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    # Start a run over the given sample of domains and return its ID; shard is the 'i/N' spec of a sharded scan
+    def create_run(self, domains_file, all_domains_count, domains, shard=None):
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (domains_file, all_domains_count, started, shard) VALUES (?, ?, ?, ?)',
+                (domains_file, all_domains_count, now(), shard))
+            run_id = cursor.lastrowid
+            self.connection.executemany(
+                'INSERT INTO run_domains (run_id, position, domain) VALUES (?, ?, ?)',
+                ((run_id, position, domain) for position, domain in enumerate(domains, start=1)))
+        return run_id
+
+    # Most recent run over domains_file (and shard) that didn't finish, or None
+    def latest_unfinished_run(self, domains_file, shard=None):
+        row = self.connection.execute(
+            'SELECT run_id FROM runs WHERE domains_file = ? AND shard IS ? AND finished IS NULL '
+            'ORDER BY run_id DESC LIMIT 1', (domains_file, shard)).fetchone()
+        return row[0] if row else None
+
+    # Latest finished run before run_id over the same domains_file (and shard), or None
+    def previous_run(self, run_id):
+        row = self.connection.execute(
+            'SELECT p.run_id FROM runs p JOIN runs r ON p.domains_file = r.domains_file AND p.shard IS r.shard '
+            'WHERE r.run_id = ? AND p.run_id < r.run_id AND p.finished IS NOT NULL '
+            'ORDER BY p.run_id DESC LIMIT 1', (run_id,)).fetchone()
+        return row[0] if row else None
+
+    def latest_run(self):
+        row = self.connection.execute('SELECT MAX(run_id) FROM runs').fetchone()
+        return row[0]
+
+    def finish_run(self, run_id):
+        self.flush()
+        with self.connection:
+            self.connection.execute('UPDATE runs SET finished = ? WHERE run_id = ?', (now(), run_id))
+
+    def run_info(self, run_id):
+        return self.connection.execute(
+            'SELECT domains_file, all_domains_count, started, finished FROM runs WHERE run_id = ?',
+            (run_id,)).fetchone()
+
+    def run_shard(self, run_id):
+        return self.connection.execute('SELECT shard FROM runs WHERE run_id = ?', (run_id,)).fetchone()[0]
+
+    def run_domain_count(self, run_id):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM run_domains WHERE run_id = ?', (run_id,)).fetchone()[0]
+
+    # Register the servers of a run; servers added since the run started are appended
+    def add_run_servers(self, run_id, servers):
+        with self.connection:
+            for server in servers:
+                self.insert_run_server(run_id, server)
+
+    def insert_run_server(self, run_id, server):
+        self.connection.execute(
+            'INSERT OR IGNORE INTO run_servers (run_id, position, server) '
+            'SELECT ?, COALESCE(MAX(position), 0) + 1, ? FROM run_servers WHERE run_id = ?',
+            (run_id, server, run_id))
+
+    def run_servers(self, run_id):
+        return [row[0] for row in self.connection.execute(
+            'SELECT server FROM run_servers WHERE run_id = ? ORDER BY position', (run_id,))]
+
+    # Domains of a run still missing a result for some of the servers, in sampling order.
+    # Returns (position, domain, servers still to test, whether an earlier result already resolved it, servers
+    # among them being retried after an UNAVAILABLE result) tuples.
+    # SQLite finds the domains with a result from every server, streaming the results in primary key order,
+    # so only the domains still to test come back to Python.
+    def remaining(self, run_id, servers):
+        self.flush()
+        remaining = []
+        placeholders = ','.join('?' * len(servers))
+        tested = self.connection.execute(
+            f'SELECT d.position, d.domain, r.server, r.resolved FROM run_domains d '
+            f'LEFT JOIN results r ON r.run_id = d.run_id AND r.domain = d.domain '
+            f'WHERE d.run_id = ? AND d.domain NOT IN ('
+            f'SELECT domain FROM results WHERE run_id = ? AND resolved != ? AND server IN ({placeholders}) '
+            f'GROUP BY domain HAVING COUNT(*) = ?) ORDER BY d.position',
+            (run_id, run_id, UNAVAILABLE, *servers, len(set(servers))))
+        for (position, domain), rows in itertools.groupby(tested, key=lambda row: row[:2]):
+            done = {}
+            unavailable = set()
+            for _, _, server, resolved in rows:
+                if resolved == UNAVAILABLE:
+                    unavailable.add(server)
+                elif server is not None:
+                    done[server] = resolved
+            missing = [server for server in servers if server not in done]
+            if missing:
+                remaining.append((position, domain, missing, any(done.get(server) for server in servers),
+                                  [server for server in missing if server in unavailable]))
+        return remaining
+
+    # Per-server resolved/blocked counts and the number of resolvable domains recorded so far in a run.
+    # 'unavailable' counts the resolvable domains a server couldn't be asked about.
+    def run_stats(self, run_id, servers):
+        self.flush()
+        dns_stats = {server: {'resolved': 0, 'blocked': 0, 'unavailable': 0} for server in servers}
+        for server, resolved, count in self.connection.execute(
+                'SELECT server, resolved, COUNT(*) FROM results WHERE run_id = ? AND resolved != ? '
+                'GROUP BY server, resolved', (run_id, UNAVAILABLE)):
+            if server in dns_stats:
+                dns_stats[server]['resolved' if resolved else 'blocked'] += count
+        placeholders = ','.join('?' * len(servers))
+        for server, count in self.connection.execute(
+                f'SELECT r.server, COUNT(*) FROM results r WHERE r.run_id = ? AND r.resolved = ? AND EXISTS ('
+                f'SELECT 1 FROM results o WHERE o.run_id = r.run_id AND o.domain = r.domain AND o.resolved = 1 '
+                f'AND o.server IN ({placeholders})) GROUP BY r.server', (run_id, UNAVAILABLE, *servers)):
+            if server in dns_stats:
+                dns_stats[server]['unavailable'] += count
+        total_resolvable_domains = self.connection.execute(
+            f'SELECT COUNT(DISTINCT domain) FROM results WHERE run_id = ? AND resolved = 1 '
+            f'AND server IN ({placeholders})', (run_id, *servers)).fetchone()[0]
+        return dns_stats, total_resolvable_domains
+
+    # Copy a run of another store (a shard of a scan) into a run of this one, after the domains already in it
+    def import_run(self, source_file, source_run_id, run_id):
+        self.flush()
+        self.connection.execute('ATTACH DATABASE ? AS source', (source_file,))
+        try:
+            with self.connection:
+                offset = self.connection.execute(
+                    'SELECT COALESCE(MAX(position), 0) FROM run_domains WHERE run_id = ?', (run_id,)).fetchone()[0]
+                self.connection.execute(
+                    'INSERT INTO run_domains (run_id, position, domain) '
+                    'SELECT ?, position + ?, domain FROM source.run_domains WHERE run_id = ?',
+                    (run_id, offset, source_run_id))
+                servers = self.connection.execute(
+                    'SELECT server FROM source.run_servers WHERE run_id = ? ORDER BY position', (source_run_id,))
+                for (server,) in servers.fetchall():
+                    self.insert_run_server(run_id, server)
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO results (run_id, domain, server, resolved, tested) '
+                    'SELECT ?, domain, server, resolved, tested FROM source.results WHERE run_id = ?',
+                    (run_id, source_run_id))
+        finally:
+            self.connection.execute('DETACH DATABASE source')
+
+    # Queue the results of one domain (None for a server out of use); they are committed in batches
+    def record(self, run_id, domain, results):
+        tested = now()
+        self.buffer.extend((run_id, domain, server, UNAVAILABLE if resolved is None else int(resolved), tested)
+                           for server, resolved in results.items())
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO results (run_id, domain, server, resolved, tested) VALUES (?, ?, ?, ?, ?)',
+                self.buffer)
+        self.buffer = []
+
+    # Stream the results of a run as CSV rows (Domain, then True/False/unavailable per server), in sampling order
+    def iter_csv_rows(self, run_id):
+        self.flush()
+        servers = self.run_servers(run_id)
+        yield ['Domain'] + servers
+        rows = self.connection.execute(
+            'SELECT d.domain, r.server, r.resolved FROM run_domains d '
+            'JOIN results r ON r.run_id = d.run_id AND r.domain = d.domain '
+            'WHERE d.run_id = ? ORDER BY d.position', (run_id,))
+        for domain, domain_rows in itertools.groupby(rows, key=lambda row: row[0]):
+            resolved = {server: 'unavailable' if value == UNAVAILABLE else bool(value)
+                        for _, server, value in domain_rows}
+            yield [domain] + [resolved.get(server, '') for server in servers]
+
+
+def now():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Export a run of the store to a CSV file, streaming it row by row
+def export_csv(store, run_id, csv_output_file):
+    with open(csv_output_file, 'w', newline='') as csvfile:
+        csv.writer(csvfile).writerows(store.iter_csv_rows(run_id))
+
+
+if __name__ == "__main__":
+    from dnstk import script_main
+    script_main('export')
@@ -0,0 +1,337 @@
+import asyncio
+import hashlib
+import random
+import ssl
+import struct
+import threading
+import zlib
+import dns.dnssec
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rrset
+from dns_blocklist_ingest import DomainSet, is_domain_set, normalize_domain, parse_blocklist_line, read_source_lines
+
+TTL = 300
+CACHE_SIZE = 100000  # names remembered for simulated recursion before the cache starts over
+TYPE_A = 1
+TYPE_AAAA = 28
+TYPE_DS = 43
+TYPE_DNSKEY = 48
+STANDIN_PORT = 5300  # unprivileged, so stand-ins run without root; list them as udp://address:5300
+SIGNATURE_LIFETIME = 7 * 86400  # seconds signed answers stay valid; they are cached until the cache starts over
+# Rule actions that answer with an error code instead of an address
+ACTION_RCODES = {'nxdomain': 3, 'refused': 5, 'servfail': 2}
+FLAG_QR = 0x8000
+FLAG_OPCODE_RD = 0x7900  # opcode and RD bits, copied from the query
+FLAG_TC = 0x0200
+FLAG_RA = 0x0080
+FLAG_AD = 0x0020
+# Settings of a stand-in server; every server entry overrides what it needs
+SERVER_DEFAULTS = {
+    'port': STANDIN_PORT,
+    'latency': 0.0,  # seconds added before every answer
+    'jitter': 0.0,  # standard deviation of the added latency
+    'recursion': 0.0,  # seconds added the first time a name and type is asked, as a resolver's cache miss
+    'loss': 0.0,  # fraction of UDP queries dropped without an answer
+    'truncate': False,  # answer UDP queries with TC set and no records, so clients retry over TCP
+    'ad': False,  # set the AD flag on answers, as a validating resolver does
+    'rules': [],  # (domains, action): a set of names or a blocklist/domain set path; 'zero', 'nxdomain', ...
+    'tls': None,  # (certificate file, key file) to also serve DNS over TLS
+    'tls_port': 8853,
+    'signing_seed': None,  # bytes: sign answers and serve DNSKEY/DS RRsets with keys derived from it, see ZoneSigner
+}
+
+
+# Domains of a rule: a set as given, a domain set file memory-mapped, or any blocklist format parsed
+def load_rule_domains(source):
+    if not isinstance(source, str):
+        return set(source)
+    if is_domain_set(source):
+        return DomainSet(source)
+    domains = set()
+    for line in read_source_lines(source):
+        for name in parse_blocklist_line(line):
+            domain = normalize_domain(name)
+            if domain is not None:
+                domains.add(domain)
+    return domains
+
+
+# Name, type and end offset of the question in a query, or None if the query can't be parsed
+def parse_question(data):
+    if len(data) < 12 or struct.unpack_from('!H', data, 4)[0] != 1:
+        return None
+    labels = []
+    offset = 12
+    try:
+        while data[offset]:
+            length = data[offset]
+            labels.append(data[offset + 1:offset + 1 + length].decode('ascii').lower())
+            offset += length + 1
+        qtype = struct.unpack_from('!H', data, offset + 1)[0]
+    except (IndexError, UnicodeDecodeError, struct.error):
+        return None
+    return '.'.join(labels), qtype, offset + 5
+
+
+# Address a stand-in server answers for a name: stable per name, so runs are comparable
+def answer_address(name, qtype, action):
+    if action == 'zero':
+        return bytes(4 if qtype == TYPE_A else 16)
+    digest = zlib.crc32(name.encode('ascii'))
+    if qtype == TYPE_A:
+        return struct.pack('!I', 0x0A000000 | digest & 0xFFFFFF)  # 10.0.0.0/8
+    return b'\xfd' + bytes(11) + struct.pack('!I', digest)  # fd00::/8
+
+
+# Signs stand-in answers as if every name were a zone delegated from its parent, all the way up to the root, with
+# Ed25519 keys derived from a seed: anyone with the seed gets the trust anchors, so the chain of trust can be
+# followed down from the root like on the internet. Needs dnspython's DNSSEC extra (cryptography).
+class ZoneSigner:
+    def __init__(self, seed):
+        from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+        self.key_from_seed = Ed25519PrivateKey.from_private_bytes
+        self.seed = seed
+        self.keys = {}  # zone name -> (private key, DNSKEY)
+        self.signed = {}  # (name, type, action) -> answer RRsets, the RRSIG RRset last
+
+    def key(self, zone):
+        if zone not in self.keys:
+            private_key = self.key_from_seed(hashlib.sha256(self.seed + zone.to_text().encode('ascii')).digest())
+            self.keys[zone] = private_key, dns.dnssec.make_dnskey(private_key.public_key(),
+                                                                  dns.dnssec.Algorithm.ED25519)
+        return self.keys[zone]
+
+    # DS RRset of the root key, to validate answers with
+    def trust_anchors(self):
+        return dns.rrset.from_rdata(dns.name.root, TTL, dns.dnssec.make_ds(dns.name.root, self.key(dns.name.root)[1],
+                                                                           'SHA256'))
+
+    # Signed answer to a query, or [] for types the stand-in has no records of: DNSKEY RRsets are signed by the
+    # zone itself, DS RRsets and addresses by the parent zone
+    def answer(self, name, qtype, action):
+        cached = self.signed.get((name, qtype, action))
+        if cached is not None:
+            return cached
+        owner = dns.name.from_text(name or '.')
+        signer = owner.parent() if owner != dns.name.root else owner
+        if qtype in (TYPE_A, TYPE_AAAA):
+            address = answer_address(name, qtype, action)
+            rdata = dns.rdata.from_wire(dns.rdataclass.IN, qtype, address, 0, len(address))
+        elif qtype == TYPE_DNSKEY:
+            rdata, signer = self.key(owner)[1], owner
+        elif qtype == TYPE_DS and owner != dns.name.root:
+            rdata = dns.dnssec.make_ds(owner, self.key(owner)[1], 'SHA256')
+        else:
+            return []
+        rrset = dns.rrset.from_rdata(owner, TTL, rdata)
+        private_key, dnskey = self.key(signer)
+        signature = dns.dnssec.sign(rrset, private_key, signer, dnskey, lifetime=SIGNATURE_LIFETIME)
+        if len(self.signed) >= CACHE_SIZE:
+            self.signed.clear()
+        answer = self.signed[name, qtype, action] = [rrset, dns.rrset.from_rdata(owner, TTL, signature)]
+        return answer
+
+
+# One stand-in DNS server: answers A/AAAA queries from its rules without recursion, over UDP and TCP
+class StandinServer:
+    def __init__(self, address, **settings):
+        self.address = address
+        self.settings = dict(SERVER_DEFAULTS, **settings)
+        self.rules = [(load_rule_domains(domains), action) for domains, action in self.settings['rules']]
+        self.signer = ZoneSigner(self.settings['signing_seed']) if self.settings['signing_seed'] else None
+        self.queries = 0
+        self.cached = set()  # (name, type) asked before, while simulating recursion
+        self.transports = []
+
+    # Action of the first rule listing the name or one of its parent domains, or None
+    def action_for(self, name):
+        labels = name.split('.')
+        for domains, action in self.rules:
+            for start in range(len(labels) - 1):
+                if '.'.join(labels[start:]) in domains:
+                    return action
+        return None
+
+    # Wire-format answer to a query, built directly from the query bytes, and the delay before sending it;
+    # (None, 0) drops the query
+    def respond(self, data, tcp=False):
+        question = parse_question(data)
+        if question is None:
+            return None, 0.0
+        name, qtype, question_end = question
+        self.queries += 1
+        delay = self.delay()
+        if self.settings['recursion'] and (name, qtype) not in self.cached:
+            if len(self.cached) >= CACHE_SIZE:
+                self.cached.clear()
+            self.cached.add((name, qtype))
+            delay += self.settings['recursion']
+        query_id, flags = struct.unpack_from('!HH', data)
+        action = self.action_for(name)
+        rcode = ACTION_RCODES.get(action, 0)
+        # Only queries with EDNS (where the DO bit is) and key lookups take the slower signing path
+        if self.signer is not None and (struct.unpack_from('!H', data, 10)[0] or qtype in (TYPE_DS, TYPE_DNSKEY)):
+            return self.signed_response(data, name, qtype, action, rcode, tcp), delay
+
+        answer = b''
+        if not rcode and qtype in (TYPE_A, TYPE_AAAA):
+            rdata = answer_address(name, qtype, action)
+            # The owner name is a compression pointer to the question name at offset 12
+            answer = b'\xc0\x0c' + struct.pack('!HHIH', qtype, 1, TTL, len(rdata)) + rdata
+
+        flags = FLAG_QR | (flags & FLAG_OPCODE_RD) | FLAG_RA | rcode
+        if self.settings['ad'] and not rcode:
+            flags |= FLAG_AD
+        if self.settings['truncate'] and not tcp and answer:
+            flags |= FLAG_TC
+            answer = b''
+        response = struct.pack('!HHHHHH', query_id, flags, 1, 1 if answer else 0, 0, 0) + data[12:question_end]
+        return response + answer, delay
+
+    # Answer built with dnspython, with the RRSIGs if the query sets the DO bit; None drops a malformed query
+    def signed_response(self, data, name, qtype, action, rcode, tcp):
+        try:
+            query = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            return None
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.RA
+        response.set_rcode(rcode)
+        answer = [] if rcode else self.signer.answer(name, qtype, action)
+        if self.settings['ad'] and not rcode:
+            response.flags |= dns.flags.AD
+        if self.settings['truncate'] and not tcp and answer:
+            response.flags |= dns.flags.TC
+            answer = []
+        response.answer = answer if query.ednsflags & dns.flags.DO else answer[:1]
+        return response.to_wire()
+
+    def delay(self):
+        latency, jitter = self.settings['latency'], self.settings['jitter']
+        return max(0.0, random.gauss(latency, jitter) if jitter else latency)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: StandinProtocol(self), local_addr=(self.address, self.settings['port']))
+        tcp_server = await asyncio.start_server(self.handle_tcp, self.address, self.settings['port'])
+        self.transports = [transport, tcp_server]
+        if self.settings['tls']:
+            tls_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            tls_context.load_cert_chain(*self.settings['tls'])
+            self.transports.append(await asyncio.start_server(self.handle_tcp, self.address,
+                                                              self.settings['tls_port'], ssl=tls_context))
+
+    # Queries pipelined on a connection are answered independently, each after its own delay
+    async def handle_tcp(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                length = struct.unpack('!H', await reader.readexactly(2))[0]
+                response, delay = self.respond(await reader.readexactly(length), tcp=True)
+                if response is None:
+                    break
+                if delay:
+                    loop.call_later(delay, self.write_tcp, writer, response)
+                else:
+                    self.write_tcp(writer, response)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    def write_tcp(self, writer, response):
+        if not writer.is_closing():
+            writer.write(struct.pack('!H', len(response)) + response)
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+
+class StandinProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.server.settings['loss'] and random.random() < self.server.settings['loss']:
+            return
+        response, delay = self.server.respond(data)
+        if response is None:
+            return
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+
+# Stand-in servers for the given entries ({'address': ..., plus any SERVER_DEFAULTS keys}), served on
+# an event loop in a background thread until closed
+class StandinServers:
+    def __init__(self, entries):
+        self.servers = [StandinServer(**entry) for entry in entries]
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    async def start(self):
+        for server in self.servers:
+            await server.start()
+
+    def queries(self):
+        return sum(server.queries for server in self.servers)
+
+    def close(self):
+        for server in self.servers:
+            self.loop.call_soon_threadsafe(server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Serve the given entries until interrupted; ready (a threading/multiprocessing Event) is set once bound
+def serve(entries, ready=None):
+    async def main():
+        servers = [StandinServer(**entry) for entry in entries]
+        for server in servers:
+            await server.start()
+        if ready is not None:
+            ready.set()
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    # List the printed entries in dns_servers.txt to use them
+    servers = [
+        {'address': '127.0.0.2', 'latency': 0.010, 'jitter': 0.002, 'recursion': 0.050},  # blocks nothing
+        {'address': '127.0.0.3', 'latency': 0.025, 'jitter': 0.010, 'rules': [('domains.txt', 'zero')]},
+        {'address': '127.0.0.4', 'latency': 0.040, 'jitter': 0.020, 'loss': 0.02,
+         'rules': [('domains.txt', 'nxdomain')]},  # lossy, filtering with NXDOMAIN
+        {'address': '127.0.0.5', 'latency': 0.015, 'truncate': True, 'ad': True,
+         'rules': [('domains.txt', 'refused')]},  # answers only over TCP
+    ]
+
+    entries = [f"udp://{server['address']}:{STANDIN_PORT}" for server in servers]
+    print(f"Serving stand-in DNS servers on {', '.join(entries)}")
+    serve(servers)
@@ -0,0 +1,489 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+try:
+    import tomllib
+except ImportError:  # Python before 3.11; JSON config files still work
+    tomllib = None
+
+# Single entry point for the toolkit: python dnstk.py scan|measure|load|dnssec|analyze|report|blocking|...
+# Only argparse is loaded up front; every subcommand imports the modules it needs (and with them dnspython,
+# NumPy, pandas, pyarrow or matplotlib) when it runs, so short invocations start quickly.
+
+CONFIG_FILE = 'dnstk.toml'  # read when --config isn't given and the file exists in the working directory
+INTERNAL_DESTS = {'help', 'config', 'handler', 'parser', 'command'}  # not settable from config files
+
+
+# A path option that can be switched off with 'none' or an empty string (also from config files)
+def optional_path(value):
+    return None if value.strip().lower() in ('', 'none') else value
+
+
+# Number of domains to pick, or 'all'
+def domain_count(value):
+    return None if value.strip().lower() in ('all', 'none') else int(value)
+
+
+def shard_spec(value):
+    from dns_domain_sampling import parse_shard
+    return parse_shard(value)
+
+
+# Query mix as popular=0.7,random=0.2,blocked=0.1; config files may give a table instead
+def query_mix(value):
+    try:
+        return {name.strip(): float(share) for name, share in (part.split('=') for part in value.split(','))}
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid query mix '{value}', expected name=share,...")
+
+
+def add_servers(parser, default='dns_servers.txt'):
+    parser.add_argument('--servers', default=default, metavar='FILE',
+                        help="DNS servers to test, one per line")
+
+
+def add_metrics(parser):
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="serve per-query metrics for Prometheus on this port, e.g. 9153")
+    parser.add_argument('--metrics-file', type=optional_path, metavar='FILE',
+                        help="dump the metrics as JSON here every few seconds")
+
+
+def add_time_window(parser):
+    parser.add_argument('--start', metavar='TIME', help="only results from this time on, e.g. 2024-05-01T00:00")
+    parser.add_argument('--end', metavar='TIME', help="only results before this time")
+
+
+# Metrics collector and its exporter, or no metrics when neither a port nor a file is set
+def metrics_exporter(args):
+    if args.metrics_port is None and args.metrics_file is None:
+        return None, contextlib.nullcontext()
+    from dns_metrics import QueryMetrics, MetricsExporter
+    metrics = QueryMetrics()
+    return metrics, MetricsExporter(metrics, args.metrics_port, args.metrics_file)
+
+
+def run_scan(args):
+    import dns_domain_list_check as check
+
+    if args.merge:
+        check.merge_shards(args.merge, args.store, args.csv)
+    elif args.workers > 1:
+        # Workers can't share a port, so each one only dumps its metrics, next to its store
+        check.evaluate_dns_servers_sharded(args.domains, args.servers, args.store, args.csv, args.num_domains,
+                                           args.workers, args.shard, args.metrics_file,
+                                           max_in_flight=args.max_in_flight,
+                                           per_server_in_flight=args.per_server_in_flight,
+                                           rate_limit=args.rate_limit, timeout=args.timeout,
+                                           use_domain_index=args.domain_index, resume=args.resume)
+    else:
+        metrics, exporter = metrics_exporter(args)
+        with exporter:
+            if args.concurrent:
+                check.evaluate_dns_servers_concurrent(args.domains, args.servers, args.store, args.csv,
+                                                      args.num_domains, args.max_in_flight,
+                                                      args.per_server_in_flight, args.rate_limit, args.timeout,
+                                                      args.domain_index, args.resume, args.shard, metrics,
+                                                      args.profile_file)
+            else:
+                check.evaluate_dns_servers(args.domains, args.servers, args.store, args.csv, args.sleep,
+                                           args.num_domains, args.domain_index, args.resume, args.shard, metrics)
+
+    if args.matrix_dir is not None:
+        from dns_result_matrix import blocking_report  # NumPy is only needed for the report
+        blocking_report(check.shard_path(args.store, None if args.merge else args.shard), args.matrix_dir)
+
+
+def run_measure(args):
+    import dns_latency_measurement as measurement
+    measurement.PING_LATENCY = args.ping
+    measurement.DNS_QUERY_LATENCY = args.dns
+    measurement.CACHE_PROBE_ZONE = args.cache_probe_zone
+    measurement.CACHE_PROBE_TYPES = tuple(args.cache_probe_types)
+    if args.cache_probe_file is not None and args.cache_probe_zone is None:
+        args.parser.error("--cache-probe-file needs --cache-probe-zone, the zone the probes send queries into")
+
+    dns_servers = measurement.load_dns_servers(args.servers)
+    domains = measurement.load_domains(args.domains, args.max_domains, args.domain_index)
+    metrics, exporter = metrics_exporter(args)
+    with exporter:
+        measurement.run_measurements(dns_servers, domains, args.interval, args.duration, args.output,
+                                     args.analysis_interval, args.round_timeout, args.format, metrics,
+                                     args.profile_file, args.cache_probe_file)
+
+
+def run_load(args):
+    import dns_load_test as load_test
+    from dns_latency_measurement import load_dns_servers
+
+    dns_servers = load_dns_servers(args.servers)
+    mix = load_test.load_query_mix(args.popular_domains, args.blocked_domains, args.mix, args.max_domains)
+    profile = load_test.ramp_profile(args.start_qps, args.max_qps, args.factor, args.step_seconds)
+    metrics, exporter = metrics_exporter(args)
+    with exporter:
+        load_test.run_load_test(dns_servers, mix, profile, args.output, args.format, args.arrivals, args.timeout,
+                                args.stop_at_saturation, args.summary_file, metrics)
+
+
+def run_dnssec(args):
+    from dns_check_dnssec import (SIGNED_DOMAINS, BOGUS_DOMAINS, load_domain_list, sweep, print_verdicts,
+                                  write_sweep_csv)
+
+    with open(args.servers, "r") as file:
+        dns_servers = [line.strip() for line in file if line.strip()]
+    signed_domains = load_domain_list(args.signed_domains, SIGNED_DOMAINS)
+    bogus_domains = load_domain_list(args.bogus_domains, BOGUS_DOMAINS)
+    verdicts, rows = sweep(dns_servers, signed_domains, bogus_domains, args.max_in_flight,
+                           args.per_server_in_flight, args.timeout)
+    print_verdicts(verdicts, rows)
+    if args.csv:
+        write_sweep_csv(rows, args.csv)
+        print(f"Saved sweep results as {args.csv}")
+
+
+def run_analyze(args):
+    from dns_latency_analysis import detailed_analysis
+    detailed_analysis(args.results, not args.show, args.output_dir, args.start, args.end, args.workers)
+
+
+def run_report(args):
+    from dns_latency_report import windowed_report, export_report, plot_report
+
+    report = windowed_report(args.results, args.window, start=args.start, end=args.end)
+    if report.empty:
+        print("No data available for analysis.")
+        return
+    export_report(report, args.output)
+    print(f"Saved windowed report ({len(report)} rows) as {args.output}")
+    if args.output_dir is not None:
+        plot_report(report, args.output_dir)
+
+
+def run_blocking(args):
+    from dns_result_matrix import blocking_report
+    blocking_report(args.store, args.matrix_dir, args.run, args.unique_blocks_file)
+
+
+def run_ingest(args):
+    from dns_blocklist_ingest import ingest_blocklists
+
+    sources = list(args.sources)
+    if args.blocklists_dir is not None and os.path.isdir(args.blocklists_dir):
+        sources += sorted(os.path.join(args.blocklists_dir, name) for name in os.listdir(args.blocklists_dir))
+    if not sources:
+        print(f"No blocklists found in '{args.blocklists_dir}'.")
+        return
+    ingest_blocklists(sources, args.output, args.false_positive_rate)
+
+
+def run_export(args):
+    from dns_results_store import ResultsStore, export_csv
+
+    store = ResultsStore(args.store)
+    try:
+        run_id = args.run or store.latest_run()
+        if run_id is None:
+            print("No runs in the results store.")
+        else:
+            export_csv(store, run_id, args.csv)
+            print(f"Exported run {run_id} to {args.csv}")
+    finally:
+        store.close()
+
+
+def run_export_latency(args):
+    from dns_latency_writer import export_csv
+    try:
+        export_csv(args.results, args.csv, args.start, args.end)
+    except FileNotFoundError as e:
+        raise SystemExit(str(e))
+    print(f"Exported {args.results} to {args.csv}")
+
+
+def run_benchmark(args):
+    import dns_benchmark as benchmark
+
+    unknown = sorted(set(args.cases) - set(benchmark.CASES))
+    if unknown:
+        args.parser.error(f"unknown benchmark cases: {', '.join(unknown)} (known: {', '.join(benchmark.CASES)})")
+    settings = {'cases': args.cases, 'domain_counts': args.domain_counts, 'server_counts': args.server_counts,
+                'latency': args.latency, 'jitter': args.jitter, 'loss': args.loss}
+    history = benchmark.load_history(args.history)
+    results = benchmark.run_benchmarks(args.cases, args.domain_counts, args.server_counts, args.latency, args.jitter,
+                                       args.loss)
+    benchmark.print_results(results)
+    record = benchmark.record_results(results, args.history, settings)
+    print(f"Recorded results in {args.history}")
+
+    regressions = benchmark.find_regressions(record, history)
+    for result, old in regressions:
+        print(f"REGRESSION {result['case']} ({result['domains']} domains x {result['servers']} servers): "
+              f"{old['qps']} -> {result['qps']} queries/s, "
+              f"{old['cpu_us_per_query']} -> {result['cpu_us_per_query']} us CPU per query")
+    return 1 if regressions else 0
+
+
+# The subcommands and their options; the defaults are what the scripts used to hard-code
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--config', default=argparse.SUPPRESS, metavar='FILE',
+                        help=f"TOML or JSON file with option defaults (default: {CONFIG_FILE} if it exists)")
+    parser = argparse.ArgumentParser(prog='dnstk', parents=[common],
+                                     description="DNS security and performance toolkit.")
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND', required=True)
+
+    def command(name, handler, help):
+        subparser = subparsers.add_parser(name, parents=[common], help=help, description=help[0].upper() + help[1:],
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        subparser.set_defaults(handler=handler, parser=subparser)
+        return subparser
+
+    scan = command('scan', run_scan, "check which domains DNS servers resolve or block")
+    scan.add_argument('--domains', default='domains.txt', metavar='FILE',
+                      help="domains to check, one per line, or a domain set built by 'dnstk ingest'")
+    add_servers(scan)
+    scan.add_argument('--store', default='dns_results.db', metavar='FILE',
+                      help="results of every run, used to resume interrupted runs")
+    scan.add_argument('--csv', default='dns_results.csv', metavar='FILE',
+                      help="detailed output, exported from the store for the current run")
+    scan.add_argument('--matrix-dir', type=optional_path, default='dns_results.matrix', metavar='DIR',
+                      help="bit matrices for the cross-server blocking report, 'none' for no report")
+    scan.add_argument('--num-domains', type=domain_count, default=1904, metavar='N',
+                      help="random domains to pick from the domain list, 'all' for all of them")
+    scan.add_argument('--domain-index', action=argparse.BooleanOptionalAction, default=False,
+                      help="keep a line-offset index next to the domain list so picks skip rescanning it")
+    scan.add_argument('--resume', action=argparse.BooleanOptionalAction, default=True,
+                      help="continue the last unfinished run over the domain list instead of picking new domains")
+    scan.add_argument('--concurrent', action=argparse.BooleanOptionalAction, default=True,
+                      help="resolve many domains at once instead of one query after another")
+    scan.add_argument('--sleep', type=float, default=0, metavar='SECONDS',
+                      help="pause between domains (serial mode only)")
+    scan.add_argument('--max-in-flight', type=int, default=256, metavar='N',
+                      help="queries in flight across all DNS servers (concurrent mode)")
+    scan.add_argument('--per-server-in-flight', type=int, default=32, metavar='N',
+                      help="queries in flight per DNS server (concurrent mode)")
+    scan.add_argument('--rate-limit', type=float, metavar='QPS',
+                      help="max queries per second per DNS server (concurrent mode)")
+    scan.add_argument('--timeout', type=float, default=5.0, metavar='SECONDS',
+                      help="seconds before a query counts as failed")
+    scan.add_argument('--workers', type=int, default=1, metavar='N',
+                      help="local processes, each scanning a hash partition of the domains concurrently")
+    scan.add_argument('--shard', type=shard_spec, metavar='i/N',
+                      help="scan only shard i (counted from 0) of N hash partitions of the domain list")
+    scan.add_argument('--merge', nargs='+', metavar='SHARD_STORE',
+                      help="merge the stores of finished shards into --store and --csv")
+    add_metrics(scan)
+    scan.add_argument('--profile-file', type=optional_path, metavar='FILE',
+                      help="write stack samples of the scan loop here (concurrent mode)")
+
+    measure = command('measure', run_measure, "measure ping and DNS query latency over time")
+    add_servers(measure)
+    measure.add_argument('--domains', default='new_domains.txt', metavar='FILE',
+                         help="domains to pick the random query of each round from")
+    measure.add_argument('--max-domains', type=int, default=10000, metavar='N',
+                         help="random domains kept in memory, however long the domain list is")
+    measure.add_argument('--domain-index', action=argparse.BooleanOptionalAction, default=False,
+                         help="keep a line-offset index next to the domain list")
+    measure.add_argument('--interval', type=float, default=60, metavar='SECONDS', help="time between rounds")
+    measure.add_argument('--duration', type=float, metavar='SECONDS', help="stop after this long; runs until stopped")
+    measure.add_argument('--output', default='dns_latency_results.csv', metavar='PATH',
+                         help="a CSV file, or a directory of segments for the parquet format")
+    measure.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                         help="parquet writes rotated columnar segments and needs pyarrow")
+    measure.add_argument('--analysis-interval', type=float, default=600, metavar='SECONDS',
+                         help="time between printed summaries")
+    measure.add_argument('--round-timeout', type=float, default=10, metavar='SECONDS',
+                         help="time a round may take; probes still running then are recorded as failed")
+    measure.add_argument('--ping', action=argparse.BooleanOptionalAction, default=True, help="measure ping latency")
+    measure.add_argument('--dns', action=argparse.BooleanOptionalAction, default=True,
+                         help="measure DNS query latency")
+    measure.add_argument('--cache-probe-file', type=optional_path, metavar='FILE',
+                         help="run cold and warm cache probes every round and write their results here")
+    measure.add_argument('--cache-probe-zone', metavar='ZONE',
+                         help="zone the random cache probe names are made up under; required with the probes")
+    measure.add_argument('--cache-probe-types', nargs='+', default=['A', 'AAAA', 'HTTPS'], metavar='TYPE',
+                         help="record types to probe")
+    add_metrics(measure)
+    measure.add_argument('--profile-file', type=optional_path, metavar='FILE',
+                         help="write stack samples of the measurement loop here")
+
+    load = command('load', run_load, "find the query rate each DNS server keeps up with")
+    add_servers(load)
+    load.add_argument('--popular-domains', default='new_domains.txt', metavar='FILE',
+                      help="names a resolver likely has cached, most popular first")
+    load.add_argument('--blocked-domains', default='domains.txt', metavar='FILE', help="blocklisted names")
+    load.add_argument('--max-domains', type=int, default=10000, metavar='N', help="names kept in memory per source")
+    load.add_argument('--mix', type=query_mix, default='popular=0.7,random=0.2,blocked=0.1',
+                      help="share of popular, random and blocked names in the queries")
+    load.add_argument('--start-qps', type=float, default=100, metavar='QPS', help="rate of the first step")
+    load.add_argument('--max-qps', type=float, default=6400, metavar='QPS',
+                      help="highest rate; set it to --start-qps for a constant rate")
+    load.add_argument('--factor', type=float, default=2, help="rate growth from one step to the next")
+    load.add_argument('--step-seconds', type=float, default=15, metavar='SECONDS', help="length of each step")
+    load.add_argument('--arrivals', choices=['poisson', 'constant'], default='poisson',
+                      help="exponential or even gaps between queries")
+    load.add_argument('--timeout', type=float, default=2.0, metavar='SECONDS',
+                      help="seconds before a query counts as failed")
+    load.add_argument('--output', default='dns_load_results.csv', metavar='PATH',
+                      help="results, readable by 'dnstk analyze' and 'dnstk report'")
+    load.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    load.add_argument('--summary-file', type=optional_path, default='dns_load_summary.json', metavar='FILE',
+                      help="per-step summaries and the rate each server held")
+    load.add_argument('--stop-at-saturation', action=argparse.BooleanOptionalAction, default=True,
+                      help="skip a server's remaining steps once it stops keeping up")
+    add_metrics(load)
+
+    dnssec = command('dnssec', run_dnssec, "check which DNS servers validate DNSSEC")
+    add_servers(dnssec)
+    dnssec.add_argument('--signed-domains', default='dnssec_signed_domains.txt', metavar='FILE',
+                        help="signed domains to query, built-in list if the file doesn't exist")
+    dnssec.add_argument('--bogus-domains', default='dnssec_bogus_domains.txt', metavar='FILE',
+                        help="domains with broken signatures, built-in list if the file doesn't exist")
+    dnssec.add_argument('--csv', type=optional_path, default='dnssec_sweep.csv', metavar='FILE',
+                        help="one row per server and domain, 'none' to skip")
+    dnssec.add_argument('--max-in-flight', type=int, default=512, metavar='N')
+    dnssec.add_argument('--per-server-in-flight', type=int, default=32, metavar='N')
+    dnssec.add_argument('--timeout', type=float, default=2.0, metavar='SECONDS', help="seconds per try")
+
+    analyze = command('analyze', run_analyze, "plot latency results per server and compare servers")
+    analyze.add_argument('--results', default='dns_latency_results.csv', metavar='PATH',
+                         help="results CSV or columnar results directory")
+    analyze.add_argument('--output-dir', default='plots', metavar='DIR')
+    analyze.add_argument('--show', action='store_true', help="show the plots in windows instead of saving them")
+    add_time_window(analyze)
+    analyze.add_argument('--workers', type=int, metavar='N', help="processes rendering plots, one per CPU if unset")
+
+    report = command('report', run_report, "tail latency and availability per server and time window")
+    report.add_argument('--results', default='dns_latency_results.csv', metavar='PATH',
+                        help="results CSV or columnar results directory")
+    report.add_argument('--window', default='1h', help="window length: 1min, 1h, 1D, ...")
+    report.add_argument('--output', default='dns_latency_report.csv', metavar='FILE',
+                        help="compact table, .csv or .parquet")
+    report.add_argument('--output-dir', type=optional_path, default='plots', metavar='DIR',
+                        help="where the plots go, 'none' for no plots")
+    add_time_window(report)
+
+    blocking = command('blocking', run_blocking, "compare what each DNS server blocked in a scan")
+    blocking.add_argument('--store', default='dns_results.db', metavar='FILE', help="results store of the scans")
+    blocking.add_argument('--matrix-dir', default='dns_results.matrix', metavar='DIR',
+                          help="bit matrices of the runs, built on first use")
+    blocking.add_argument('--run', type=int, metavar='ID', help="run to report on, the latest if unset")
+    blocking.add_argument('--unique-blocks-file', type=optional_path, default='dns_unique_blocks.csv',
+                          metavar='FILE', help="every domain only one server blocks, 'none' to skip")
+
+    ingest = command('ingest', run_ingest, "build a domain set from blocklists")
+    ingest.add_argument('sources', nargs='*', metavar='SOURCE',
+                        help="blocklist files or URLs (hosts, adblock, dnsmasq or plain format)")
+    ingest.add_argument('--blocklists-dir', type=optional_path, default='blocklists', metavar='DIR',
+                        help="downloaded blocklists, all read in addition to the sources")
+    ingest.add_argument('--output', default='domains.dset', metavar='FILE',
+                        help="domain set read by 'dnstk scan' and 'dnstk measure'")
+    ingest.add_argument('--false-positive-rate', type=float, default=0.001, metavar='RATE',
+                        help="bloom filter false positive rate")
+
+    export = command('export', run_export, "export a scan run from the results store as CSV")
+    export.add_argument('--store', default='dns_results.db', metavar='FILE')
+    export.add_argument('--run', type=int, metavar='ID', help="run to export, the latest if unset")
+    export.add_argument('--csv', default='dns_results.csv', metavar='FILE')
+
+    export_latency = command('export-latency', run_export_latency, "export columnar latency results as CSV")
+    export_latency.add_argument('--results', default='dns_latency_results', metavar='DIR',
+                                help="columnar store written by 'dnstk measure --format parquet'")
+    export_latency.add_argument('--csv', default='dns_latency_results_export.csv', metavar='FILE')
+    add_time_window(export_latency)
+
+    benchmark = command('benchmark', run_benchmark, "benchmark the toolkit against stand-in DNS servers")
+    benchmark.add_argument('--cases', nargs='+', default=['scan_serial', 'scan_concurrent', 'measurement',
+                                                           'dnssec_sweep'], metavar='CASE')
+    benchmark.add_argument('--domain-counts', nargs='+', type=int, default=[1000, 10000], metavar='N')
+    benchmark.add_argument('--server-counts', nargs='+', type=int, default=[1, 4, 16], metavar='N')
+    benchmark.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+                           help="injected stand-in latency; 0 measures the toolkit's own overhead")
+    benchmark.add_argument('--jitter', type=float, default=0.0, metavar='SECONDS')
+    benchmark.add_argument('--loss', type=float, default=0.0, metavar='RATIO')
+    benchmark.add_argument('--history', default='benchmark_results.jsonl', metavar='FILE',
+                           help="one JSON record per suite run, compared against for regressions")
+
+    return parser, subparsers.choices
+
+
+def load_config(path):
+    if path.endswith('.json'):
+        with open(path, 'r') as file:
+            return json.load(file)
+    if tomllib is None:
+        raise SystemExit(f"Reading {path} needs Python 3.11 or newer, use a .json config file instead")
+    with open(path, 'rb') as file:
+        return tomllib.load(file)
+
+
+# A config value as the option would have parsed it; lists fill nargs options, tables pass through
+def config_value(action, value):
+    convert = action.type or (lambda text: text)
+    if action.nargs in ('+', '*'):
+        values = value if isinstance(value, list) else [value]
+        return [convert(item) if isinstance(item, str) else item for item in values]
+    return convert(value) if isinstance(value, str) else value
+
+
+def option_actions(subparser):
+    return {action.dest: action for action in subparser._actions if action.dest not in INTERNAL_DESTS}
+
+
+# Turn the config into defaults of the subcommand; the command line still overrides them.
+# Top-level keys apply to every subcommand with that option, [section] keys only to that subcommand.
+# Option and section names may use dashes or underscores: num-domains, [export_latency].
+def apply_config(config, path, command, subparsers):
+    known = set().union(*(option_actions(subparser) for subparser in subparsers.values()))
+    sections = {}
+    shared = {}
+    for key, value in config.items():
+        if key.replace('-', '_') in known:
+            shared[key] = value  # options, including table-valued ones such as mix
+        elif isinstance(value, dict) and key.replace('_', '-') in subparsers:
+            sections[key.replace('_', '-')] = value
+        elif isinstance(value, dict):
+            raise SystemExit(f"{path}: unknown section [{key}]")
+        else:
+            raise SystemExit(f"{path}: unknown option '{key}'")
+
+    subparser = subparsers[command]
+    options = option_actions(subparser)
+    section = sections.get(command, {})
+    defaults = {}
+    for values, strict in ((shared, False), (section, True)):
+        for key, value in values.items():
+            dest = key.replace('-', '_')
+            if dest not in options:
+                if strict:
+                    subparser.error(f"{path}: [{command}] has no option '{key}'")
+                continue
+            try:
+                defaults[dest] = config_value(options[dest], value)
+            except (argparse.ArgumentTypeError, TypeError, ValueError) as e:
+                subparser.error(f"{path}: invalid value for '{key}': {e}")
+    subparser.set_defaults(**defaults)
+
+
+def main(argv=None):
+    parser, subparsers = build_parser()
+    args = parser.parse_args(argv)
+    config_path = getattr(args, 'config', None)
+    if config_path is None and os.path.isfile(CONFIG_FILE):
+        config_path = CONFIG_FILE
+    if config_path is not None:
+        apply_config(load_config(config_path), config_path, args.command, subparsers)
+        args = parser.parse_args(argv)
+    return args.handler(args) or 0
+
+
+# Run one subcommand with the script's own arguments, for the modules' __main__ blocks
+def script_main(command):
+    sys.exit(main([command] + sys.argv[1:]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import asyncio
+import dns.dnssec
+import dns.message
+import dns.name
+import dns.rdatatype
+import dns.rrset
+import pytest
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from dns_check_dnssec import ChainValidator, sweep
+from dns_query_engine import QueryResult
+from dns_standin_server import STANDIN_PORT, StandinServers, ZoneSigner
+
+ALGORITHM = dns.dnssec.Algorithm.ED25519
+
+
+# A zone key pair: the private key and its DNSKEY record
+def make_key(ksk=True):
+    private_key = ed25519.Ed25519PrivateKey.generate()
+    return private_key, dns.dnssec.make_dnskey(private_key.public_key(), ALGORITHM, flags=257 if ksk else 256)
+
+
+def signatures(rrset, key, signer):
+    private_key, dnskey = key
+    rrsig = dns.dnssec.sign(rrset, private_key, dns.name.from_text(signer), dnskey, lifetime=3600)
+    return dns.rrset.from_rdata(rrset.name, rrset.ttl, rrsig)
+
+
+def dnskey_rrset(zone, *keys):
+    return dns.rrset.from_rdata(zone, 3600, *(dnskey for _, dnskey in keys))
+
+
+def ds_rrset(zone, key):
+    return dns.rrset.from_rdata(zone, 3600, dns.dnssec.make_ds(zone, key[1], 'SHA256'))
+
+
+# Answers every query from a table of (name, type) -> answer section, like a server that has the zones
+class FakeEngine:
+    def __init__(self, records):
+        self.records = records
+
+    async def query(self, server, domain, rdtype='A', want_dnssec=False):
+        name, rdtype = dns.name.from_text(domain), dns.rdatatype.RdataType.make(rdtype)
+        response = dns.message.make_response(dns.message.make_query(name, rdtype, want_dnssec=True))
+        response.answer = list(self.records.get((domain, rdtype), []))
+        # Through the wire format, as from a real server, so the message indexes its RRsets
+        return QueryResult(dns.message.from_wire(response.to_wire()), 0.001, 1)
+
+
+# A signed root and test. zone, with www.test. A signed by test.
+@pytest.fixture
+def chain():
+    root, zone = make_key(), make_key()
+    zone_signing = make_key(ksk=False)
+    root_keys = dnskey_rrset('.', root)
+    zone_keys = dnskey_rrset('test.', zone, zone_signing)
+    delegation = ds_rrset('test.', zone)
+    answer = dns.rrset.from_text('www.test.', 300, 'IN', 'A', '192.0.2.1')
+    records = {
+        ('.', dns.rdatatype.DNSKEY): [root_keys, signatures(root_keys, root, '.')],
+        ('test.', dns.rdatatype.DNSKEY): [zone_keys, signatures(zone_keys, zone, 'test.')],
+        ('test.', dns.rdatatype.DS): [delegation, signatures(delegation, root, '.')],
+    }
+    return {'root': root, 'zone': zone, 'zone_signing': zone_signing, 'records': records,
+            'answer': answer, 'anchors': ds_rrset('.', root)}
+
+
+def check(chain, answer_section, timeout=5):
+    validator = ChainValidator(FakeEngine(chain['records']), ['192.0.2.53'], chain['anchors'])
+    response = dns.message.make_response(dns.message.make_query('www.test.', 'A', want_dnssec=True))
+    response.answer = answer_section
+    return asyncio.run(asyncio.wait_for(validator.check_answer(response), timeout))
+
+
+def test_answer_signed_down_from_the_root_is_secure(chain):
+    answer = chain['answer']
+    assert check(chain, [answer, signatures(answer, chain['zone_signing'], 'test.')]) == 'secure'
+
+
+def test_answer_without_signatures_is_unsigned(chain):
+    assert check(chain, [chain['answer']]) == 'unsigned'
+
+
+def test_answer_signed_by_unknown_key_is_bogus(chain):
+    answer = chain['answer']
+    assert check(chain, [answer, signatures(answer, make_key(ksk=False), 'test.')]) == 'bogus'
+
+
+def test_dnskey_set_must_be_signed_by_a_key_matching_the_ds(chain):
+    # The real KSK is in the set, but only the forger's own key signed it
+    forger = make_key()
+    forged_keys = dnskey_rrset('test.', chain['zone'], forger)
+    chain['records']['test.', dns.rdatatype.DNSKEY] = [forged_keys, signatures(forged_keys, forger, 'test.')]
+    answer = chain['answer']
+    assert check(chain, [answer, signatures(answer, forger, 'test.')]) == 'bogus'
+
+
+def test_ds_signed_by_the_zone_itself_is_bogus_without_hanging(chain):
+    delegation = ds_rrset('test.', chain['zone'])
+    chain['records']['test.', dns.rdatatype.DS] = [delegation, signatures(delegation, chain['zone'], 'test.')]
+    answer = chain['answer']
+    assert check(chain, [answer, signatures(answer, chain['zone_signing'], 'test.')]) == 'bogus'
+
+
+def test_signer_must_enclose_the_answer_name(chain):
+    # Valid keys of test. vouching for a name outside the zone
+    other = dns.rrset.from_text('www.example.', 300, 'IN', 'A', '192.0.2.1')
+    assert check(chain, [other, signatures(other, chain['zone_signing'], 'test.')]) == 'bogus'
+
+
+def test_stripped_key_signatures_leave_the_answer_unverified(chain):
+    # A path that drops RRSIGs says nothing about the signatures, so this isn't bogus
+    chain['records']['test.', dns.rdatatype.DNSKEY] = chain['records']['test.', dns.rdatatype.DNSKEY][:1]
+    answer = chain['answer']
+    assert check(chain, [answer, signatures(answer, chain['zone_signing'], 'test.')]) == 'unverified'
+
+
+def test_unsigned_chain_server_leaves_answers_unverified():
+    # Signed answers, but the keys are fetched from a stand-in that serves no DNSSEC records at all
+    signed, unsigned = f'udp://127.0.1.221:{STANDIN_PORT}', f'udp://127.0.1.222:{STANDIN_PORT}'
+    with StandinServers([{'address': '127.0.1.221', 'port': STANDIN_PORT, 'signing_seed': b'seed'},
+                         {'address': '127.0.1.222', 'port': STANDIN_PORT}]):
+        _, rows = sweep([signed], ['www.site.test'], [], timeout=1.0, chain_servers=[unsigned],
+                        trust_anchors=ZoneSigner(b'seed').trust_anchors())
+    assert rows[0]['outcome'] == 'unverified'
@@ -0,0 +1,82 @@
+import asyncio
+import socket
+import pytest
+import dns_domain_list_check
+from dns_domain_list_check import resolve_domain, resolve_domain_async
+from dns_query_engine import BlockingQueryEngine, QueryEngine
+from dns_standin_server import STANDIN_PORT, StandinServers
+
+
+@pytest.fixture
+def silent_server():
+    # A bound UDP socket that never answers, like a server that dropped off the network
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    yield f'udp://127.0.0.1:{sock.getsockname()[1]}'
+    sock.close()
+
+
+@pytest.fixture
+def standin():
+    entries = [{'address': '127.0.1.211', 'port': STANDIN_PORT, 'rules': [({'blocked.test'}, 'nxdomain')]},
+               {'address': '127.0.1.212', 'port': STANDIN_PORT, 'rules': [({'blocked.test'}, 'zero')]}]
+    with StandinServers(entries):
+        yield [f"udp://{entry['address']}:{STANDIN_PORT}" for entry in entries]
+
+
+async def resolve_all(server, domains, **engine_options):
+    engine = QueryEngine(**engine_options)
+    try:
+        return await asyncio.gather(*[resolve_domain_async(domain, engine, server, asyncio.Semaphore(8),
+                                                           asyncio.Semaphore(64)) for domain in domains])
+    finally:
+        await engine.close()
+
+
+def test_dead_server_is_unavailable_not_blocked(silent_server):
+    # Enough queries to run out of retry budget and open the circuit breaker along the way
+    results = asyncio.run(resolve_all(silent_server, [f'd{index}.test' for index in range(40)],
+                                      timeout=0.05, lifetime=0.2))
+    assert set(results) == {None}
+
+
+def test_blocking_resolve_of_dead_server_is_unavailable(silent_server, monkeypatch):
+    engine = BlockingQueryEngine(timeout=0.05, lifetime=0.2)
+    monkeypatch.setattr(dns_domain_list_check, 'shared_blocking_engine', lambda: engine)
+    try:
+        assert resolve_domain('a.test', silent_server, 0) is None
+    finally:
+        engine.close()
+
+
+def test_answers_decide_resolved_or_blocked(standin):
+    nxdomain, zero = standin
+    assert asyncio.run(resolve_all(nxdomain, ['www.site.test', 'www.blocked.test'])) == [True, False]
+    assert asyncio.run(resolve_all(zero, ['www.site.test', 'www.blocked.test'])) == [True, False]
+
+
+def test_resumed_stats_match_the_store(tmp_path):
+    domains_file, servers_file = tmp_path / 'domains.txt', tmp_path / 'servers.txt'
+    domains_file.write_text('a.test\nb.test\nc.test\n')
+    servers_file.write_text('first\nsecond\n')
+    store_file = str(tmp_path / 'results.db')
+    scan = dns_domain_list_check.start_scan(str(domains_file), str(servers_file), store_file, None, False, True, None)
+    first_results = {'a.test': {'first': True, 'second': None}, 'b.test': {'first': None, 'second': None},
+                     'c.test': {'first': True, 'second': False}}
+    for index, domain, servers, resolved_before, retried in scan['remaining']:
+        dns_domain_list_check.record_domain_result(scan, domain, index, first_results[domain], resolved_before,
+                                                   retried)
+    scan['store'].close()
+
+    # On resume the server that didn't answer does, and the stats kept while scanning agree with the store's
+    scan = dns_domain_list_check.start_scan(str(domains_file), str(servers_file), store_file, None, False, True, None)
+    assert scan['dns_stats']['second']['unavailable'] == 1
+    assert [(domain, servers, retried) for _, domain, servers, _, retried in scan['remaining']] == [
+        ('a.test', ['second'], ['second']), ('b.test', ['first', 'second'], ['first', 'second'])]
+    for index, domain, servers, resolved_before, retried in scan['remaining']:
+        dns_domain_list_check.record_domain_result(scan, domain, index, {server: False for server in servers},
+                                                   resolved_before, retried)
+    assert (scan['dns_stats'], scan['total_resolvable_domains']) == scan['store'].run_stats(scan['run_id'],
+                                                                                          scan['dns_servers'])
+    assert scan['dns_stats']['second'] == {'resolved': 0, 'blocked': 3, 'unavailable': 0}
+    scan['store'].close()
@@ -0,0 +1,35 @@
+import math
+import os
+import pytest
+from dns_latency_writer import ParquetResultsWriter, load_manifest, read_rows
+
+pytest.importorskip('pyarrow')
+
+
+def rows(timestamp_ns, count):
+    return [(timestamp_ns + index, f'server{index}', None, 0.01, math.nan, 'a.test', 0.0, 0.0)
+            for index in range(count)]
+
+
+def test_open_segment_survives_a_crash(tmp_path):
+    directory = str(tmp_path / 'store')
+    writer = ParquetResultsWriter(directory, batch_rows=3)
+    writer.write(rows(1000, 2))
+    writer.write(rows(2000, 2))  # one row group written, one row still buffered
+    writer.journal.write('[3000, "server')  # the crash cut the last line short
+    writer.journal.flush()
+
+    ParquetResultsWriter(directory).close()
+    assert [segment['rows'] for segment in load_manifest(directory)['segments']] == [4]
+    assert [row['timestamp'] for row in read_rows(directory)] == [1000, 1001, 2000, 2001]
+    assert not [name for name in os.listdir(directory) if name.endswith(('.journal', '.partial'))]
+
+
+def test_segments_stay_open_across_writes(tmp_path):
+    directory = str(tmp_path / 'store')
+    writer = ParquetResultsWriter(directory, batch_rows=2)
+    for round_number in range(10):
+        writer.write(rows(round_number * 1000, 3))
+    writer.close()
+    assert [segment['rows'] for segment in load_manifest(directory)['segments']] == [30]
+    assert [row['ping_latency'] for row in read_rows(directory, 9000)] == [None] * 3
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from dns_result_matrix import (BLOCKED, ERROR, RESOLVED, bit_positions, blocking_coverage, blocking_overlap,
+                               build_matrix, diff_runs, unique_blocks)
+from dns_results_store import ResultsStore
+
+DOMAINS = ['a.test', 'b.test', 'c.test', 'd.test', 'e.test', 'f.test', 'g.test', 'h.test', 'i.test']
+SERVERS = ['plain', 'filter', 'strict']
+# Per domain, what each server did: True resolved, False blocked, None out of use
+RESULTS = {
+    'a.test': (True, True, True),
+    'b.test': (True, False, False),
+    'c.test': (True, True, False),
+    'd.test': (True, False, True),
+    'e.test': (False, False, False),  # resolved nowhere, so not counted as blocked
+    'f.test': (True, None, False),
+    'g.test': (True, True, True),
+    'h.test': (True, False, False),
+    'i.test': (True, True, True),
+}
+
+
+def record_run(store, results, domains=DOMAINS):
+    run_id = store.create_run('domains.txt', len(domains), domains)
+    store.add_run_servers(run_id, SERVERS)
+    for domain in domains:
+        store.record(run_id, domain, dict(zip(SERVERS, results[domain])))
+    store.finish_run(run_id)
+    return run_id
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ResultsStore(str(tmp_path / 'results.db'))
+    yield store
+    store.close()
+
+
+def columns(matrix, row):
+    return [matrix.domain(column) for column in bit_positions(row, matrix.size)]
+
+
+def test_planes_follow_results(store, tmp_path):
+    matrix = build_matrix(store, record_run(store, RESULTS), str(tmp_path / 'matrix'))
+    assert matrix.size == len(DOMAINS) and matrix.servers == SERVERS
+    assert columns(matrix, matrix.row(BLOCKED, 'filter')) == ['b.test', 'd.test', 'e.test', 'h.test']
+    assert columns(matrix, matrix.row(ERROR, 'filter')) == ['f.test']
+    assert columns(matrix, matrix.row(RESOLVED, 'strict')) == ['a.test', 'd.test', 'g.test', 'i.test']
+    assert columns(matrix, matrix.active()) == [domain for domain in DOMAINS if domain != 'e.test']
+    matrix.close()
+
+
+def test_blocking_reports(store, tmp_path):
+    matrix = build_matrix(store, record_run(store, RESULTS), str(tmp_path / 'matrix'))
+    unique = unique_blocks(matrix)
+    assert columns(matrix, unique['plain']) == []
+    assert columns(matrix, unique['filter']) == ['d.test']
+    assert columns(matrix, unique['strict']) == ['c.test', 'f.test']
+
+    common, jaccard = blocking_overlap(matrix)
+    # filter blocks b, d, h and strict b, c, f, h: two in common out of five
+    assert common.tolist() == [[0, 0, 0], [0, 3, 2], [0, 2, 4]]
+    assert jaccard[1, 2] == pytest.approx(2 / 5)
+    assert jaccard[0, 1] == 0.0 and jaccard[0, 0] == 1.0
+
+    union, coverage = blocking_coverage(matrix)
+    assert union == 5
+    assert coverage == {'plain': (0, 0.0), 'filter': (3, 0.6), 'strict': (4, 0.8)}
+    matrix.close()
+
+
+def test_diff_lines_up_runs_by_domain(store, tmp_path):
+    previous = build_matrix(store, record_run(store, RESULTS), str(tmp_path / 'previous'))
+    changed = dict(RESULTS, **{'a.test': (True, False, True), 'b.test': (True, True, False)})
+    # The next run samples the domains in another order, and one domain the previous run didn't test
+    domains = list(reversed(DOMAINS[1:])) + ['a.test', 'new.test']
+    changed['new.test'] = (True, False, False)
+    current = build_matrix(store, record_run(store, changed, domains), str(tmp_path / 'current'))
+
+    changes = diff_runs(previous, current)
+    newly_blocked, unblocked = changes['filter']
+    assert [current.domain(column) for column in newly_blocked] == ['a.test']
+    assert [current.domain(column) for column in unblocked] == ['b.test']
+    assert all(len(newly) == len(gone) == 0 for server, (newly, gone) in changes.items() if server != 'filter')
+    previous.close()
+    current.close()
+
+
+def test_bits_are_packed(store, tmp_path):
+    matrix = build_matrix(store, record_run(store, RESULTS), str(tmp_path / 'matrix'))
+    assert matrix.bits.shape == (3, len(SERVERS), 2) and matrix.bits.dtype == np.uint8
+    matrix.close()
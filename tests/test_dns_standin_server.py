@@ -0,0 +1,32 @@
+from dns_check_dnssec import classify_server, sweep
+from dns_standin_server import STANDIN_PORT, StandinServers, ZoneSigner
+
+SEED = b'test-seed'
+
+
+def signed_standin(address):
+    return StandinServers([{'address': address, 'port': STANDIN_PORT, 'ad': True, 'signing_seed': SEED,
+                            'rules': [({'blocked.test'}, 'nxdomain')]}])
+
+
+def test_sweep_validates_signed_standin():
+    with signed_standin('127.0.1.201') as standin:
+        _, rows = sweep([f'udp://127.0.1.201:{STANDIN_PORT}'], ['a.site.test', 'b.site.test', 'c.other.test'], [],
+                        trust_anchors=ZoneSigner(SEED).trust_anchors(), timeout=1.0)
+    assert [row['outcome'] for row in rows] == ['secure'] * 3
+    assert standin.queries() > 3  # the answers and the DNSKEY/DS chain down from the root
+
+
+def test_sweep_rejects_other_trust_anchors():
+    with signed_standin('127.0.1.202'):
+        _, rows = sweep([f'udp://127.0.1.202:{STANDIN_PORT}'], ['a.site.test'], [],
+                        trust_anchors=ZoneSigner(b'other-seed').trust_anchors(), timeout=1.0)
+    assert rows[0]['outcome'] == 'bogus'
+
+
+def test_blocked_names_are_not_signed():
+    with signed_standin('127.0.1.203'):
+        verdicts, rows = sweep([f'udp://127.0.1.203:{STANDIN_PORT}'], ['x.blocked.test'], [],
+                               trust_anchors=ZoneSigner(SEED).trust_anchors(), timeout=1.0)
+    assert rows[0]['outcome'] == 'nxdomain'
+    assert verdicts == {f'udp://127.0.1.203:{STANDIN_PORT}': classify_server(rows)}
@@ -0,0 +1,65 @@
+import pytest
+from dnstk import apply_config, build_parser, domain_count, optional_path
+
+
+def parse(argv, config=None):
+    parser, subparsers = build_parser()
+    if config is not None:
+        apply_config(config, 'dnstk.toml', argv[0], subparsers)
+    return parser.parse_args(argv)
+
+
+def test_domain_count():
+    assert domain_count('250') == 250
+    assert domain_count(' All ') is None
+    assert domain_count('none') is None
+    with pytest.raises(ValueError):
+        domain_count('many')
+
+
+def test_optional_path():
+    assert optional_path('results.csv') == 'results.csv'
+    assert optional_path('') is None
+    assert optional_path('None') is None
+
+
+def test_scan_is_concurrent_by_default():
+    assert parse(['scan']).concurrent is True
+    assert parse(['scan', '--no-concurrent']).concurrent is False
+
+
+def test_section_overrides_shared_and_command_line_overrides_both():
+    config = {'timeout': 1.5, 'num-domains': 'all', 'scan': {'timeout': 0.5, 'concurrent': False}}
+    args = parse(['scan'], config)
+    assert (args.timeout, args.num_domains, args.concurrent) == (0.5, None, False)
+    assert parse(['scan', '--timeout', '3', '--num-domains', '10'], config).timeout == 3.0
+    assert parse(['scan', '--timeout', '3', '--num-domains', '10'], config).num_domains == 10
+    # Shared options only apply where the subcommand has them
+    assert parse(['dnssec'], config).timeout == 1.5
+
+
+def test_underscores_and_dashes_are_interchangeable():
+    config = {'num_domains': 5, 'export_latency': {'csv': 'out.csv', 'start': '2024-01-01'}}
+    assert parse(['scan'], config).num_domains == 5
+    args = parse(['export-latency'], config)
+    assert (args.csv, args.start) == ('out.csv', '2024-01-01')
+    assert parse(['export-latency'], {'export-latency': {'csv': 'out.csv'}}).csv == 'out.csv'
+
+
+def test_tables_and_lists_become_option_values():
+    args = parse(['load'], {'load': {'mix': {'popular': 0.5, 'random': 0.5}}})
+    assert args.mix == {'popular': 0.5, 'random': 0.5}
+    args = parse(['benchmark'], {'benchmark': {'server-counts': 2, 'domain-counts': ['100', 200]}})
+    assert (args.server_counts, args.domain_counts) == ([2], [100, 200])
+
+
+@pytest.mark.parametrize('config', [{'nonsense': 1}, {'scna': {'timeout': 1}}])
+def test_unknown_keys_are_rejected(config):
+    with pytest.raises(SystemExit):
+        parse(['scan'], config)
+
+
+def test_unknown_option_of_a_section_is_rejected(capsys):
+    with pytest.raises(SystemExit):
+        parse(['scan'], {'scan': {'history': 'x.jsonl'}})
+    assert "[scan] has no option 'history'" in capsys.readouterr().err